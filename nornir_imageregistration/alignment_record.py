@@ -16,11 +16,13 @@ class AlignmentRecord:
     Records basic registration information as an angle and offset between a fixed and moving image
     If the offset is zero the center of both images occupy the same point.  
     The offset determines the translation of the moving image over the fixed image.
-    There is no support for scale, and there should not be unless added as another variable to the alignment record
+    There is no support for scale, and there should not be unless added as another variable to the alignment record.
+    An estimated scale can be recorded, but it is not applied to the transform.
     
     :param array peak: Translation vector for moving image
     :param float weight: The strength of the alignment
     :param float angle: Angle to rotate moving image in degrees
+    :param float ScaleEstimate: Optional estimate of the size of moving image features relative to the fixed image
     
     '''
 
@@ -43,6 +45,11 @@ class AlignmentRecord:
     def weight(self, value):
         self._weight = value
 
+    @property
+    def ScaleEstimate(self):
+        '''Estimated size of moving image features relative to the fixed image, None if not estimated'''
+        return self._ScaleEstimate
+
     @property
     def peak(self):
         '''Translation vector for the alignment'''
@@ -64,13 +71,17 @@ class AlignmentRecord:
         Returns a new alignment record with the coordinates of the peak reversed
         Used to change the frame of reference of the alignment from one tile to another
         '''
-        return AlignmentRecord((-self.peak[0], -self.peak[1]), self.weight, self.angle)
+        InverseScale = None
+        if self.ScaleEstimate is not None:
+            InverseScale = 1.0 / self.ScaleEstimate
+
+        return AlignmentRecord((-self.peak[0], -self.peak[1]), self.weight, self.angle, ScaleEstimate=InverseScale)
 
     def __str__(self):
         s = 'angle: ' + str(self._angle) + ' offset: ' + str(self._peak) + ' weight: ' + str(self._weight)
         return s
 
-    def __init__(self, peak, weight, angle=0.0):
+    def __init__(self, peak, weight, angle=0.0, ScaleEstimate=None):
         if not isinstance(angle, float):
             angle = float(angle)
 
@@ -81,6 +92,7 @@ class AlignmentRecord:
 
         self._peak = peak
         self._weight = weight
+        self._ScaleEstimate = ScaleEstimate
 
     def CorrectPeakForOriginalImageSize(self, FixedImageShape, MovingImageShape):
 
@@ -6,6 +6,7 @@ Created on Jul 10, 2012
  
 import itertools
 import math
+import multiprocessing
 from operator import attrgetter
 import os
 
@@ -39,21 +40,143 @@ def _CalculateImageFFTs(tiles):
     pool.wait_completion()
     
     
-def TranslateTiles(transforms, imagepaths, excess_scalar, imageScale=None):
+# Pairs whose cropped overlapping regions have the same shape are registered together with core.FindOffsetBatch.
+# Set to 1 to register each pair in its own task.
+PhaseCorrelationBatchSize = 16
+
+# Cropped overlapping regions are enlarged to a multiple of this many pixels so pairs with similar overlaps can be batched
+BatchedRegionShapeMultiple = 32
+
+# Search window registration skips pairs whose template would be smaller than this many pixels in either dimension
+MinSearchTemplateSize = 16
+
+
+def _OrderedOverlappingPairs(list_tiles, min_overlap):
+    '''
+    :return: Overlapping tile pairs ordered so each tile is decoded once
+    '''
+    
+    pairs = list(nornir_imageregistration.tile.IterateOverlappingTiles(list_tiles, min_overlap))
+    (ordered_pairs, cache_size) = nornir_imageregistration.tile.OrderOverlappingPairsByTile(list_tiles, pairs)
+    return ordered_pairs
+
+
+def _WorkerCacheSize(ordered_pairs):
+    '''
+    :return: Number of tile images each worker should cache when processing the pairs in order.  Workers receive pairs
+             from across the sweep, so each worker is given the size for the whole sweep.  The memory of each worker's
+             cache is also bounded by tile.MaxCachedTileImageBytes.
+    '''
+    cache_size = nornir_imageregistration.tile.CacheSizeForPairOrder(ordered_pairs)
+    
+    # Workers finish pairs out of order, leave room for the tiles of pairs still in progress
+    return min(cache_size + (2 * multiprocessing.cpu_count()), nornir_imageregistration.tile.MaxCachedTileImages)
+
+
+def _PadRegionsForPhaseCorrelation(RegionA, RegionB):
+    '''
+    Pad normalized overlapping regions with noise to a size FFT's transform efficiently.  The cropped regions are not 
+    enlarged, so the correlation sees the same image content at any padded size.
+    :return: (Padded RegionA, Padded RegionB)
+    '''
+    (Height, Width) = core.PaddedShapeForPhaseCorrelation(RegionA.shape, MinOverlap=1.0, PaddingPolicy=core.PaddingPolicies.SMOOTH)
+    return (core.PadImageForPhaseCorrelation(RegionA, NewWidth=Width, NewHeight=Height, MinOverlap=1.0),
+            core.PadImageForPhaseCorrelation(RegionB, NewWidth=Width, NewHeight=Height, MinOverlap=1.0))
+
+
+def _BatchedRegionShape(overlapping_rect, excess_scalar):
+    '''
+    :return: The shape of the cropped overlapping region, rounded up to a multiple of BatchedRegionShapeMultiple
+    '''
+    scaled_size = spatial.Rectangle.scale(overlapping_rect, excess_scalar).Size
+    return tuple((np.ceil(scaled_size / BatchedRegionShapeMultiple) * BatchedRegionShapeMultiple).astype(np.int64).tolist())
+    
+
+def _SearchWindowRegions(overlapping_rect_A, overlapping_rect_B, A_shape, window_radius):
+    '''
+    The template is the part of B's overlapping region which stays within tile A when displaced by up to window_radius
+    pixels.  The search region is the template's region of tile A enlarged by window_radius on every side.
+    :param tuple A_shape: Shape of tile A's image
+    :param int window_radius: Largest displacement searched, in downsampled pixels
+    :return: (search_rect_A, template_rect_B), or None if the template would be smaller than MinSearchTemplateSize
+    '''
+    
+    origin_A = np.asarray(overlapping_rect_A.BottomLeft, dtype=np.int64)
+    origin_B = np.asarray(overlapping_rect_B.BottomLeft, dtype=np.int64)
+    size = np.asarray(overlapping_rect_A.Size, dtype=np.int64)
+    
+    # Bounds of tile A relative to the overlapping region
+    min_A = -origin_A
+    max_A = np.asarray(A_shape, dtype=np.int64) - origin_A
+    
+    template_min = np.maximum(0, min_A + window_radius)
+    template_max = np.minimum(size, max_A - window_radius)
+    template_size = template_max - template_min
+    if np.any(template_size < MinSearchTemplateSize):
+        return None
+    
+    template_rect_B = spatial.Rectangle.CreateFromPointAndArea(origin_B + template_min, template_size)
+    search_rect_A = spatial.Rectangle.CreateFromPointAndArea(origin_A + template_min - window_radius, template_size + (2 * window_radius))
+    return (search_rect_A, template_rect_B)
+    
+
+def _BatchPairsByRegionShape(pair_regions, excess_scalar, batch_size):
+    '''
+    Group pairs into batches whose cropped overlapping regions have the same shape.  Pairs are added to batches in
+    order, so each batch holds pairs that were close together in the original order.
+    :param list pair_regions: List of (A, B, overlapping_rect_A, overlapping_rect_B, OffsetAdjustment)
+    :return: List of (cropped shape, list of pair regions)
+    '''
+    
+    batches = []
+    open_batches = {}
+    for pair_region in pair_regions:
+        shape = _BatchedRegionShape(pair_region[2], excess_scalar)
+        
+        batch = open_batches.get(shape, None)
+        if batch is None:
+            batch = (shape, [])
+            open_batches[shape] = batch
+            batches.append(batch)
+            
+        batch[1].append(pair_region)
+        if len(batch[1]) >= batch_size:
+            del open_batches[shape]
+            
+    return batches
+    
+    
+def TranslateTiles(transforms, imagepaths, excess_scalar, imageScale=None, LayoutSolver=None, MaxDisplacement=None, CorrelationMode=None):
     '''
     Finds the optimal translation of a set of tiles to construct a larger seemless mosaic.
     :param float excess_scalar: How much additional area should we pad the overlapping regions with.
+    :param str LayoutSolver: One of layout.LayoutSolvers, defaults to relaxation
+    :param float MaxDisplacement: Largest expected error of the tile positions in full resolution pixels.  If specified each
+                                  pair is registered with normalized cross-correlation over only that window of offsets instead
+                                  of phase correlation of the expanded overlapping regions, and excess_scalar is ignored.
+    :param str CorrelationMode: One of core.CorrelationModes, defaults to core.DefaultCorrelationMode.  With core.CorrelationModes.MASKED_NCC
+                                the parts of the expanded overlapping regions outside the tiles are masked instead of filled with noise.
     '''
 
+    if LayoutSolver is None:
+        LayoutSolver = nornir_imageregistration.layout.LayoutSolvers.RELAX
+
+    if not LayoutSolver in nornir_imageregistration.layout.LayoutSolvers.Solvers:
+        raise ValueError("Unknown layout solver %s, expected one of %s" % (LayoutSolver, str(nornir_imageregistration.layout.LayoutSolvers.Solvers)))
+
     tiles = nornir_imageregistration.tile.CreateTiles(transforms, imagepaths)
 
     if imageScale is None:
         imageScale = tileset.MostCommonScalar(transforms, imagepaths)
 
-    offsets_collection = _FindTileOffsets(tiles, excess_scalar, imageScale=imageScale)
+    offsets_collection = _FindTileOffsets(tiles, excess_scalar, imageScale=imageScale, max_displacement=MaxDisplacement, correlation_mode=CorrelationMode)
     
     nornir_imageregistration.layout.ScaleOffsetWeightsByPopulationRank(offsets_collection, min_allowed_weight=0.25, max_allowed_weight=1.0)
-    nornir_imageregistration.layout.RelaxLayout(offsets_collection, max_tension_cutoff=1.0, max_iter=150)
+    
+    if LayoutSolver == nornir_imageregistration.layout.LayoutSolvers.LEAST_SQUARES:
+        nornir_imageregistration.layout.SolveLayoutLeastSquares(offsets_collection, reweight_iterations=3)
+    else:
+        nornir_imageregistration.layout.RelaxLayout(offsets_collection, max_tension_cutoff=1.0, max_iter=150)
     
     # final_layout = nornir_imageregistration.layout.BuildLayoutWithHighestWeightsFirst(offsets_collection)
 
@@ -61,10 +184,12 @@ def TranslateTiles(transforms, imagepaths, excess_scalar, imageScale=None):
     return (offsets_collection, tiles)
 
 
-def RefineTranslations(transforms, imagepaths, imageScale=None, subregion_shape=None):
+def RefineTranslations(transforms, imagepaths, imageScale=None, subregion_shape=None, MaxDisplacement=None):
     '''
     Refine the initial translate results by registering a number of smaller regions and taking the average offset.  Then update the offsets.
     This still produces a translation only offset
+    :param float MaxDisplacement: Largest expected error of the tile positions in full resolution pixels.  If specified each
+                                  subregion is registered with normalized cross-correlation over only that window of offsets.
     '''
     if imageScale is None:
         imageScale = 1.0
@@ -73,6 +198,7 @@ def RefineTranslations(transforms, imagepaths, imageScale=None, subregion_shape=
         subregion_shape = np.array([128, 128])
         
     downsample = 1.0 / imageScale
+    window_radius = _WindowRadius(MaxDisplacement, imageScale)
     
     tiles = nornir_imageregistration.tile.CreateTiles(transforms, imagepaths)
     list_tiles = list(tiles.values())
@@ -86,12 +212,16 @@ def RefineTranslations(transforms, imagepaths, imageScale=None, subregion_shape=
     for t in list_tiles:
         layout.CreateNode(t.ID, t.ControlBoundingBox.Center)
         
-    for A, B in nornir_imageregistration.tile.IterateOverlappingTiles(list_tiles, minOverlap=0.03):
+    ordered_pairs = _OrderedOverlappingPairs(list_tiles, min_overlap=0.03)
+    cache_size = _WorkerCacheSize(ordered_pairs)
+    cache_pass = nornir_imageregistration.tile.NewCachePassID()
+        
+    for A, B in ordered_pairs:
         # OK... add some small neighborhoods and register those...
-        (downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = __Calculate_Overlapping_Regions(A, B, imageScale)
+        (downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = nornir_imageregistration.tile.Tile.Calculate_Overlapping_Regions(A, B, imageScale)
 #         
           
-        task = pool.add_task("Align %d -> %d" % (A.ID, B.ID), __RefineTileAlignmentRemote, A, B, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, imageScale, subregion_shape)
+        task = pool.add_task("Align %d -> %d" % (A.ID, B.ID), __RefineTileAlignmentRemote, A.ImagePath, B.ImagePath, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, imageScale, subregion_shape, cache_size, window_radius=window_radius, cache_pass=cache_pass)
         task.A = A
         task.B = B
         task.OffsetAdjustment = OffsetAdjustment
@@ -129,22 +259,39 @@ def RefineTranslations(transforms, imagepaths, imageScale=None, subregion_shape=
         
     pool.wait_completion()
     
+    # Worker processes release their images when they receive a task from the next pass
+    nornir_imageregistration.tile.ClearTileImageCache()
+    
     return (layout, tiles)
             
         
     
     
-def _FindTileOffsets(tiles, excess_scalar, min_overlap=0.05, imageScale=None):
+def _WindowRadius(max_displacement, imageScale):
+    '''
+    :return: max_displacement converted to downsampled pixels, or None if max_displacement is None
+    '''
+    if max_displacement is None:
+        return None
+    
+    return max(int(np.ceil(max_displacement * imageScale)), 1)
+
+
+def _FindTileOffsets(tiles, excess_scalar, min_overlap=0.05, imageScale=None, max_displacement=None, correlation_mode=None):
     '''Populates the OffsetToTile dictionary for tiles
     :param dict tiles: Dictionary mapping TileID to a tile
     :param dict imageScale: downsample level if known.  None causes it to be calculated.
-    :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.'''
+    :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.
+    :param float max_displacement: If specified, register pairs using a search window of this radius in full resolution pixels
+    :param str correlation_mode: One of core.CorrelationModes.  Masked correlation registers each pair in its own task.'''
     
 
     if imageScale is None:
         imageScale = 1.0
         
     downsample = 1.0 / imageScale
+    window_radius = _WindowRadius(max_displacement, imageScale)
+    masked = core._ResolveCorrelationMode(correlation_mode) == core.CorrelationModes.MASKED_NCC
 
     # idx = tileset.CreateSpatialMap([t.ControlBoundingBox for t in tiles], tiles)
 
@@ -162,81 +309,161 @@ def _FindTileOffsets(tiles, excess_scalar, min_overlap=0.05, imageScale=None):
     for t in list_tiles:
         layout.CreateNode(t.ID, t.ControlBoundingBox.Center)
         
+    # Pairs are ordered so each tile image is decoded once and shared by all of its pairs through a cache on the workers
+    ordered_pairs = _OrderedOverlappingPairs(list_tiles, min_overlap)
+    
+    pair_regions = []
+    for A, B in ordered_pairs:
+        (downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = nornir_imageregistration.tile.Tile.Calculate_Overlapping_Regions(A, B, imageScale)
+        pair_regions.append((A, B, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment))
+        
+    if PhaseCorrelationBatchSize > 1 and window_radius is None and not masked:
+        batches = _BatchPairsByRegionShape(pair_regions, excess_scalar, PhaseCorrelationBatchSize)
+    else:
+        batches = [(None, [pair_region]) for pair_region in pair_regions]
+        
+    cache_size = _WorkerCacheSize([(pair_region[0], pair_region[1]) for (shape, batch) in batches for pair_region in batch])
+    cache_pass = nornir_imageregistration.tile.NewCachePassID()
+        
     print("Starting tile alignment") 
-    for A, B in nornir_imageregistration.tile.IterateOverlappingTiles(list_tiles, min_overlap):
+    for (cropped_shape, batch) in batches:
         # Used for debugging: __tile_offset(A, B, imageScale)
         # t = pool.add_task("Align %d -> %d %s", __tile_offset, A, B, imageScale)
-        (downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = nornir_imageregistration.tile.Tile.Calculate_Overlapping_Regions(A, B, imageScale)
         
         # __tile_offset_remote(A.ImagePath, B.ImagePath, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, excess_scalar)
         
         try:
-            t = pool.add_task("Align %d -> %d" % (A.ID, B.ID), __tile_offset_remote, A.ImagePath, B.ImagePath, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, excess_scalar)
+            if window_radius is not None:
+                (A, B, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = batch[0]
+                t = pool.add_task("Align %d -> %d" % (A.ID, B.ID), __tile_offset_window_remote, A.ImagePath, B.ImagePath, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, window_radius, cache_size, cache_pass=cache_pass)
+            elif cropped_shape is None:
+                (A, B, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment) = batch[0]
+                t = pool.add_task("Align %d -> %d" % (A.ID, B.ID), __tile_offset_remote, A.ImagePath, B.ImagePath, downsampled_overlapping_rect_A, downsampled_overlapping_rect_B, OffsetAdjustment, excess_scalar, cache_size, masked, cache_pass=cache_pass)
+            else:
+                t = pool.add_task("Align %d pairs %s" % (len(batch), str(cropped_shape)), __tile_offset_batch_remote,
+                                  [pair_region[0].ImagePath for pair_region in batch],
+                                  [pair_region[1].ImagePath for pair_region in batch],
+                                  [pair_region[2] for pair_region in batch],
+                                  [pair_region[3] for pair_region in batch],
+                                  [pair_region[4] for pair_region in batch],
+                                  excess_scalar, cropped_shape, cache_size, cache_pass=cache_pass)
         except FloatingPointError as e:  # Very rarely the overlapping region is entirely one color and this error is thrown.
-            print("%d -> %d = %s" % (t.A.ID, t.B.ID, str(e)))
+            for pair_region in batch:
+                print("%d -> %d = %s" % (pair_region[0].ID, pair_region[1].ID, str(e)))
+            continue
         
-        t.A = A
-        t.B = B
+        t.batched = cropped_shape is not None
+        t.pairs = batch
         tasks.append(t) 
-        CalculationCount += 1
+        CalculationCount += len(batch)
         # print("Start alignment %d -> %d" % (A.ID, B.ID))
 
     for t in tasks:
         try:
-            offset = t.wait_return()
+            offsets = t.wait_return()
+            if not t.batched:
+                offsets = [offsets]
         except FloatingPointError as e:  # Very rarely the overlapping region is entirely one color and this error is thrown.
-            print("%d -> %d = %s" % (t.A.ID, t.B.ID, str(e)))
-            continue 
-        
-        # Figure out what offset we found vs. what offset we expected
-        PredictedOffset = t.B.ControlBoundingBox.Center - t.A.ControlBoundingBox.Center
-        ActualOffset = offset.peak * downsample
-        
-        diff = ActualOffset - PredictedOffset
-        distance = np.sqrt(np.sum(diff ** 2))
-        
-        print("%d -> %d = %g" % (t.A.ID, t.B.ID, distance))
-        
-        layout.SetOffset(t.A.ID, t.B.ID, ActualOffset, offset.weight) 
+            offsets = [e] * len(t.pairs)
+            
+        for (pair_region, offset) in zip(t.pairs, offsets):
+            (A, B) = pair_region[0:2]
+            if isinstance(offset, FloatingPointError):
+                print("%d -> %d = %s" % (A.ID, B.ID, str(offset)))
+                continue 
+            
+            if offset is None:
+                print("%d -> %d = No peak within %d pixels" % (A.ID, B.ID, window_radius))
+                continue
+            
+            # Figure out what offset we found vs. what offset we expected
+            PredictedOffset = B.ControlBoundingBox.Center - A.ControlBoundingBox.Center
+            ActualOffset = offset.peak * downsample
+            
+            diff = ActualOffset - PredictedOffset
+            distance = np.sqrt(np.sum(diff ** 2))
+            
+            print("%d -> %d = %g" % (A.ID, B.ID, distance))
+            
+            layout.SetOffset(A.ID, B.ID, ActualOffset, offset.weight) 
         
     pool.wait_completion()
     
+    # Worker processes release their images when they receive a task from the next pass
+    nornir_imageregistration.tile.ClearTileImageCache()
+    
     print(("Total offset calculations: " + str(CalculationCount)))
 
     return layout
 
 
 
-def __get_overlapping_image(image, overlapping_rect, excess_scalar):
+def __get_overlapping_rect(overlapping_rect, excess_scalar, cropped_shape=None):
+    '''
+    :return: The region of the tile's image to crop so it contains the specified rectangle
+    '''
+    
+    scaled_rect = spatial.Rectangle.scale(overlapping_rect, excess_scalar)
+    if cropped_shape is not None:
+        scaled_rect = spatial.Rectangle.change_area(scaled_rect, cropped_shape)
+        
+    return spatial.Rectangle.SafeRound(scaled_rect)
+
+
+def __get_overlapping_image(image, overlapping_rect, excess_scalar, cropped_shape=None):
+    '''
+    Crop the tile's image so it contains the specified rectangle.  Areas outside the image are filled with noise.
+    :param tuple cropped_shape: Crop a region of exactly this shape centered on the scaled rectangle
+    '''
+    
+    scaled_rect = __get_overlapping_rect(overlapping_rect, excess_scalar, cropped_shape)
+    # Callers normalize the cropped image in place, so it must not be a view of a cached tile image
+    return core.CropImage(image, Xo=int(scaled_rect.BottomLeft[1]), Yo=int(scaled_rect.BottomLeft[0]), Width=int(scaled_rect.Width), Height=int(scaled_rect.Height), cval='random', copy=True)
+
+
+def __get_overlapping_image_and_mask(image, overlapping_rect, excess_scalar, cropped_shape=None):
     '''
-    Crop the tile's image so it contains the specified rectangle
+    Crop the tile's image so it contains the specified rectangle.  Areas outside the image are zero and masked.
+    :return: (cropped image, boolean mask of the pixels inside the image)
     '''
     
-    scaled_rect = spatial.Rectangle.SafeRound(spatial.Rectangle.scale(overlapping_rect, excess_scalar))
-    return core.CropImage(image, Xo=int(scaled_rect.BottomLeft[1]), Yo=int(scaled_rect.BottomLeft[0]), Width=int(scaled_rect.Width), Height=int(scaled_rect.Height), cval='random')
+    scaled_rect = __get_overlapping_rect(overlapping_rect, excess_scalar, cropped_shape)
+    (Xo, Yo, Width, Height) = (int(scaled_rect.BottomLeft[1]), int(scaled_rect.BottomLeft[0]), int(scaled_rect.Width), int(scaled_rect.Height))
+    return (core.CropImage(image, Xo=Xo, Yo=Yo, Width=Width, Height=Height, cval=0), core.CropMask(image.shape, Xo=Xo, Yo=Yo, Width=Width, Height=Height))
     
     # return core.PadImageForPhaseCorrelation(cropped, MinOverlap=1.0, PowerOfTwo=True)
 
     
  
 
-def __tile_offset_remote(A_Filename, B_Filename, overlapping_rect_A, overlapping_rect_B, OffsetAdjustment, excess_scalar):
+def __tile_offset_remote(A_Filename, B_Filename, overlapping_rect_A, overlapping_rect_B, OffsetAdjustment, excess_scalar, cache_size=None, masked=False, cache_pass=None):
     '''
     :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.
+    :param int cache_size: Number of decoded tile images the worker should keep for other pairs
+    :param str cache_pass: ID of the pass, the worker releases images cached for earlier passes
+    :param bool masked: Use masked normalized cross-correlation, excluding the parts of the overlapping regions outside the tiles
     Return the offset required to align to image files.
     This function exists to minimize the inter-process communication
     '''
     
-    A = core.LoadImage(A_Filename).astype(dtype=np.float16)
-    B = core.LoadImage(B_Filename).astype(dtype=np.float16)
+    A = nornir_imageregistration.tile.GetCachedTileImage(A_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+    B = nornir_imageregistration.tile.GetCachedTileImage(B_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
 
 # I had to add the .astype call above for DM4 support, but I recall it broke PMG input.  Leave this comment here until the tests are passing
-#    A = core.LoadImage(A_Filename) #.astype(dtype=np.float16)
-#    B = core.LoadImage(B_Filename) #.astype(dtype=np.float16)
+#    A = core.LoadImage(A_Filename) #.astype(dtype=core.ComputeDtype)
+#    B = core.LoadImage(B_Filename) #.astype(dtype=core.ComputeDtype)
 
     
     # I tried a 1.0 overlap.  It works better for light microscopy where the reported stage position is more precise
     # For TEM the stage position can be less reliable and the 1.5 scalar produces better results
+    if masked:
+        # Correlation coefficients do not depend on the intensity range, so the regions are not normalized
+        (OverlappingRegionA, MaskA) = __get_overlapping_image_and_mask(A, overlapping_rect_A, excess_scalar=excess_scalar)
+        (OverlappingRegionB, MaskB) = __get_overlapping_image_and_mask(B, overlapping_rect_B, excess_scalar=excess_scalar)
+        
+        record = core.FindOffset(OverlappingRegionA, OverlappingRegionB, FixedMask=MaskA, MovingMask=MaskB)
+        return nornir_imageregistration.AlignmentRecord(np.array(record.peak) + OffsetAdjustment, record.weight)
+    
     OverlappingRegionA = __get_overlapping_image(A, overlapping_rect_A, excess_scalar=excess_scalar)
     OverlappingRegionB = __get_overlapping_image(B, overlapping_rect_B, excess_scalar=excess_scalar)
     
@@ -246,6 +473,8 @@ def __tile_offset_remote(A_Filename, B_Filename, overlapping_rect_A, overlapping
     OverlappingRegionB -= OverlappingRegionB.min()
     OverlappingRegionB /= OverlappingRegionB.max()
     
+    (OverlappingRegionA, OverlappingRegionB) = _PadRegionsForPhaseCorrelation(OverlappingRegionA, OverlappingRegionB)
+    
     # core.ShowGrayscale([OverlappingRegionA, OverlappingRegionB])
     
     record = core.FindOffset(OverlappingRegionA, OverlappingRegionB, FFT_Required=True)
@@ -259,6 +488,178 @@ def __tile_offset_remote(A_Filename, B_Filename, overlapping_rect_A, overlapping
     return adjusted_record
 
 
+def __tile_offset_window_remote(A_Filename, B_Filename, overlapping_rect_A, overlapping_rect_B, OffsetAdjustment, window_radius, cache_size=None, cache_pass=None):
+    '''
+    Return the offset required to align two image files, searching only displacements of up to window_radius pixels from OffsetAdjustment.
+    :param int window_radius: Largest displacement searched, in downsampled pixels
+    :param int cache_size: Number of decoded tile images the worker should keep for other pairs
+    :param str cache_pass: ID of the pass, the worker releases images cached for earlier passes
+    :return: An alignment record, or None if the overlap is too small, uniform, or has no peak inside the window
+    '''
+    
+    A = nornir_imageregistration.tile.GetCachedTileImage(A_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+    B = nornir_imageregistration.tile.GetCachedTileImage(B_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+    
+    record = __register_within_window(A, B, overlapping_rect_A, overlapping_rect_B, window_radius)
+    if record is None:
+        return None
+    
+    return nornir_imageregistration.AlignmentRecord(np.array(record.peak) + OffsetAdjustment, record.weight)
+
+
+def __register_within_window(A, B, overlapping_rect_A, overlapping_rect_B, window_radius):
+    '''
+    :return: Alignment record from core.FindOffsetWithinWindow for the overlapping regions, or None if they cannot be registered
+    '''
+    regions = _SearchWindowRegions(overlapping_rect_A, overlapping_rect_B, A.shape, window_radius)
+    if regions is None:
+        return None
+    
+    (search_rect_A, template_rect_B) = regions
+    SearchRegion = core.CropImageRect(A, search_rect_A, cval=0)
+    Template = core.CropImageRect(B, template_rect_B, cval=0)
+    
+    return core.FindOffsetWithinWindow(SearchRegion, Template)
+
+
+def __tile_offset_batch_remote(A_Filenames, B_Filenames, overlapping_rects_A, overlapping_rects_B, OffsetAdjustments, excess_scalar, cropped_shape, cache_size=None, cache_pass=None):
+    '''
+    Return the offsets required to align a batch of image pairs.  The overlapping regions of every pair are cropped to
+    the same shape so they can be registered with a single call to core.FindOffsetBatch.
+    :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.
+    :param tuple cropped_shape: Shape the overlapping regions are cropped to
+    :param int cache_size: Number of decoded tile images the worker should keep for other pairs
+    :param str cache_pass: ID of the pass, the worker releases images cached for earlier passes
+    :return: A list with an alignment record for each pair, or the FloatingPointError raised when registering the pair
+    '''
+    
+    num_pairs = len(A_Filenames)
+    results = [None] * num_pairs
+    
+    iRegistered = []
+    FixedRegions = []
+    MovingRegions = []
+    for i in range(0, num_pairs):
+        A = nornir_imageregistration.tile.GetCachedTileImage(A_Filenames[i], dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+        B = nornir_imageregistration.tile.GetCachedTileImage(B_Filenames[i], dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+        
+        try:
+            OverlappingRegionA = __get_overlapping_image(A, overlapping_rects_A[i], excess_scalar=excess_scalar, cropped_shape=cropped_shape)
+            OverlappingRegionB = __get_overlapping_image(B, overlapping_rects_B[i], excess_scalar=excess_scalar, cropped_shape=cropped_shape)
+            
+            OverlappingRegionA -= OverlappingRegionA.min()
+            OverlappingRegionA /= OverlappingRegionA.max()
+            
+            OverlappingRegionB -= OverlappingRegionB.min()
+            OverlappingRegionB /= OverlappingRegionB.max()
+            
+            (OverlappingRegionA, OverlappingRegionB) = _PadRegionsForPhaseCorrelation(OverlappingRegionA, OverlappingRegionB)
+        except FloatingPointError as e:  # The overlapping region is entirely one color
+            results[i] = e
+            continue
+        
+        iRegistered.append(i)
+        FixedRegions.append(OverlappingRegionA)
+        MovingRegions.append(OverlappingRegionB)
+        
+    if len(iRegistered) == 0:
+        return results
+    
+    try:
+        records = core.FindOffsetBatch(FixedRegions, MovingRegions, FFT_Required=True)
+    except FloatingPointError:
+        # One of the pairs cannot be registered, register them individually so only that pair fails
+        records = []
+        for (OverlappingRegionA, OverlappingRegionB) in zip(FixedRegions, MovingRegions):
+            try:
+                records.append(core.FindOffset(OverlappingRegionA, OverlappingRegionB, FFT_Required=True))
+            except FloatingPointError as e:
+                records.append(e)
+                
+    for (i, record) in zip(iRegistered, records):
+        if isinstance(record, FloatingPointError):
+            results[i] = record
+        else:
+            results[i] = nornir_imageregistration.AlignmentRecord(np.array(record.peak) + OffsetAdjustments[i], record.weight)
+        
+    return results
+
+
+def __RefineTileAlignmentRemote(A_Filename, B_Filename, overlapping_rect_A, overlapping_rect_B, OffsetAdjustment, imageScale, subregion_shape, cache_size=None, excess_scalar=1.5, window_radius=None, cache_pass=None):
+    '''
+    Register subregions of the overlapping regions of two tiles and average the offsets weighted by the strength of each peak.
+    :param ndarray subregion_shape: Shape of the subregions to register
+    :param int cache_size: Number of decoded tile images the worker should keep for other pairs
+    :param str cache_pass: ID of the pass, the worker releases images cached for earlier passes
+    :param float excess_scalar: How much additional area should we pad each subregion with.
+    :param int window_radius: If specified, register each subregion by searching only displacements of up to this many downsampled pixels.  excess_scalar is ignored.
+    :return: (point_pairs, net_offset) where point_pairs is an array of [AY, AX, BY, BX] for the center of each subregion
+             and net_offset is [Y, X, Weight].  Points and offsets are in full resolution pixels.
+    '''
+    
+    A = nornir_imageregistration.tile.GetCachedTileImage(A_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+    B = nornir_imageregistration.tile.GetCachedTileImage(B_Filename, dtype=core.ComputeDtype, CacheSize=cache_size, PassID=cache_pass)
+    
+    region_shape = np.array(overlapping_rect_A.Size, dtype=np.int64)
+    
+    # Use a single subregion if the overlapping region is smaller than the requested subregion
+    subregion_shape = np.minimum(np.asarray(subregion_shape, dtype=np.int64), region_shape)
+    grid_dims = region_shape // subregion_shape
+    
+    downsample = 1.0 / imageScale
+    point_pairs = []
+    peaks = []
+    weights = []
+    for iY in range(0, grid_dims[0]):
+        for iX in range(0, grid_dims[1]):
+            origin = np.array((iY, iX)) * subregion_shape
+            subregion_rect_A = spatial.Rectangle.CreateFromPointAndArea(overlapping_rect_A.BottomLeft + origin, subregion_shape)
+            subregion_rect_B = spatial.Rectangle.CreateFromPointAndArea(overlapping_rect_B.BottomLeft + origin, subregion_shape)
+            
+            if window_radius is not None:
+                record = __register_within_window(A, B, subregion_rect_A, subregion_rect_B, window_radius)
+                if record is None:
+                    continue
+            else:
+                try:
+                    SubregionA = __get_overlapping_image(A, subregion_rect_A, excess_scalar=excess_scalar)
+                    SubregionB = __get_overlapping_image(B, subregion_rect_B, excess_scalar=excess_scalar)
+                    
+                    SubregionA -= SubregionA.min()
+                    SubregionA /= SubregionA.max()
+                    SubregionB -= SubregionB.min()
+                    SubregionB /= SubregionB.max()
+                    
+                    (SubregionA, SubregionB) = _PadRegionsForPhaseCorrelation(SubregionA, SubregionB)
+                    
+                    record = core.FindOffset(SubregionA, SubregionB, FFT_Required=True)
+                except FloatingPointError:  # The subregion is entirely one color
+                    continue
+            
+            if not np.all(np.isfinite(record.peak)):
+                continue
+            
+            A_Point = subregion_rect_A.Center
+            B_Point = subregion_rect_B.Center - np.array(record.peak)
+            point_pairs.append(np.hstack((A_Point, B_Point)) * downsample)
+            peaks.append(record.peak)
+            weights.append(record.weight)
+    
+    if len(peaks) == 0:
+        raise ValueError("No subregion of the overlapping region could be registered")
+    
+    peaks = np.array(peaks)
+    weights = np.array(weights)
+    
+    if np.sum(weights) > 0:
+        peak = np.average(peaks, axis=0, weights=weights)
+    else:
+        peak = np.mean(peaks, axis=0)
+        
+    net_offset = np.hstack((peak * downsample, np.mean(weights)))
+    return (np.vstack(point_pairs), net_offset)
+
+
 def __tile_offset(A, B, imageScale):
     '''
     First crop the images so we only send the half of the images which can overlap
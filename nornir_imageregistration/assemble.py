@@ -5,14 +5,17 @@ Created on Apr 22, 2013
 '''
 
 
+import logging
 import os
+import tempfile
 
 from matplotlib.pyplot import imsave
 from nornir_imageregistration.files.stosfile import StosFile
-from   nornir_imageregistration.transforms import factory, triangulation
-from   nornir_imageregistration.transforms.utils import InvalidIndicies
+from   nornir_imageregistration.transforms import factory, piecewiseaffine, sparsegrid, triangulation
 from scipy.ndimage import interpolation
 
+import nornir_imageregistration.completion_queue as completion_queue
+import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
 import nornir_imageregistration.transforms.base as transformbase
 import nornir_pools
 import nornir_shared.images as images
@@ -22,6 +25,25 @@ import numpy as np
 from . import core
 
 
+class WarpMethods(object):
+    '''How the coordinate map of a region is calculated'''
+    
+    POINTS = 'points'  # Pass the coordinates of every pixel through the transform
+    PIECEWISE_AFFINE = 'piecewise-affine'  # Rasterize the triangles of triangulation transforms, other transforms use POINTS
+    
+    Methods = [POINTS, PIECEWISE_AFFINE]
+
+DefaultWarpMethod = WarpMethods.PIECEWISE_AFFINE
+
+# If not None, smooth transforms are evaluated on a sparse lattice and interpolated, keeping the estimated error of
+# the mapped coordinates below this many pixels.  See transforms.sparsegrid.
+DefaultSparseGridTolerance = None
+
+# Pixels of the warped image read beyond the region each streamed tile samples.  The spline filter's boundary effects
+# decay by a factor of about four per pixel, so seams between tiles are negligible.
+StreamedTilePadding = 12
+
+
 def GetROICoords(botleft, area):
     x_range = np.arange(botleft[1], botleft[1] + area[1], dtype=np.float32)
     y_range = np.arange(botleft[0], botleft[0] + area[0], dtype=np.float32)
@@ -44,7 +66,82 @@ def GetROICoords(botleft, area):
 
     return coordArray
 
-def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False):
+def _ROICoordinateMap(transform, botleft, area, inverse, extrapolate=False, WarpMethod=None, SparseGridTolerance=None):
+    '''
+    Pass every pixel in a region through the transform.  Maps are reused from coordinate_map_cache when possible.
+    
+    :param transform transform: The transform used to map points between fixed and mapped space
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
+    :param 1x2_array area: The (Height, Width) of the region of interest
+    :param bool inverse: True to use the inverse transform
+    :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param str WarpMethod: One of WarpMethods, defaults to DefaultWarpMethod
+    :param float SparseGridTolerance: Evaluate the transform on a sparse lattice with this error tolerance in pixels, defaults to DefaultSparseGridTolerance
+    :return: (ValidMask, MappedCoords).  ValidMask is True for the region's pixels the transform maps.  MappedCoords
+             are the mapped coordinates of the valid pixels in row-major order.  Both arrays are read-only.
+    :rtype: tuple(ndarray, Nx2 array)
+    '''
+    
+    if WarpMethod is None:
+        WarpMethod = DefaultWarpMethod
+        
+    if WarpMethod == WarpMethods.PIECEWISE_AFFINE and not piecewiseaffine.SupportsPiecewiseAffine(transform, inverse):
+        WarpMethod = WarpMethods.POINTS
+    
+    if SparseGridTolerance is None:
+        SparseGridTolerance = DefaultSparseGridTolerance
+    
+    cache = coordinate_map_cache.DefaultCache
+    key = None
+    if cache.Enabled:
+        key = coordinate_map_cache.CoordinateMapKey(transform, botleft, area, inverse, extrapolate, tolerance=SparseGridTolerance, WarpMethod=WarpMethod)
+        if key is not None:
+            cached = cache.Get(key)
+            if cached is not None:
+                return cached
+    
+    if WarpMethod == WarpMethods.PIECEWISE_AFFINE:
+        MappedCoords = piecewiseaffine.TransformGrid(transform, botleft, area, inverse=inverse, extrapolate=extrapolate,
+                                                     SparseGridTolerance=SparseGridTolerance).reshape((-1, 2))
+    elif SparseGridTolerance is not None:
+        MappedCoords = sparsegrid.TransformGrid(transform, botleft, area, SparseGridTolerance, inverse=inverse, extrapolate=extrapolate).reshape((-1, 2))
+    else:
+        coordArray = GetROICoords(botleft, area)
+        
+        if inverse:
+            MappedCoords = transform.InverseTransform(coordArray, extrapolate=extrapolate).astype(np.float32, copy=False)
+        else:
+            MappedCoords = transform.Transform(coordArray, extrapolate=extrapolate).astype(np.float32, copy=False)
+            
+        del coordArray
+    
+    ValidMask = np.logical_not(np.isnan(MappedCoords).any(axis=1))
+    if not np.all(ValidMask):
+        MappedCoords = MappedCoords[ValidMask]
+        
+    ValidMask = ValidMask.reshape((int(area[0]), int(area[1])))
+    
+    if key is not None:
+        cache.Add(key, ValidMask, MappedCoords)
+    
+    return (ValidMask, MappedCoords)
+
+
+def _ValidROICoords(ValidMask):
+    '''
+    :return: Coordinates of the valid pixels relative to the region's bottom left corner, in row-major order
+    '''
+    if not np.all(ValidMask):
+        return np.argwhere(ValidMask).astype(np.float32)
+    
+    # Filling the coordinates is much faster than searching the mask when every pixel is valid
+    coords = np.empty(ValidMask.shape + (2,), dtype=np.float32)
+    coords[:, :, 0] = np.arange(ValidMask.shape[0])[:, np.newaxis]
+    coords[:, :, 1] = np.arange(ValidMask.shape[1])[np.newaxis, :]
+    return coords.reshape((-1, 2))
+
+
+def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False, WarpMethod=None, SparseGridTolerance=None):
     ''' 
     Apply a transform to a region of interest within an image. Center and area are in fixed space
     
@@ -52,24 +149,19 @@ def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False):
     :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
     :param 1x2_array area: The (Height, Width) of the region of interest
     :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param str WarpMethod: One of WarpMethods, defaults to DefaultWarpMethod
+    :param float SparseGridTolerance: Evaluate the transform on a sparse lattice with this error tolerance in pixels, defaults to DefaultSparseGridTolerance
     :return: Tuple of arrays.  First array is fixed space coordinates.  Second array is warped space coordinates.
     :rtype: tuple(Nx2 array,Nx2 array)
     '''
 
-    DstSpace_coordArray = GetROICoords(botleft, area)
-
-    SrcSpace_coordArray = transform.InverseTransform(DstSpace_coordArray, extrapolate=extrapolate).astype(np.float32)
-    (valid_SrcSpace_coordArray, InvalidIndiciesList) = InvalidIndicies(SrcSpace_coordArray)
-
-    del SrcSpace_coordArray
-
-    valid_DstSpace_coordArray = np.delete(DstSpace_coordArray, InvalidIndiciesList, axis=0)
-    valid_DstSpace_coordArray = valid_DstSpace_coordArray - botleft
+    (ValidMask, valid_SrcSpace_coordArray) = _ROICoordinateMap(transform, botleft, area, inverse=True, extrapolate=extrapolate, WarpMethod=WarpMethod, SparseGridTolerance=SparseGridTolerance)
+    valid_DstSpace_coordArray = _ValidROICoords(ValidMask)
 
     return (valid_DstSpace_coordArray, valid_SrcSpace_coordArray)
 
 
-def SourceROI_to_DestinationROI(transform, botleft, area, extrapolate=False):
+def SourceROI_to_DestinationROI(transform, botleft, area, extrapolate=False, WarpMethod=None, SparseGridTolerance=None):
     '''
     Apply an inverse transform to a region of interest within an image. Center and area are in fixed space
     
@@ -77,19 +169,14 @@ def SourceROI_to_DestinationROI(transform, botleft, area, extrapolate=False):
     :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
     :param 1x2_array area: The (Height, Width) of the region of interest
     :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param str WarpMethod: One of WarpMethods, defaults to DefaultWarpMethod
+    :param float SparseGridTolerance: Evaluate the transform on a sparse lattice with this error tolerance in pixels, defaults to DefaultSparseGridTolerance
     :return: Tuple of arrays.  First array is fixed space coordinates.  Second array is warped space coordinates.
     :rtype: tuple(Nx2 array,Nx2 array)
     '''
 
-    SrcSpace_coordArray = GetROICoords(botleft, area)
-
-    DstSpace_coordArray = transform.Transform(SrcSpace_coordArray, extrapolate=extrapolate).astype(np.float32)
-    (valid_DstSpace_coordArray, InvalidIndiciesList) = InvalidIndicies(DstSpace_coordArray)
-
-    del DstSpace_coordArray
-
-    valid_SrcSpace_coordArray = np.delete(SrcSpace_coordArray, InvalidIndiciesList, axis=0)
-    valid_SrcSpace_coordArray = valid_SrcSpace_coordArray - botleft
+    (ValidMask, valid_DstSpace_coordArray) = _ROICoordinateMap(transform, botleft, area, inverse=False, extrapolate=extrapolate, WarpMethod=WarpMethod, SparseGridTolerance=SparseGridTolerance)
+    valid_SrcSpace_coordArray = _ValidROICoords(ValidMask)
 
     return (valid_DstSpace_coordArray, valid_SrcSpace_coordArray)
 
@@ -153,14 +240,50 @@ def __CropImageToFitCoords(input_image, coordinates, cval=0):
     
     return (cropped_image, translated_coordinates)
 
-def __WarpedImageUsingCoords(fixed_coords, warped_coords, FixedImageArea, WarpedImage, area=None, cval=0):
+def _LoadImageToFitCoords(ImageFullPath, coordinates, dtype=None, padding=1):
+    '''Read only the region of an image file that __CropImageToFitCoords would crop from the decoded image
+       :param str ImageFullPath: Image file we will be extracting data from at the specified coordinates
+       :param ndarray coordinates: Nx2 array of points indexing into the image
+       :param dtype dtype: Type of the returned image, see core.ReadImage
+       :param int padding: Pixels read beyond the coordinates on each side
+       :return: (cropped_image, translated_coordinates)
+       '''
+    
+    if coordinates.shape[0] == 0:
+        return (np.zeros((1, 1), dtype=dtype), coordinates)
+    
+    minCoord = np.maximum(np.floor(np.min(coordinates, 0)) - np.array([padding, padding]), 0)
+    maxCoord = np.ceil(np.max(coordinates, 0)) + np.array([padding, padding])
+    
+    cropped_image = core.ReadImage(ImageFullPath, dtype=dtype, Region=(minCoord[0], minCoord[1], maxCoord[0], maxCoord[1]))
+    if cropped_image.size == 0:
+        return (np.zeros((1, 1), dtype=cropped_image.dtype), coordinates)
+    
+    return (cropped_image, coordinates - minCoord)
+
+
+def _SplineFilteredSharedArray(image, order):
+    '''
+    :return: The image's spline coefficients in a shared memory array, for map_coordinates with prefilter=False.  The
+             coefficients are calculated as map_coordinates calculates them for mode='constant'.
+    '''
+    filtered = core.npArrayToReadOnlySharedArray(image)
+    if order > 1:
+        interpolation.spline_filter(filtered, order=order, output=filtered, mode='constant')
+    
+    return filtered
+
+
+def __WarpedImageUsingCoords(fixed_coords, warped_coords, FixedImageArea, WarpedImage, area=None, cval=0, order=3, prefiltered=False):
     '''Use the passed coordinates to create a warped image
     :Param fixed_coords: 2D coordinates in fixed space
     :Param warped_coords: 2D coordinates in warped space
     :Param FixedImageArea: Dimensions of fixed space
     :Param WarpedImage: Image to read pixel values from while creating fixed space images
     :Param area: Expected dimensions of output
-    :Param cval: Value to place in unmappable regions, defaults to zero.'''
+    :Param cval: Value to place in unmappable regions, defaults to zero.
+    :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+    :param bool prefiltered: True if WarpedImage contains spline coefficients from _SplineFilteredSharedArray'''
 
     if area is None:
         area = FixedImageArea
@@ -178,16 +301,22 @@ def __WarpedImageUsingCoords(fixed_coords, warped_coords, FixedImageArea, Warped
 
     subroi_warpedImage = None
     # For large images we only need a specific range of the image, but the entire image is passed through a spline filter by map_coordinates
-    # In this case use only a subset of the warpedimage
-    if np.prod(WarpedImage.shape) > warped_coords.shape[0]:
+    # In this case use only a subset of the warpedimage.  Prefiltered images are not filtered again, so are not cropped.
+    if prefiltered:
+        subroi_warpedImage = WarpedImage
+    elif np.prod(WarpedImage.shape) > warped_coords.shape[0]:
     # if not area[0] == FixedImageArea[0] and area[1] == FixedImageArea[1]:
         # if area[0] <= FixedImageArea[0] or area[1] <= FixedImageArea[1]:
         (subroi_warpedImage, warped_coords) = __CropImageToFitCoords(WarpedImage, warped_coords, cval=cval)
         del WarpedImage
     else:
         subroi_warpedImage = WarpedImage
+        
+    # map_coordinates returns the input dtype, and does not support float16
+    if np.issubdtype(subroi_warpedImage.dtype, np.floating):
+        subroi_warpedImage = core.AsComputeDtype(subroi_warpedImage)
     
-    outputImage = interpolation.map_coordinates(subroi_warpedImage, warped_coords.transpose(), mode='constant', order=3, cval=cval)
+    outputImage = interpolation.map_coordinates(subroi_warpedImage, warped_coords.transpose(), mode='constant', order=order, cval=cval, prefilter=not prefiltered)
     if fixed_coords.shape[0] == np.prod(area):
         # All coordinates mapped, so we can return the output warped image as is.
         outputImage = outputImage.reshape(area)
@@ -219,7 +348,7 @@ def _ReplaceFilesWithImages(listImages):
     return listImages
 
 
-def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False):
+def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False, WarpMethod=None, order=3, prefiltered=False):
     '''Warps every image in the DataToTransform list using the provided transform.
     :Param transform: transform to pass warped space coordinates through to obtain fixed space coordinates
     :Param FixedImageArea: Size of fixed space region to map pixels into
@@ -228,6 +357,9 @@ def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft
     :Param area: Expected dimensions of output
     :Param cval: Value to place in unmappable regions, defaults to zero.
     :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param str WarpMethod: One of WarpMethods, defaults to DefaultWarpMethod
+    :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+    :param bool prefiltered: True if the images contain spline coefficients from _SplineFilteredSharedArray
     '''
     
     if botleft is None:
@@ -242,14 +374,14 @@ def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft
     if not isinstance(cval, list):
         cval = [cval] * len(DataToTransform)
 
-    (DstSpace_coords, SrcSpace_coords) = SourceROI_to_DestinationROI(transform, botleft, area, extrapolate=extrapolate)
+    (DstSpace_coords, SrcSpace_coords) = SourceROI_to_DestinationROI(transform, botleft, area, extrapolate=extrapolate, WarpMethod=WarpMethod)
     
     ImagesToTransform = _ReplaceFilesWithImages(DataToTransform)  
 
     if isinstance(ImagesToTransform, list):
         FixedImageList = []
         for i, wi in enumerate(ImagesToTransform):
-            fi = __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, WarpedImageArea, wi, area, cval=cval[i])
+            fi = __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, WarpedImageArea, wi, area, cval=cval[i], order=order, prefiltered=prefiltered)
             FixedImageList.append(fi)
             
         del SrcSpace_coords
@@ -257,11 +389,11 @@ def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft
         
         return FixedImageList
     else:
-        return __WarpedImageUsingCoords(SrcSpace_coords, DstSpace_coords, WarpedImageArea, ImagesToTransform, area, cval=cval[0])
+        return __WarpedImageUsingCoords(SrcSpace_coords, DstSpace_coords, WarpedImageArea, ImagesToTransform, area, cval=cval[0], order=order, prefiltered=prefiltered)
 
         
 
-def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False):
+def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False, WarpMethod=None, order=3, prefiltered=False):
 
     '''Warps every image in the DataToTransform list using the provided transform.
     :Param transform: transform to pass warped space coordinates through to obtain fixed space coordinates
@@ -271,6 +403,9 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
     :Param area: Expected dimensions of output
     :Param cval: Value to place in unmappable regions, defaults to zero.
     :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param str WarpMethod: One of WarpMethods, defaults to DefaultWarpMethod
+    :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+    :param bool prefiltered: True if the images contain spline coefficients from _SplineFilteredSharedArray
     '''
 
     if botleft is None:
@@ -282,7 +417,7 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
     if cval is None:
         cval = 0
         
-    (DstSpace_coords, SrcSpace_coords) = DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=extrapolate)
+    (DstSpace_coords, SrcSpace_coords) = DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=extrapolate, WarpMethod=WarpMethod)
     
     ImagesToTransform = _ReplaceFilesWithImages(DataToTransform)  
 
@@ -292,7 +427,7 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
         
         FixedImageList = []
         for i, wi in enumerate(ImagesToTransform):
-            fi = __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, wi, area, cval=cval[i])
+            fi = __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, wi, area, cval=cval[i], order=order, prefiltered=prefiltered)
             FixedImageList.append(fi)
             
         del SrcSpace_coords
@@ -300,7 +435,7 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
         
         return FixedImageList
     else:
-        return __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, ImagesToTransform, area, cval=cval)
+        return __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, ImagesToTransform, area, cval=cval, order=order, prefiltered=prefiltered)
 
 def ParameterToStosTransform(transformData):
     '''
@@ -315,25 +450,25 @@ def ParameterToStosTransform(transformData):
         stos = StosFile.Load(transformData)
         stostransform = factory.LoadTransform(stos.Transform)
     elif isinstance(transformData, StosFile):
-        stos = transformData.Transform
-        stostransform = factory.LoadTransform(stos.Transform)
+        stostransform = factory.LoadTransform(transformData.Transform)
     elif isinstance(transformData, transformbase.Base):
         stostransform = transformData
         
     return stostransform
 
-def TransformStos(transformData, OutputFilename=None, fixedImageFilename=None, warpedImageFilename=None, scalar=1.0, CropUndefined=False):
-    '''Assembles an image based on the passed transform.
-    :param bool fixedImageFilename: Image describing the size we want the warped image to fill
-    :param bool warpedImageFilename: Image we will warp into fixed space
-    :param float scalar: Amount to scale the transform before passing the image through
-    :param bool CropUndefined: If true do exclude areas outside the convex hull of the transform, if it exists
-    :param bool Dicreet: True causes points outside the defined transform region to be clipped instead of interpolated
-    :return: transformed image
+def _LoadStosForWarp(transformData, fixedImageFilename, warpedImageFilename, scalar, CropUndefined):
+    '''
+    :return: (transform, fixedImageFilename, warpedImageFilename).  The transform is scaled by scalar.  Image filenames
+             default to the images named in the .stos file.  None if an image filename is not known.
     '''
 
     stos = None
-    stostransform = ParameterToStosTransform(transformData)
+    if isinstance(transformData, StosFile):
+        stos = transformData
+    elif isinstance(transformData, str) and os.path.exists(transformData):
+        stos = StosFile.Load(transformData)
+
+    stostransform = ParameterToStosTransform(transformData if stos is None else stos)
 
     if CropUndefined:
         stostransform = triangulation.Triangulation(pointpairs=stostransform.points)
@@ -350,13 +485,38 @@ def TransformStos(transformData, OutputFilename=None, fixedImageFilename=None, w
 
         warpedImageFilename = stos.MappedImageFullPath
 
+    stostransform.points = stostransform.points * scalar
+
+    return (stostransform, fixedImageFilename, warpedImageFilename)
+
+
+def TransformStos(transformData, OutputFilename=None, fixedImageFilename=None, warpedImageFilename=None, scalar=1.0, CropUndefined=False, order=3, Stream=False):
+    '''Assembles an image based on the passed transform.
+    :param bool fixedImageFilename: Image describing the size we want the warped image to fill
+    :param bool warpedImageFilename: Image we will warp into fixed space
+    :param float scalar: Amount to scale the transform before passing the image through
+    :param bool CropUndefined: If true do exclude areas outside the convex hull of the transform, if it exists
+    :param bool Dicreet: True causes points outside the defined transform region to be clipped instead of interpolated
+    :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+    :param bool Stream: Warp the image in tiles written directly to OutputFilename, a .npy file, see TransformStosStreamed for memory limits
+    :return: transformed image
+    '''
+
+    if Stream:
+        return TransformStosStreamed(transformData, OutputFilename, fixedImageFilename=fixedImageFilename, warpedImageFilename=warpedImageFilename,
+                                     scalar=scalar, CropUndefined=CropUndefined, order=order)
+
+    loaded = _LoadStosForWarp(transformData, fixedImageFilename, warpedImageFilename, scalar, CropUndefined)
+    if loaded is None:
+        return None
+
+    (stostransform, fixedImageFilename, warpedImageFilename) = loaded
+
     fixedImageSize = core.GetImageSize(fixedImageFilename)
     fixedImageShape = np.array(fixedImageSize) * scalar
     warpedImage = core.LoadImage(warpedImageFilename)
 
-    stostransform.points = stostransform.points * scalar
-
-    warpedImage = TransformImage(stostransform, fixedImageShape, warpedImage)
+    warpedImage = TransformImage(stostransform, fixedImageShape, warpedImage, order=order)
 
     if not OutputFilename is None:
         imsave(OutputFilename, warpedImage, cmap='gray')
@@ -364,8 +524,133 @@ def TransformStos(transformData, OutputFilename=None, fixedImageFilename=None, w
     return warpedImage
 
 
-def TransformImage(transform, fixedImageShape, warpedImage):
-    '''Cut image into tiles, assemble small chunks'''
+def _ImageAsArrayFile(ImageFullPath, TempDir):
+    '''
+    Image files other than .npy must be decoded completely, so decode the image once into a .npy file tiles can read
+    regions from.  Pixel values match core.LoadImage.  The decoded image, in its stored type, is held in memory while
+    it is converted to the .npy file in bands, so memory use grows with the size of the image.
+    :return: (path to .npy file, True if the file is temporary)
+    '''
+
+    (root, ext) = os.path.splitext(ImageFullPath)
+    if ext == '.npy':
+        return (ImageFullPath, False)
+
+    image = core.ReadImage(ImageFullPath)
+    dtype = core._LoadImageDtype(ImageFullPath)
+    if dtype is None:
+        dtype = image.dtype
+
+    (hFile, TempFullpath) = tempfile.mkstemp(suffix='.npy', dir=TempDir)
+    os.close(hFile)
+
+    ArrayImage = np.lib.format.open_memmap(TempFullpath, mode='w+', dtype=dtype, shape=image.shape)
+    BandHeight = 1024
+    for iY in range(0, image.shape[0], BandHeight):
+        ArrayImage[iY:iY + BandHeight] = core._ConvertImageDtype(image[iY:iY + BandHeight], dtype, ScaleIntegers=True)
+
+    ArrayImage.flush()
+    del ArrayImage
+
+    return (TempFullpath, True)
+
+
+def TransformStosStreamed(transformData, OutputFilename, fixedImageFilename=None, warpedImageFilename=None, scalar=1.0, CropUndefined=False,
+                          order=3, TileSize=None, pool=None, MaxInFlight=None):
+    '''Assembles an image based on the passed transform without holding the output image in memory.  The output is
+       divided into tiles warped by parallel tasks.  Each task reads only the region of the warped image the tile
+       samples and writes the tile directly into the memory mapped output.  For .npy warped images memory use is
+       bounded by the tile size and the number of tiles in flight.  Other image formats cannot be decoded in regions,
+       so they are decoded once, in their stored type, and copied to a temporary .npy file before warping begins.  Peak
+       memory then includes the decoded warped image, usually one or two bytes per pixel.  Convert large warped images
+       to .npy beforehand to avoid this.
+       :param str OutputFilename: .npy file to write the image to
+       :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+       :param tuple TileSize: (Height, Width) of the output tiles, defaults to 2048x2048
+       :param int MaxInFlight: Maximum number of tiles warped concurrently, see completion_queue.DefaultMaxInFlight
+       :return: Read-only memory mapped output image, None if the image filenames are not known
+       '''
+
+    if TileSize is None:
+        TileSize = (2048, 2048)
+
+    loaded = _LoadStosForWarp(transformData, fixedImageFilename, warpedImageFilename, scalar, CropUndefined)
+    if loaded is None:
+        return None
+
+    (stostransform, fixedImageFilename, warpedImageFilename) = loaded
+
+    logger = logging.getLogger(__name__ + '.TransformStosStreamed')
+
+    fixedImageSize = core.GetImageSize(fixedImageFilename)
+    (height, width) = (int(fixedImageSize[0] * scalar), int(fixedImageSize[1] * scalar))
+
+    # Match the dtype TransformStos returns when warping in memory
+    outputImage = np.lib.format.open_memmap(OutputFilename, mode='w+', dtype=core.ComputeDtype, shape=(height, width))
+    del outputImage
+
+    if pool is None:
+        pool = nornir_pools.GetGlobalMultithreadingPool()
+
+    (warpedArrayFilename, IsTemporary) = _ImageAsArrayFile(warpedImageFilename, os.path.dirname(os.path.abspath(OutputFilename)))
+
+    logger.info('Warping %dx%d image in %dx%d tiles' % (height, width, TileSize[0], TileSize[1]))
+
+    try:
+        taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=MaxInFlight)
+
+        for iY in range(0, height, int(TileSize[0])):
+            for iX in range(0, width, int(TileSize[1])):
+                TileBounds = (iY, iX, min(iY + int(TileSize[0]), height), min(iX + int(TileSize[1]), width))
+                taskQueue.add_task("TransformStosTile %d,%d" % (iY, iX), _TransformStosTile, stostransform, warpedArrayFilename,
+                                   TileBounds=TileBounds, OutputFilename=OutputFilename, order=order)
+
+                for t in taskQueue.completed():
+                    t.wait_return()
+
+        for t in taskQueue.as_completed():
+            t.wait_return()
+    finally:
+        if IsTemporary:
+            os.remove(warpedArrayFilename)
+
+    return np.load(OutputFilename, mmap_mode='r')
+
+
+def _TransformStosTile(transform, WarpedImageFullPath, TileBounds, OutputFilename, order=3):
+    '''Warp one tile of TransformStosStreamed and write it into the memory mapped output file
+       :param str WarpedImageFullPath: .npy file containing the warped image
+       :param tuple TileBounds: (MinY, MinX, MaxY, MaxX) of the tile in output pixels'''
+
+    area = (TileBounds[2] - TileBounds[0], TileBounds[3] - TileBounds[1])
+
+    (fixed_coords, warped_coords) = DestinationROI_to_SourceROI(transform, (TileBounds[0], TileBounds[1]), area)
+    (warpedImage, warped_coords) = _LoadImageToFitCoords(WarpedImageFullPath, warped_coords, dtype=core.ComputeDtype, padding=StreamedTilePadding)
+
+    # Filter the padded region here, __WarpedImageUsingCoords would crop the padding away before filtering
+    prefiltered = order > 1
+    if prefiltered:
+        warpedImage = interpolation.spline_filter(warpedImage, order=order, output=np.float32, mode='constant')
+
+    tileImage = __WarpedImageUsingCoords(fixed_coords, warped_coords, area, warpedImage, area, cval=0, order=order, prefiltered=prefiltered)
+
+    del fixed_coords
+    del warped_coords
+    del warpedImage
+
+    outputImage = np.load(OutputFilename, mmap_mode='r+')
+    outputImage[TileBounds[0]:TileBounds[2], TileBounds[1]:TileBounds[3]] = tileImage
+    outputImage.flush()
+    del outputImage
+
+    return TileBounds
+
+
+def TransformImage(transform, fixedImageShape, warpedImage, order=3, prefilter=True):
+    '''Cut image into tiles, assemble small chunks
+    :param int order: Order of the spline interpolation, 0 for nearest neighbor, 1 for linear
+    :param bool prefilter: Spline filter the warped image once and share it with every tile.  Otherwise each tile
+                           filters the region of the warped image it needs.'''
 
     tilesize = [2048, 2048]
 
@@ -380,10 +665,15 @@ def TransformImage(transform, fixedImageShape, warpedImage):
     
     if np.all(grid_shape == np.array([1, 1])):
         # Single threaded
-        return WarpedImageToFixedSpace(transform, fixedImageShape, warpedImage, botleft=np.array([0, 0]), area=fixedImageShape)
+        return WarpedImageToFixedSpace(transform, fixedImageShape, warpedImage, botleft=np.array([0, 0]), area=fixedImageShape, order=order)
     else:
-        outputImage = np.zeros(fixedImageShape, dtype=np.float32)
-        sharedWarpedImage = core.npArrayToReadOnlySharedArray(warpedImage)
+        outputImage = np.zeros((height, width), dtype=core.ComputeDtype)
+        prefiltered = prefilter and order > 1
+        if prefiltered:
+            sharedWarpedImage = _SplineFilteredSharedArray(warpedImage, order)
+        else:
+            sharedWarpedImage = core.npArrayToReadOnlySharedArray(warpedImage)
+            
         mpool = nornir_pools.GetGlobalMultithreadingPool()
         
     
@@ -399,7 +689,7 @@ def TransformImage(transform, fixedImageShape, warpedImage):
                 if end_iX > width:
                     end_iX = width
     
-                task = mpool.add_task(str(iX) + "x_" + str(iY) + "y", WarpedImageToFixedSpace, transform, fixedImageShape, sharedWarpedImage, botleft=[iY, iX], area=[end_iY - iY, end_iX - iX])
+                task = mpool.add_task(str(iX) + "x_" + str(iY) + "y", WarpedImageToFixedSpace, transform, fixedImageShape, sharedWarpedImage, botleft=[iY, iX], area=[end_iY - iY, end_iX - iX], order=order, prefiltered=prefiltered)
                 task.iY = iY
                 task.end_iY = end_iY
                 task.iX = iX
@@ -12,6 +12,7 @@ import tempfile
 import threading
 
 import nornir_imageregistration.assemble  as assemble
+import nornir_imageregistration.completion_queue as completion_queue
 import nornir_imageregistration.core as core
 import nornir_imageregistration.spatial as spatial
 import nornir_imageregistration.tileset as tiles
@@ -27,11 +28,32 @@ import numpy as np
 # import nornir_imageregistration.transforms.triangulation as triangulation
 DistanceImageCache = {}
 
+
+class ZBufferModes(object):
+    '''How the distance of each output pixel from the center of its source tile is calculated for the z-buffer'''
+    
+    DISTANCE_IMAGE = 'distance-image'  # Warp a cached image of center distances alongside every tile
+    ANALYTIC = 'analytic'  # Calculate the center distance directly from the source space coordinates of each pixel
+    
+    Modes = [DISTANCE_IMAGE, ANALYTIC]
+
+DefaultZBufferMode = ZBufferModes.ANALYTIC
+
 # TODO: Use atexit to delete the temporary files
 # TODO: use_memmap does not work when assembling tiles on a cluster, disable for now.  Specific test is IDOCTests.test_AssembleTilesIDoc
 use_memmap = False
 nextNumpyMemMapFilenameIndex = 0
 
+# Memory budget, in bytes, used by TilesToImageChunked when the caller does not specify one
+DefaultMemoryBudget = 2 * 1024 * 1024 * 1024
+
+# Approximate peak bytes used for each output pixel of a chunk: the image and z-buffer, the fixed and warped
+# coordinate arrays, and the interpolated values before conversion to the storage dtype
+ChunkBytesPerPixel = 72
+
+# Approximate peak bytes used for each pixel of a source tile: the loaded image and the spline filtered copy
+TileBytesPerPixel = 12
+
 def GetProcessAndThreadUniqueString():
     '''We use the index because if the same thread makes a new tile of the same size and the original has not been garbage collected yet we get errors'''
     global nextNumpyMemMapFilenameIndex
@@ -216,7 +238,7 @@ def distFunc(i, j):
 def CreateDistanceImage(shape, dtype=None):
 
     if dtype is None:
-        dtype = np.float32
+        dtype = core.ComputeDtype
 
     center = [shape[0] / 2.0, shape[1] / 2.0]
 
@@ -236,30 +258,84 @@ def CreateDistanceImage(shape, dtype=None):
     return distance
 
 
+def CenterDistanceForCoords(coords, shape, dtype=None):
+    '''Distance from the center of an image of the specified shape for each source space coordinate.  Returns the
+       values CreateDistanceImage contains at the same coordinates, so the z-buffer matches the warped distance image.
+       Coordinates falling outside the image are infinite.
+       :param ndarray coords: Nx2 array of (Y,X) coordinates in the source image
+       :param tuple shape: (Height, Width) of the source image
+       :return: Array of N distances
+       :rtype: ndarray'''
+
+    if dtype is None:
+        dtype = core.ComputeDtype
+
+    distance = np.zeros(coords.shape[0], dtype=dtype)
+    for iAxis in range(0, 2):
+        length = float(shape[iAxis])
+        # CreateDistanceImage samples -center to center with linspace, so the last pixel is exactly center pixels away
+        step = length / (length - 1.0) if length > 1 else 0.0
+        axis_distance = (coords[:, iAxis] * step) - (length / 2.0)
+        distance += axis_distance * axis_distance
+
+    distance = np.sqrt(distance)
+
+    outside = np.logical_or(np.any(coords < 0, 1), np.any(coords > np.asarray(shape, dtype=coords.dtype) - 1, 1))
+    distance[outside] = np.inf
+
+    return distance
+
+
+def __CenterDistanceImageUsingCoords(fixed_coords, warped_coords, WarpedImageShape, area, cval):
+    '''Build the z-buffer image for a tile warped using the passed coordinates'''
+
+    area = np.asarray(area, dtype=np.uint64)
+    distance = CenterDistanceForCoords(warped_coords, WarpedImageShape)
+    distance[np.isinf(distance)] = cval
+
+    if fixed_coords.shape[0] == np.prod(area):
+        return distance.reshape(area)
+
+    distanceImage = np.full(area, cval, dtype=distance.dtype)
+    if fixed_coords.shape[0] > 0:
+        fixed_coords_rounded = np.asarray(np.round(fixed_coords), dtype=np.int32)
+        distanceImage[fixed_coords_rounded[:, 0], fixed_coords_rounded[:, 1]] = distance
+
+    return distanceImage
+
+
 def __MaxZBufferValue(dtype):
     return np.finfo(dtype).max
 
 
-def EmptyDistanceBuffer(shape, dtype=np.float16):
+def EmptyDistanceBuffer(shape, dtype=None):
+    
+    if dtype is None:
+        dtype = core.StorageDtype
+        
     fullImageZbuffer = None
     
     if use_memmap:
         full_distance_image_array_path = os.path.join(tempfile.gettempdir(), 'distance_image_%dx%d_%s.npy' % (shape[0], shape[1], GetProcessAndThreadUniqueString()))
-        fullImageZbuffer = np.memmap(full_distance_image_array_path, dtype=np.float16, mode='w+', shape=shape)
+        fullImageZbuffer = np.memmap(full_distance_image_array_path, dtype=dtype, mode='w+', shape=shape)
         fullImageZbuffer[:] = __MaxZBufferValue(dtype)
         fullImageZbuffer.flush()
         del fullImageZbuffer
-        fullImageZbuffer = np.memmap(full_distance_image_array_path, dtype=np.float16, mode='r+', shape=shape)
+        fullImageZbuffer = np.memmap(full_distance_image_array_path, dtype=dtype, mode='r+', shape=shape)
     else:
         fullImageZbuffer = np.full(shape, __MaxZBufferValue(dtype), dtype=dtype)
     
     return fullImageZbuffer
 
-def __CreateOutputBufferForTransforms(transforms, requiredScale=None):
+def __CreateOutputBufferForTransforms(transforms, requiredScale=None, dtype=None):
     '''Create output images using the passed rectangle
     :param tuple rectangle: (minY, minX, maxY, maxX)
+    :param dtype dtype: dtype of the image and z-buffer, defaults to core.StorageDtype
     :return: (fullImage, ZBuffer)
     '''
+    if dtype is None:
+        dtype = core.StorageDtype
+        
     fullImage = None
     (minY, minX, maxY, maxX) = tutils.FixedBoundingBox(transforms).ToTuple()
     fullImage_shape = (int(np.ceil(requiredScale * maxY)), int(np.ceil(requiredScale * maxX)))
@@ -267,25 +343,30 @@ def __CreateOutputBufferForTransforms(transforms, requiredScale=None):
     if use_memmap:
         try:
             fullimage_array_path = os.path.join(tempfile.gettempdir(), 'image_%dx%d_%s.npy' % (fullImage_shape[0], fullImage_shape[1], GetProcessAndThreadUniqueString()))
-            fullImage = np.memmap(fullimage_array_path, dtype=np.float16, mode='w+', shape=fullImage_shape)
+            fullImage = np.memmap(fullimage_array_path, dtype=dtype, mode='w+', shape=fullImage_shape)
             fullImage[:] = 0
             fullImage.flush()
             del fullImage
-            fullImage = np.memmap(fullimage_array_path, dtype=np.float16, mode='r+', shape=fullImage_shape)
+            fullImage = np.memmap(fullimage_array_path, dtype=dtype, mode='r+', shape=fullImage_shape)
         except: 
             prettyoutput.LogErr("Unable to open memory mapped file %s." % (fullimage_array_path))
             raise 
     else:
-        fullImage = np.zeros(fullImage_shape, dtype=np.float16)
+        fullImage = np.zeros(fullImage_shape, dtype=dtype)
 
     fullImageZbuffer = EmptyDistanceBuffer(fullImage.shape, dtype=fullImage.dtype)
     return (fullImage, fullImageZbuffer)
 
 
-def __CreateOutputBufferForArea(Height, Width, requiredScale=None):
+def __CreateOutputBufferForArea(Height, Width, requiredScale=None, dtype=None):
     '''Create output images using the passed width and height
+    :param dtype dtype: dtype of the image and z-buffer, defaults to core.StorageDtype
     '''
     global use_memmap
+    
+    if dtype is None:
+        dtype = core.StorageDtype
+        
     fullImage = None
     fullImage_shape = (int(np.ceil(requiredScale * Height)), int(np.ceil(requiredScale * Width)))
 
@@ -293,13 +374,13 @@ def __CreateOutputBufferForArea(Height, Width, requiredScale=None):
         try:
             fullimage_array_path = os.path.join(tempfile.gettempdir(), 'image_%dx%d_%s.npy' % (fullImage_shape[0], fullImage_shape[1], GetProcessAndThreadUniqueString()))
             # print("Open %s" % (fullimage_array_path))
-            fullImage = np.memmap(fullimage_array_path, dtype=np.float16, mode='w+', shape=fullImage_shape)
+            fullImage = np.memmap(fullimage_array_path, dtype=dtype, mode='w+', shape=fullImage_shape)
             fullImage[:] = 0
         except: 
             prettyoutput.LogErr("Unable to open memory mapped file %s." % (fullimage_array_path))
             raise 
     else:
-        fullImage = np.zeros(fullImage_shape, dtype=np.float16)
+        fullImage = np.zeros(fullImage_shape, dtype=dtype)
 
     fullImageZbuffer = EmptyDistanceBuffer(fullImage.shape, dtype=fullImage.dtype) 
     return (fullImage, fullImageZbuffer)
@@ -350,13 +431,22 @@ def __GetOrCreateDistanceImage(distanceImage, imageShape):
     return __GetOrCreateCachedDistanceImage(imageShape)
 
 
-def TilesToImage(transforms, imagepaths, FixedRegion=None, requiredScale=None):
+def TilesToImage(transforms, imagepaths, FixedRegion=None, requiredScale=None, ZBufferMode=None, StorageDtype=None, WarpMethod=None):
     '''
 
     :param tuple FixedRegion: (MinX, MinY, Width, Height)
+    :param str ZBufferMode: One of ZBufferModes, defaults to DefaultZBufferMode
+    :param dtype StorageDtype: dtype of the output image, defaults to core.StorageDtype
+    :param str WarpMethod: One of assemble.WarpMethods, defaults to assemble.DefaultWarpMethod
 
     '''
 
+    if ZBufferMode is None:
+        ZBufferMode = DefaultZBufferMode
+        
+    if StorageDtype is None:
+        StorageDtype = core.StorageDtype
+
     assert(len(transforms) == len(imagepaths))
 
     # logger = logging.getLogger(__name__ + '.TilesToImage')
@@ -370,9 +460,9 @@ def TilesToImage(transforms, imagepaths, FixedRegion=None, requiredScale=None):
 
     if not FixedRegion is None:
         fixedRect = spatial.Rectangle.CreateFromPointAndArea((FixedRegion[0], FixedRegion[1]), (FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1]))
-        (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1], requiredScale)
+        (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1], requiredScale, dtype=StorageDtype)
     else:
-        (fullImage, fullImageZbuffer) = __CreateOutputBufferForTransforms(transforms, requiredScale)
+        (fullImage, fullImageZbuffer) = __CreateOutputBufferForTransforms(transforms, requiredScale, dtype=StorageDtype)
 
     minY = 0
     minX = 0
@@ -387,9 +477,10 @@ def TilesToImage(transforms, imagepaths, FixedRegion=None, requiredScale=None):
 
         imagefullpath = imagepaths[i]
         
-        distanceImage = __GetOrCreateDistanceImage(distanceImage, core.GetImageSize(imagefullpath))
+        if ZBufferMode == ZBufferModes.DISTANCE_IMAGE:
+            distanceImage = __GetOrCreateDistanceImage(distanceImage, core.GetImageSize(imagefullpath))
 
-        transformedImageData = TransformTile(transform, imagefullpath, distanceImage, requiredScale=requiredScale, FixedRegion=FixedRegion)
+        transformedImageData = TransformTile(transform, imagefullpath, distanceImage, requiredScale=requiredScale, FixedRegion=FixedRegion, ZBufferMode=ZBufferMode, StorageDtype=StorageDtype, WarpMethod=WarpMethod)
 
         if fixedRect is None:
             (minY, minX, maxY, maxX) = transformedImageData.transform.FixedBoundingBox.ToTuple()
@@ -412,10 +503,17 @@ def TilesToImage(transforms, imagepaths, FixedRegion=None, requiredScale=None):
     return (fullImage, mask)
 
 
-def TilesToImageParallel(transforms, imagepaths, FixedRegion=None, requiredScale=None, pool=None):
-    '''Assembles a set of transforms and imagepaths to a single image using parallel techniques'''
+def TilesToImageParallel(transforms, imagepaths, FixedRegion=None, requiredScale=None, pool=None, MaxInFlight=None, ZBufferMode=None, StorageDtype=None, WarpMethod=None):
+    '''Assembles a set of transforms and imagepaths to a single image using parallel techniques
+       :param int MaxInFlight: Maximum number of tiles warped concurrently, see completion_queue.DefaultMaxInFlight
+       :param str ZBufferMode: One of ZBufferModes, defaults to DefaultZBufferMode
+       :param dtype StorageDtype: dtype of the output image, defaults to core.StorageDtype
+       :param str WarpMethod: One of assemble.WarpMethods, defaults to assemble.DefaultWarpMethod'''
 
     assert(len(transforms) == len(imagepaths))
+    
+    if StorageDtype is None:
+        StorageDtype = core.StorageDtype
 
     logger = logging.getLogger('TilesToImageParallel')
 
@@ -428,17 +526,17 @@ def TilesToImageParallel(transforms, imagepaths, FixedRegion=None, requiredScale
         
     # pool = nornir_pools.GetGlobalSerialPool()
 
-    tasks = []
     fixedRect = None
     fullImage = None
 
     if not FixedRegion is None:
         fixedRect = spatial.Rectangle.CreateFromPointAndArea((FixedRegion[0], FixedRegion[1]), (FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1]))
-        (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1], requiredScale)
+        (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(FixedRegion[2] - FixedRegion[0], FixedRegion[3] - FixedRegion[1], requiredScale, dtype=StorageDtype)
     else:
-        (fullImage, fullImageZbuffer) = __CreateOutputBufferForTransforms(transforms, requiredScale)
+        (fullImage, fullImageZbuffer) = __CreateOutputBufferForTransforms(transforms, requiredScale, dtype=StorageDtype)
 
-    CheckTaskInterval = 16
+    # Tiles are composited as soon as they finish.  Bounding the tasks in flight limits the warped tiles held in memory
+    taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=MaxInFlight)
 
     for i, transform in enumerate(transforms):
 
@@ -450,46 +548,21 @@ def TilesToImageParallel(transforms, imagepaths, FixedRegion=None, requiredScale
 
         imagefullpath = imagepaths[i]
 
-        task = pool.add_task("TransformTile" + imagefullpath, TransformTile, transform=transform, imagefullpath=imagefullpath, distanceImage=None, requiredScale=requiredScale, FixedRegion=FixedRegion)
+        task = taskQueue.add_task("TransformTile" + imagefullpath, TransformTile, transform=transform, imagefullpath=imagefullpath, distanceImage=None, requiredScale=requiredScale, FixedRegion=FixedRegion, ZBufferMode=ZBufferMode, StorageDtype=StorageDtype, WarpMethod=WarpMethod)
         task.transform = transform
-        tasks.append(task)
 
-        if not i % CheckTaskInterval == 0:
-            continue
-        
-        if len(tasks) > multiprocessing.cpu_count():
-            iTask = len(tasks) - 1
-            while iTask >= 0:
-                t = tasks[iTask]
-                if t.iscompleted:
-                    transformedImageData = t.wait_return()
-                    __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZbuffer, FixedRegion)
-                    del transformedImageData 
-                    del tasks[iTask]
-                
-                iTask -= 1
+        for t in taskQueue.completed():
+            transformedImageData = t.wait_return()
+            __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZbuffer, FixedRegion)
+            del transformedImageData
 
     logger.info('All warps queued, integrating results into final image')
 
-    while len(tasks) > 0:
-        t = tasks.pop(0)
-        transformedImageData = t.wait_return()     
+    for t in taskQueue.as_completed():
+        transformedImageData = t.wait_return()
         __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZbuffer, FixedRegion)
         del transformedImageData
-        del t
-        
-        # Pass through the entire loop and eliminate completed tasks in case any finished out of order
-        iTask = len(tasks) - 1
-        while iTask >= 0:
-            t = tasks[iTask]
-            if t.iscompleted:
-                transformedImageData = t.wait_return()
-                __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZbuffer, FixedRegion)
-                del transformedImageData 
-                del tasks[iTask]
-            
-            iTask -= 1
-            
+
     logger.info('Final image complete, building mask')
 
     mask = fullImageZbuffer < __MaxZBufferValue(fullImageZbuffer.dtype)
@@ -508,6 +581,148 @@ def TilesToImageParallel(transforms, imagepaths, FixedRegion=None, requiredScale
     return (fullImage, mask)
 
 
+def EstimateChunkMemory(ChunkSize, TileShape):
+    '''
+    :param int ChunkSize: Width and height of a square output chunk
+    :param tuple TileShape: (Height, Width) of the largest source tile
+    :return: Approximate peak bytes needed to assemble one chunk
+    '''
+    return (ChunkSize * ChunkSize * ChunkBytesPerPixel) + (np.prod(TileShape) * TileBytesPerPixel)
+
+
+def ChunkSizeForMemoryBudget(MemoryBudget, TileShape, NumChunksInFlight=None, MinChunkSize=256):
+    '''
+    :param int MemoryBudget: Bytes available for assembly
+    :param tuple TileShape: (Height, Width) of the largest source tile
+    :param int NumChunksInFlight: Number of chunks assembled concurrently, defaults to the number of cores
+    :param int MinChunkSize: Smallest chunk returned, chunk sizes are a multiple of this value
+    :return: Largest chunk size which allows NumChunksInFlight chunks to fit in the memory budget
+    :rtype: int
+    '''
+
+    if NumChunksInFlight is None:
+        NumChunksInFlight = multiprocessing.cpu_count()
+
+    ChunkBudget = (MemoryBudget / float(NumChunksInFlight)) - (np.prod(TileShape) * TileBytesPerPixel)
+    if ChunkBudget <= 0:
+        return MinChunkSize
+
+    ChunkSize = int(np.sqrt(ChunkBudget / ChunkBytesPerPixel) // MinChunkSize) * MinChunkSize
+    return max(ChunkSize, MinChunkSize)
+
+
+def TilesToImageChunked(transforms, imagepaths, OutputImageFullPath, OutputMaskFullPath=None, ChunkSize=None, MemoryBudget=None, requiredScale=None, pool=None, ZBufferMode=None, StorageDtype=None, WarpMethod=None):
+    '''Assembles a set of transforms and imagepaths into .npy files on disk without holding the full image in memory.
+       The output is divided into square chunks.  Each chunk is assembled by a separate task from only the tiles
+       intersecting it and written directly into the memory mapped output.  The number of chunks assembled at once
+       is limited so the estimated memory use stays within MemoryBudget.
+       :param str OutputImageFullPath: .npy file to write the image to
+       :param str OutputMaskFullPath: .npy file to write the boolean mask to.  Defaults to OutputImageFullPath with a _mask suffix
+       :param int ChunkSize: Width and height of each chunk in output pixels.  Calculated from MemoryBudget if not specified
+       :param int MemoryBudget: Bytes available for assembly, defaults to DefaultMemoryBudget
+       :param str ZBufferMode: One of ZBufferModes, defaults to DefaultZBufferMode
+       :param dtype StorageDtype: dtype of the output image, defaults to core.StorageDtype
+       :param str WarpMethod: One of assemble.WarpMethods, defaults to assemble.DefaultWarpMethod
+       :return: (image, mask) as read-only memory mapped arrays
+       '''
+
+    assert(len(transforms) == len(imagepaths))
+
+    logger = logging.getLogger('TilesToImageChunked')
+    
+    if StorageDtype is None:
+        StorageDtype = core.StorageDtype
+
+    if requiredScale is None:
+        requiredScale = tiles.MostCommonScalar(transforms, imagepaths)
+
+    if MemoryBudget is None:
+        MemoryBudget = DefaultMemoryBudget
+
+    if OutputMaskFullPath is None:
+        (root, ext) = os.path.splitext(OutputImageFullPath)
+        OutputMaskFullPath = root + '_mask.npy'
+
+    if pool is None:
+        pool = nornir_pools.GetGlobalMultithreadingPool()
+
+    TileShape = core.GetImageSize(imagepaths[0])
+    if ChunkSize is None:
+        ChunkSize = ChunkSizeForMemoryBudget(MemoryBudget, TileShape)
+
+    MaxInFlight = int(max(1, min(multiprocessing.cpu_count(), MemoryBudget // EstimateChunkMemory(ChunkSize, TileShape))))
+
+    (minY, minX, maxY, maxX) = tutils.FixedBoundingBox(transforms).ToTuple()
+    fullImage_shape = (int(np.ceil(requiredScale * maxY)), int(np.ceil(requiredScale * maxX)))
+
+    fullImage = np.lib.format.open_memmap(OutputImageFullPath, mode='w+', dtype=StorageDtype, shape=fullImage_shape)
+    fullMask = np.lib.format.open_memmap(OutputMaskFullPath, mode='w+', dtype=np.bool_, shape=fullImage_shape)
+    del fullImage
+    del fullMask
+
+    tileRects = spatial.RectangleSet.Create([t.FixedBoundingBox for t in transforms])
+
+    logger.info('Assembling %dx%d image in %d pixel chunks, %d chunks at a time' % (fullImage_shape[0], fullImage_shape[1], ChunkSize, MaxInFlight))
+
+    taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=MaxInFlight)
+
+    for ChunkMinY in range(0, fullImage_shape[0], ChunkSize):
+        for ChunkMinX in range(0, fullImage_shape[1], ChunkSize):
+            ChunkBounds = (ChunkMinY, ChunkMinX, min(ChunkMinY + ChunkSize, fullImage_shape[0]), min(ChunkMinX + ChunkSize, fullImage_shape[1]))
+            FixedRegion = np.array(ChunkBounds, dtype=np.float64) / requiredScale
+
+            iTiles = tileRects.Intersect(FixedRegion)
+            if len(iTiles) == 0:
+                continue
+
+            taskQueue.add_task("AssembleChunk %d,%d" % (ChunkMinY, ChunkMinX), _AssembleChunk,
+                               [transforms[i] for i in iTiles],
+                               [imagepaths[i] for i in iTiles],
+                               ChunkBounds=ChunkBounds,
+                               FixedRegion=FixedRegion,
+                               OutputImageFullPath=OutputImageFullPath,
+                               OutputMaskFullPath=OutputMaskFullPath,
+                               requiredScale=requiredScale,
+                               ZBufferMode=ZBufferMode,
+                               StorageDtype=StorageDtype,
+                               WarpMethod=WarpMethod)
+
+            for t in taskQueue.completed():
+                t.wait_return()
+
+    for t in taskQueue.as_completed():
+        t.wait_return()
+
+    logger.info('Assemble complete')
+
+    return (np.load(OutputImageFullPath, mmap_mode='r'), np.load(OutputMaskFullPath, mmap_mode='r'))
+
+
+def _AssembleChunk(transforms, imagepaths, ChunkBounds, FixedRegion, OutputImageFullPath, OutputMaskFullPath, requiredScale, ZBufferMode=None, StorageDtype=None, WarpMethod=None):
+    '''Assemble one chunk of TilesToImageChunked and write it into the memory mapped output files
+       :param tuple ChunkBounds: (MinY, MinX, MaxY, MaxX) of the chunk in output pixels
+       :param ndarray FixedRegion: ChunkBounds in the fixed space of the transforms'''
+
+    (chunkImage, chunkMask) = TilesToImage(transforms, imagepaths, FixedRegion=FixedRegion, requiredScale=requiredScale, ZBufferMode=ZBufferMode, StorageDtype=StorageDtype, WarpMethod=WarpMethod)
+
+    # Scaling the region into and out of fixed space can round up to an extra row or column
+    (Height, Width) = (ChunkBounds[2] - ChunkBounds[0], ChunkBounds[3] - ChunkBounds[1])
+    chunkImage = chunkImage[:Height, :Width]
+    chunkMask = chunkMask[:Height, :Width]
+
+    fullImage = np.load(OutputImageFullPath, mmap_mode='r+')
+    fullImage[ChunkBounds[0]:ChunkBounds[2], ChunkBounds[1]:ChunkBounds[3]] = chunkImage
+    fullImage.flush()
+    del fullImage
+
+    fullMask = np.load(OutputMaskFullPath, mmap_mode='r+')
+    fullMask[ChunkBounds[0]:ChunkBounds[2], ChunkBounds[1]:ChunkBounds[3]] = chunkMask
+    fullMask.flush()
+    del fullMask
+
+    return ChunkBounds
+
+
 def __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZBuffer, FixedRegion=None):
     
     if transformedImageData is None:
@@ -540,7 +755,7 @@ def __AddTransformedTileToComposite(transformedImageData, fullImage, fullImageZB
     transformedImageData.Clear()
 
 
-def TransformTile(transform, imagefullpath, distanceImage=None, requiredScale=None, FixedRegion=None):
+def TransformTile(transform, imagefullpath, distanceImage=None, requiredScale=None, FixedRegion=None, ZBufferMode=None, StorageDtype=None, WarpMethod=None):
     '''Transform the passed image.  DistanceImage is an existing image recording the distance to the center of the
        image for each pixel.  requiredScale is used when the image size does not match the image size encoded in the
        transform.  A scale will be calculated in this case and if it does not match the required scale the tile will 
@@ -550,7 +765,16 @@ def TransformTile(transform, imagefullpath, distanceImage=None, requiredScale=No
        :param ndarray distanceImage: Optional pre-allocated array to contain the distance of each pixel from the center for use as a depth mask
        :param float requiredScale: Optional pre-calculated scalar to apply to the transform.  If None the scale is calculated based on the difference
                                    between input image size and the image size of the transform
-       :param array FixedRegion: [MinY MinX MaxY MaxX] If specified only the specified region is transformed.  Otherwise transform the entire image.'''
+       :param array FixedRegion: [MinY MinX MaxY MaxX] If specified only the specified region is transformed.  Otherwise transform the entire image.
+       :param str ZBufferMode: One of ZBufferModes, defaults to DefaultZBufferMode.  distanceImage is ignored by the analytic mode.
+       :param dtype StorageDtype: dtype of the returned image and z-buffer, defaults to core.StorageDtype
+       :param str WarpMethod: One of assemble.WarpMethods, defaults to assemble.DefaultWarpMethod'''
+
+    if ZBufferMode is None:
+        ZBufferMode = DefaultZBufferMode
+        
+    if StorageDtype is None:
+        StorageDtype = core.StorageDtype
 
     if not FixedRegion is None:
         spatial.RaiseValueErrorOnInvalidBounds(FixedRegion)
@@ -564,12 +788,11 @@ def TransformTile(transform, imagefullpath, distanceImage=None, requiredScale=No
     # Don't bother mapping points falling outside the defined boundaries because we won't have image data for it
     #   transform = triangulation.Triangulation(transform.points)
 
-    warpedImage = core.LoadImage(imagefullpath)
-    if warpedImage is None:
-        raise IOError("Unable to load image: %s" % (imagefullpath))
+    # The image is decoded after the coordinates are known, so only the header is read here
+    warpedImageShape = core.GetImageSize(imagefullpath)
 
     # Automatically scale the transform if the input image shape does not match the transform bounds
-    transformScale = tiles.__DetermineTransformScale(transform, warpedImage.shape)
+    transformScale = tiles.__DetermineTransformScale(transform, warpedImageShape)
 
     if not requiredScale is None:
         if not core.ApproxEqual(transformScale, requiredScale):
@@ -600,19 +823,32 @@ def TransformTile(transform, imagefullpath, distanceImage=None, requiredScale=No
     height = np.ceil(height)
     width = np.ceil(width)
 
-    distanceImage = __GetOrCreateDistanceImage(distanceImage, warpedImage.shape)
+    if ZBufferMode == ZBufferModes.ANALYTIC:
+        (fixed_coords, warped_coords) = assemble.DestinationROI_to_SourceROI(transform, (minY, minX), (height, width), WarpMethod=WarpMethod)
+        centerDistanceImage = __CenterDistanceImageUsingCoords(fixed_coords, warped_coords, warpedImageShape, (height, width), cval=__MaxZBufferValue(StorageDtype))
+        
+        # Decode only the part of the tile the coordinates sample
+        (warpedImage, warped_coords) = assemble._LoadImageToFitCoords(imagefullpath, warped_coords, dtype=core.ComputeDtype)
+        fixedImage = assemble.__WarpedImageUsingCoords(fixed_coords, warped_coords, (height, width), warpedImage, (height, width), cval=0)
 
-    (fixedImage, centerDistanceImage) = assemble.WarpedImageToFixedSpace(transform,
-                                                                         (height, width),
-                                                                         [warpedImage, distanceImage],
-                                                                         botleft=(minY, minX),
-                                                                         area=(height, width),
-                                                                         cval=[0, __MaxZBufferValue(np.float16)])
+        del fixed_coords
+        del warped_coords
+    else:
+        warpedImage = core.ReadImage(imagefullpath, dtype=core.ComputeDtype)
+        distanceImage = __GetOrCreateDistanceImage(distanceImage, warpedImage.shape)
+    
+        (fixedImage, centerDistanceImage) = assemble.WarpedImageToFixedSpace(transform,
+                                                                             (height, width),
+                                                                             [warpedImage, distanceImage],
+                                                                             botleft=(minY, minX),
+                                                                             area=(height, width),
+                                                                             cval=[0, __MaxZBufferValue(StorageDtype)],
+                                                                             WarpMethod=WarpMethod)
+        del distanceImage
 
     del warpedImage
-    del distanceImage
 
-    return TransformedImageData.Create(fixedImage.astype(np.float16), centerDistanceImage.astype(np.float16), transform, transformScale)
+    return TransformedImageData.Create(fixedImage.astype(StorageDtype, copy=False), centerDistanceImage.astype(StorageDtype, copy=False), transform, transformScale)
 
 if __name__ == '__main__':
     pass
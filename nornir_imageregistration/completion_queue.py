@@ -0,0 +1,143 @@
+'''
+Collect the results of nornir_pools tasks in the order they finish instead of polling a task list.
+
+A waiting thread is started for each task in flight.  When a task finishes its result is placed in a queue the caller
+consumes.  The number of tasks in flight is bounded, add_task blocks until a running task finishes when the limit
+is reached.  This bounds the memory consumed by queued task parameters.  Finished results wait in an unbounded queue
+until they are consumed, so callers should consume completed tasks between calls to add_task, as below, to bound the
+memory held by results.
+
+Typical use::
+
+    taskQueue = CompletionQueue(pool)
+    for item in work:
+        taskQueue.add_task(name, func, item)
+
+        for task in taskQueue.completed():
+            Consume(task.wait_return())
+
+    for task in taskQueue.as_completed():
+        Consume(task.wait_return())
+'''
+
+import multiprocessing
+import threading
+
+from six.moves import queue
+
+
+def DefaultMaxInFlight():
+    '''Enough tasks to keep every core busy while results are consumed'''
+    return multiprocessing.cpu_count() * 2
+
+
+class CompletedTask(object):
+    '''
+    A finished pool task.  wait_return does not block, it returns the task's value or raises the exception the task raised.
+    Any other attributes, such as those added by the caller after add_task, are read from the original task.
+    '''
+
+    @property
+    def task(self):
+        return self._task
+
+    def wait_return(self):
+        if not self._exception is None:
+            raise self._exception
+
+        return self._value
+
+    def __init__(self, task, value=None, exception=None):
+        self._task = task
+        self._value = value
+        self._exception = exception
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self._task, name)
+
+
+class CompletionQueue(object):
+    '''
+    Submits tasks to a pool and returns them in the order they complete
+    '''
+
+    @property
+    def outstanding(self):
+        '''Number of tasks submitted which have not been returned by completed or as_completed'''
+        return self._outstanding
+
+    @property
+    def max_in_flight(self):
+        return self._max_in_flight
+
+    def __init__(self, pool, MaxInFlight=None):
+        '''
+        :param pool: nornir_pools pool tasks are added to
+        :param int MaxInFlight: Maximum number of unfinished tasks.  Finished tasks waiting to be consumed are not counted.  Defaults to DefaultMaxInFlight()
+        '''
+
+        if MaxInFlight is None:
+            MaxInFlight = DefaultMaxInFlight()
+
+        if MaxInFlight < 1:
+            raise ValueError("MaxInFlight must be at least one")
+
+        self._pool = pool
+        self._max_in_flight = MaxInFlight
+        self._slots = threading.BoundedSemaphore(MaxInFlight)
+        self._completed = queue.Queue()
+        self._outstanding = 0
+
+    def add_task(self, name, func, *args, **kwargs):
+        '''Add a task to the pool.  Blocks if MaxInFlight tasks are unfinished.
+        :return: The pool's task object'''
+
+        self._slots.acquire()
+
+        try:
+            task = self._pool.add_task(name, func, *args, **kwargs)
+        except:
+            self._slots.release()
+            raise
+
+        self._outstanding += 1
+
+        waiter = threading.Thread(target=self._WaitForTask, args=(task,), name="Wait for " + str(name))
+        waiter.daemon = True
+        waiter.start()
+
+        return task
+
+    def _WaitForTask(self, task):
+        try:
+            completed = CompletedTask(task, value=task.wait_return())
+        except Exception as e:
+            completed = CompletedTask(task, exception=e)
+
+        self._slots.release()
+        self._completed.put(completed)
+
+    def completed(self):
+        '''Yield the tasks which have already finished, does not block
+        :rtype: CompletedTask'''
+
+        while self._outstanding > 0:
+            try:
+                task = self._completed.get_nowait()
+            except queue.Empty:
+                return
+
+            self._outstanding -= 1
+            yield task
+
+    def as_completed(self):
+        '''Yield every outstanding task as soon as it finishes
+        :rtype: CompletedTask'''
+
+        while self._outstanding > 0:
+            task = self._completed.get()
+            self._outstanding -= 1
+            yield task
@@ -0,0 +1,312 @@
+'''
+Cache of the coordinate maps used to warp image regions.
+
+A coordinate map records where a transform maps each pixel of a rectangular region.  Building one passes every pixel
+of the region through the transform, which dominates the cost of warping a tile.  Assembling the same transforms again,
+for another channel, contrast or overlapping region, reuses the maps.
+
+A map is stored as a boolean image of the region, True where the transform maps the pixel, and the mapped coordinates
+of the valid pixels in row-major order.  Maps are keyed by a checksum of the transform's type and control points, the
+direction of the mapping, the region, whether points are extrapolated, and the tolerance of interpolated maps.  Scaled
+transforms have scaled control points, so the scale is part of the checksum.
+
+Recently used maps are kept in memory up to MaxCachedBytes.  If a cache directory is set maps are also saved there as
+.npy files and memory mapped when loaded, so worker processes and later runs share them.  The directory is trimmed to
+MaxCacheDirectoryBytes by deleting the least recently used maps.  Each process trims it when it first saves a map and
+again after saving an eighth of the limit, so the directory can briefly exceed the limit while several processes save.
+'''
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+CacheDirectoryEnvironmentVariable = 'NORNIR_COORDINATE_MAP_CACHE'
+
+# Bytes of coordinate maps each process keeps in memory.  Set to zero to disable the in-memory cache.
+MaxCachedBytes = 128 * 1024 * 1024
+
+# Bytes of coordinate maps kept in the cache directory
+MaxCacheDirectoryBytes = 4 * 1024 * 1024 * 1024
+
+_CacheDirectory = None
+
+
+def SetCacheDirectory(path):
+    '''Save coordinate maps to the directory for use by this process, worker processes started after the call, and later runs.
+       Pass None to stop using a directory.'''
+    global _CacheDirectory
+
+    _CacheDirectory = path
+    if path is None:
+        os.environ.pop(CacheDirectoryEnvironmentVariable, None)
+    else:
+        os.makedirs(path, exist_ok=True)
+        os.environ[CacheDirectoryEnvironmentVariable] = path
+
+
+def GetCacheDirectory():
+    '''
+    :return: Directory coordinate maps are saved to, or None
+    '''
+    if _CacheDirectory is not None:
+        return _CacheDirectory
+
+    return os.environ.get(CacheDirectoryEnvironmentVariable, None)
+
+
+def TransformChecksum(transform):
+    '''
+    :return: Checksum of the transform's type and control points, None if the transform does not have control points
+    :rtype: str
+    '''
+
+    points = getattr(transform, 'points', None)
+    if points is None:
+        return None
+
+    h = hashlib.sha1()
+    h.update(type(transform).__name__.encode('utf-8'))
+    h.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def CoordinateMapKey(transform, botleft, area, inverse, extrapolate, tolerance=None, WarpMethod=None):
+    '''
+    :param transform transform: Transform mapping the region's pixels
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
+    :param 1x2_array area: The (Height, Width) of the region of interest
+    :param bool inverse: True if the pixels are passed through the inverse transform
+    :param bool extrapolate: True if points outside the bounding box of the transform are mapped
+    :param float tolerance: Error tolerance of maps interpolated from a sparse lattice, None for exact maps
+    :param str WarpMethod: The assemble.WarpMethods value that calculates the map
+    :return: Key for the region's coordinate map, None if the transform cannot be checksummed
+    :rtype: str
+    '''
+
+    checksum = TransformChecksum(transform)
+    if checksum is None:
+        return None
+
+    h = hashlib.sha1()
+    h.update(checksum.encode('utf-8'))
+    h.update(np.asarray([botleft[0], botleft[1], area[0], area[1], inverse, extrapolate], dtype=np.float64).tobytes())
+    if tolerance is not None:
+        h.update(np.asarray([tolerance], dtype=np.float64).tobytes())
+    if WarpMethod is not None:
+        h.update(WarpMethod.encode('utf-8'))
+    return h.hexdigest()
+
+
+class CoordinateMapCache(object):
+    '''
+    Thread safe least recently used cache of coordinate maps, optionally backed by a directory of memory mapped files
+    '''
+
+    def __init__(self, MaxBytes=None, CacheDirectory=None, MaxDirectoryBytes=None):
+        '''
+        :param int MaxBytes: Bytes of maps kept in memory, defaults to the module's MaxCachedBytes
+        :param str CacheDirectory: Directory maps are saved to, defaults to GetCacheDirectory()
+        :param int MaxDirectoryBytes: Bytes of maps kept in the cache directory, defaults to the module's MaxCacheDirectoryBytes
+        '''
+        self._MaxBytes = MaxBytes
+        self._CacheDirectory = CacheDirectory
+        self._MaxDirectoryBytes = MaxDirectoryBytes
+        self._lock = threading.Lock()
+        self._maps = collections.OrderedDict()
+        self._nbytes = 0
+        self._SavedSinceTrim = None
+
+    @property
+    def MaxBytes(self):
+        if self._MaxBytes is None:
+            return MaxCachedBytes
+
+        return self._MaxBytes
+
+    @property
+    def CacheDirectory(self):
+        if self._CacheDirectory is None:
+            return GetCacheDirectory()
+
+        return self._CacheDirectory
+
+    @property
+    def MaxDirectoryBytes(self):
+        if self._MaxDirectoryBytes is None:
+            return MaxCacheDirectoryBytes
+
+        return self._MaxDirectoryBytes
+
+    @property
+    def Enabled(self):
+        return self.MaxBytes > 0 or self.CacheDirectory is not None
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._maps)
+
+    def Clear(self):
+        with self._lock:
+            self._maps.clear()
+            self._nbytes = 0
+
+    def Get(self, key):
+        '''
+        :return: (ValidMask, MappedCoords) or None if the map is not cached.  The arrays are read-only.
+        '''
+
+        with self._lock:
+            entry = self._maps.get(key, None)
+            if entry is not None:
+                self._maps.move_to_end(key)
+                return entry
+
+        entry = self._Load(key)
+        if entry is not None:
+            self._Remember(key, entry)
+
+        return entry
+
+    def Add(self, key, ValidMask, MappedCoords):
+        '''
+        Cache a coordinate map.  The arrays are made read-only.
+        '''
+
+        ValidMask.flags.writeable = False
+        MappedCoords.flags.writeable = False
+
+        entry = (ValidMask, MappedCoords)
+        self._Remember(key, entry)
+        self._Save(key, entry)
+
+    def _Remember(self, key, entry):
+        nbytes = entry[0].nbytes + entry[1].nbytes
+        if nbytes > self.MaxBytes:
+            return
+
+        with self._lock:
+            if key in self._maps:
+                return
+
+            self._maps[key] = entry
+            self._nbytes += nbytes
+
+            while self._nbytes > self.MaxBytes:
+                (oldKey, oldEntry) = self._maps.popitem(last=False)
+                self._nbytes -= oldEntry[0].nbytes + oldEntry[1].nbytes
+
+    def _Paths(self, key):
+        CacheDirectory = self.CacheDirectory
+        return (os.path.join(CacheDirectory, key + '_mask.npy'), os.path.join(CacheDirectory, key + '_coords.npy'))
+
+    def _Load(self, key):
+        if self.CacheDirectory is None:
+            return None
+
+        (MaskPath, CoordsPath) = self._Paths(key)
+
+        # The mask is written last, so the coordinates are complete if it exists
+        if not os.path.exists(MaskPath):
+            return None
+
+        try:
+            entry = (np.load(MaskPath, mmap_mode='r'), np.load(CoordsPath, mmap_mode='r'))
+        except (IOError, ValueError):
+            logging.getLogger(__name__).warning('Ignoring unreadable coordinate map: ' + CoordsPath)
+            return None
+
+        # Mark the map as recently used so it is the last to be trimmed
+        try:
+            os.utime(MaskPath)
+        except OSError:
+            pass
+
+        return entry
+
+    def _Save(self, key, entry):
+        if self.CacheDirectory is None:
+            return
+
+        for (path, array) in zip(reversed(self._Paths(key)), reversed(entry)):
+            TempPath = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+            try:
+                np.save(TempPath, array)
+                os.replace(TempPath + '.npy', path)
+            except (IOError, OSError):
+                logging.getLogger(__name__).info('Unable to save coordinate map: ' + path)
+                if os.path.exists(TempPath + '.npy'):
+                    os.remove(TempPath + '.npy')
+                return
+
+        with self._lock:
+            if self._SavedSinceTrim is not None:
+                self._SavedSinceTrim += entry[0].nbytes + entry[1].nbytes
+                if self._SavedSinceTrim < self.MaxDirectoryBytes // 8:
+                    return
+
+            self._SavedSinceTrim = 0
+
+        TrimCacheDirectory(self.CacheDirectory, self.MaxDirectoryBytes)
+
+
+def TrimCacheDirectory(CacheDirectory, MaxBytes=None):
+    '''
+    Delete the least recently used coordinate maps until the maps in the directory use at most MaxBytes
+    :param int MaxBytes: Defaults to the module's MaxCacheDirectoryBytes
+    '''
+
+    if MaxBytes is None:
+        MaxBytes = MaxCacheDirectoryBytes
+
+    try:
+        filenames = os.listdir(CacheDirectory)
+    except OSError:
+        return
+
+    # The mask's modification time records the last use.  Coordinates without a mask, left by an interrupted save,
+    # use their own modification time.
+    Suffixes = ('_mask.npy', '_coords.npy')
+    LastUse = {}
+    Bytes = collections.defaultdict(int)
+    for filename in filenames:
+        for suffix in Suffixes:
+            if not filename.endswith(suffix):
+                continue
+
+            key = filename[:-len(suffix)]
+            try:
+                FileStat = os.stat(os.path.join(CacheDirectory, filename))
+            except OSError:
+                continue
+
+            Bytes[key] += FileStat.st_size
+            if suffix == Suffixes[0] or key not in LastUse:
+                LastUse[key] = FileStat.st_mtime
+
+    TotalBytes = sum(Bytes.values())
+    for key in sorted(LastUse.keys(), key=LastUse.get):
+        if TotalBytes <= MaxBytes:
+            break
+
+        # The mask is removed first so readers do not load a map without coordinates
+        try:
+            for suffix in Suffixes:
+                path = os.path.join(CacheDirectory, key + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+        except OSError:
+            # Another process removed the map, or has it open on a platform that prevents deletion
+            continue
+
+        TotalBytes -= Bytes[key]
+
+
+# Cache used by assemble
+DefaultCache = CoordinateMapCache()
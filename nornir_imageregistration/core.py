@@ -14,6 +14,8 @@ import tempfile
 from PIL import Image
 import nornir_imageregistration
 from nornir_imageregistration.spatial.rectangle import Rectangle
+import nornir_imageregistration.fft_backend as fft_backend
+import nornir_imageregistration.image_size_cache as image_size_cache
 import numpy.fft
 import scipy.misc
 import scipy.ndimage.measurements
@@ -22,12 +24,19 @@ import scipy.stats
 import matplotlib.pyplot as plt
 import nornir_shared.images as shared_images
 import numpy as np
-import numpy.fft.fftpack as fftpack
 import scipy.ndimage.interpolation as interpolation
 
 
 # In a remote process we need errors raised, otherwise we crash for the wrong reason and debugging is tougher. 
 np.seterr(all='raise')
+
+# Floating point type used for image arithmetic such as padding, normalization and registration.  numpy emulates
+# float16 arithmetic in software, which is very slow, and float64 doubles memory use without improving registration.
+ComputeDtype = np.float32
+
+# Floating point type of assembled mosaics and their z-buffers.  Values are calculated using ComputeDtype and converted
+# when stored.  float16 halves the memory of full mosaic assembly, set to np.float32 to keep full precision.
+StorageDtype = np.float16
     
 # from memory_profiler import profile
 
@@ -278,14 +287,14 @@ def ResizeImage(image, scalar):
     
     return scipy.misc.imresize(image, np.array(new_size, dtype=np.int64), interp=interp)
 
-def CropImageRect(imageparam, bounding_rect, cval=None):
-    return CropImage(imageparam, Xo=int(bounding_rect[1]), Yo=int(bounding_rect[0]), Width=int(bounding_rect.Width), Height=int(bounding_rect.Height), cval=cval)
+def CropImageRect(imageparam, bounding_rect, cval=None, copy=False):
+    return CropImage(imageparam, Xo=int(bounding_rect[1]), Yo=int(bounding_rect[0]), Width=int(bounding_rect.Width), Height=int(bounding_rect.Height), cval=cval, copy=copy)
 
-def CropImage(imageparam, Xo, Yo, Width, Height, cval=None):
+def CropImage(imageparam, Xo, Yo, Width, Height, cval=None, copy=False):
     '''
        Crop the image at the passed bounds and returns the cropped ndarray.
        If the requested area is outside the bounds of the array then the correct region is returned
-       with a background color set
+       with a background color set.  If the requested area is inside the array a view of the array is returned.
        
        :param ndarray imageparam: An ndarray image to crop.  A string containing a path to an image is also acceptable.e
        :param int Xo: X origin for crop
@@ -293,6 +302,7 @@ def CropImage(imageparam, Xo, Yo, Width, Height, cval=None):
        :param int Width: New width of image
        :param int Height: New height of image
        :param int cval: default value for regions outside the original image boundaries.  Defaults to 0.  Use 'random' to fill with random noise matching images statistical profile
+       :param bool copy: Return a new array even when the requested area is inside the image.  Use if the cropped image will be modified.
        
        :return: Cropped image
        :rtype: ndarray
@@ -312,6 +322,15 @@ def CropImage(imageparam, Xo, Yo, Width, Height, cval=None):
     assert(isinstance(Width, int))
     assert(isinstance(Height, int))
     
+    if Xo >= 0 and Yo >= 0 and Xo + Width <= image.shape[1] and Yo + Height <= image.shape[0]:
+        Xo = int(Xo)
+        Yo = int(Yo)
+        cropped = image[Yo:Yo + Height, Xo:Xo + Width]
+        if copy:
+            cropped = cropped.copy()
+            
+        return cropped
+    
     image_rectangle = Rectangle([0, 0, image.shape[0], image.shape[1]])
     crop_rectangle = Rectangle.CreateFromPointAndArea([Yo, Xo], [Height, Width])
     
@@ -363,7 +382,7 @@ def CropImage(imageparam, Xo, Yo, Width, Height, cval=None):
         
     # Create output image
     cropped = None
-    if cval is None:
+    if cval is None or (not isinstance(cval, str) and cval == 0):
         cropped = np.zeros((Height, Width), dtype=image.dtype)
     elif cval == 'random':    
         cropped = np.ones((Height, Width), dtype=image.dtype)
@@ -377,6 +396,18 @@ def CropImage(imageparam, Xo, Yo, Width, Height, cval=None):
 
     return cropped
 
+def CropMask(ImageShape, Xo, Yo, Width, Height):
+    '''
+    :param tuple ImageShape: Shape of the image being cropped
+    :return: Boolean image with the shape CropImage returns, True where the cropped region lies within the original image boundaries
+    :rtype: ndarray
+    '''
+    
+    mask = np.zeros((Height, Width), dtype=bool)
+    mask[max(-Yo, 0):max(ImageShape[0] - Yo, 0), max(-Xo, 0):max(ImageShape[1] - Xo, 0)] = True
+    return mask
+    
+
 def npArrayToReadOnlySharedArray(npArray):
     '''Returns a shared memory array for a numpy array.  Used to reduce memory footprint when passing parameters to multiprocess pools'''
     SharedBase = multiprocessing.sharedctypes.RawArray(ctypes.c_float, npArray.shape[0] * npArray.shape[1])
@@ -397,11 +428,19 @@ def CreateTemporaryReadonlyMemmapFile(npArray):
     return memmap_metadata(path=TempFullpath, shape=npArray.shape, dtype=npArray.dtype)
 
 
+def AsComputeDtype(image):
+    '''
+    :return: The image converted to ComputeDtype.  Images already using ComputeDtype are returned without a copy.
+    :rtype: ndarray
+    '''
+    return np.asarray(image, dtype=ComputeDtype)
+
+
 def GenRandomData(height, width, mean, standardDev):
     '''
     Generate random data of shape with the specified mean and standard deviation
     '''
-    image = (np.random.randn(int(height), int(width)).astype(np.float32) * standardDev) + mean
+    image = (np.random.randn(int(height), int(width)).astype(ComputeDtype) * standardDev) + mean
 
     if mean - (standardDev * 2) < 0:
         image = abs(image)
@@ -410,6 +449,7 @@ def GenRandomData(height, width, mean, standardDev):
 
 def GetImageSize(ImageFullPath):
     '''
+    Only the file header is read.  Sizes are cached until the file changes, see image_size_cache.
     :returns: Image (height, width)
     :rtype: tuple
     '''
@@ -417,20 +457,19 @@ def GetImageSize(ImageFullPath):
     # if not os.path.exists(ImageFullPath):
         # raise ValueError("%s does not exist" % (ImageFullPath))
         
-    (root, ext) = os.path.splitext(ImageFullPath)
+    return image_size_cache.GetImageSize(ImageFullPath)
+
+
+def GetImageSizes(ImageFullPaths, pool=None):
+    '''
+    Read the sizes of many images.  Uncached images are read in parallel.
+    :param list ImageFullPaths: Paths to images
+    :param pool: nornir_pools pool used to read the image headers, defaults to the global thread pool
+    :returns: List of image (height, width), None for images that could not be read
+    :rtype: list
+    '''
     
-    image = None
-    try:
-        if ext == '.npy':
-            image = _LoadImageByExtension(ImageFullPath)
-            return image.shape
-        else:
-            image = Image.open(ImageFullPath)
-            return (image.size[1], image.size[0])
-    except IOError:
-        raise IOError("Unable to read size from %s" % (ImageFullPath))
-    finally:
-        del image
+    return image_size_cache.GetImageSizes(ImageFullPaths, pool=pool)
 
 def ForceGrayscale(image):
     '''
@@ -509,18 +548,160 @@ def SaveImage_JPeg2000(ImageFullPath, image, tile_dim=None):
 #     im.save(ImageFullPath, tile_offset=tile_coord, tile_size=tile_dim)
 #     
 
-def _LoadImageByExtension(ImageFullPath, bpp=8):
+def _LoadImageDtype(ImageFullPath):
+    '''LoadImage returns PNG images as float32 from 0 to 1, as matplotlib's imread did.  Other formats keep their stored type.'''
+    
     (root, ext) = os.path.splitext(ImageFullPath)
+    if ext.lower() == '.png':
+        return np.float32
     
-    image = None
-    if ext == '.npy':
-        image = np.load(ImageFullPath, 'c') 
+    return None
+
+
+def _PILImageToArray(im):
+    '''
+    :return: Grayscale ndarray of a PIL image.  The first channel of color images is used.
+    '''
+    
+    if im.mode == 'P':
+        im = im.convert('RGB')
+        
+    return ForceGrayscale(np.asarray(im))
+
+
+def _ClipRegion(Region, shape):
+    '''
+    :return: [MinY MinX MaxY MaxX] integer bounds of the region clipped to an image of the specified shape
+    '''
+    
+    (MinY, MinX, MaxY, MaxX) = Region
+    MinY = min(max(int(np.floor(MinY)), 0), shape[0])
+    MinX = min(max(int(np.floor(MinX)), 0), shape[1])
+    MaxY = min(max(int(np.ceil(MaxY)), MinY), shape[0])
+    MaxX = min(max(int(np.ceil(MaxX)), MinX), shape[1])
+    return (MinY, MinX, MaxY, MaxX)
+
+
+def _BlockMeans(image, factor):
+    '''
+    :return: float64 mean of each factor x factor block of the image.  Blocks on the far edges may be partial, so the
+             output shape is the input shape divided by factor and rounded up.
+    '''
+    
+    RowSums = np.add.reduceat(image, np.arange(0, image.shape[0], factor), axis=0, dtype=np.float64)
+    BlockSums = np.add.reduceat(RowSums, np.arange(0, image.shape[1], factor), axis=1)
+    del RowSums
+    
+    RowCounts = np.minimum(image.shape[0] - np.arange(0, image.shape[0], factor), factor)
+    ColCounts = np.minimum(image.shape[1] - np.arange(0, image.shape[1], factor), factor)
+    BlockSums /= np.outer(RowCounts, ColCounts)
+    return BlockSums
+
+
+def _ConvertImageDtype(image, dtype, ScaleIntegers):
+    '''
+    Convert the image to dtype.  If ScaleIntegers is True integer images converted to floating point are scaled from 0 to 1.
+    '''
+    
+    if dtype is None or image.dtype == dtype:
+        return image
+    
+    dtype = np.dtype(dtype)
+    if ScaleIntegers and np.issubdtype(image.dtype, np.integer) and np.issubdtype(dtype, np.floating):
+        converted = image.astype(dtype)
+        converted /= np.iinfo(image.dtype).max
+        return converted
+    
+    return image.astype(dtype)
+
+
+def ReadImage(ImageFullPath, dtype=None, Scalar=None, Region=None, ScaleIntegers=None):
+    '''
+    Decode an image, keeping its stored type unless another is requested.  Reduced images are decoded at reduced 
+    resolution by JPEG decoders, or reduced by averaging blocks of pixels before any type conversion, so the full
+    resolution image is never converted to floating point.  .npy files are memory mapped, so only the requested 
+    region is read.  Other formats are decoded completely and then cropped.
+    
+    :param str ImageFullPath: Path to image
+    :param dtype dtype: Type of the returned image.  None keeps the stored type, usually uint8 or uint16.
+    :param float Scalar: Resize the image by this amount, which should be less than one.  The image is reduced by the 
+                         largest integer factor the scalar allows and the remaining scale is interpolated.  The shape 
+                         matches ReduceImage(image, Scalar).
+    :param array Region: [MinY MinX MaxY MaxX] in full resolution pixels.  Only this region of the image is returned.  Clipped to the image bounds.
+    :param bool ScaleIntegers: Scale integer images from 0 to 1 when a floating point dtype is requested.  Defaults to the
+                               behavior of LoadImage, which scales PNG images and keeps the stored range of other formats.
+                               .npy files are never scaled.
+    :returns: Grayscale image
+    :rtype: ndimage
+    '''
+    
+    (root, ext) = os.path.splitext(ImageFullPath)
+    IsArray = ext == '.npy'
+    
+    if ScaleIntegers is None:
+        ScaleIntegers = _LoadImageDtype(ImageFullPath) is not None
+    ScaleIntegers = ScaleIntegers and not IsArray
+    
+    if Scalar is not None and Scalar >= 1.0:
+        Scalar = None
+    
+    factor = 1
+    if Scalar is not None:
+        factor = max(int(np.floor((1.0 / Scalar) + 1e-6)), 1)
+    
+    if IsArray:
+        image = np.load(ImageFullPath, mmap_mode='r')
+        if image.ndim > 2:
+            image = ForceGrayscale(image)
+        SourceShape = image.shape
     else:
-        image = plt.imread(ImageFullPath)
-        if bpp == 1:
-            image = image.astype(np.bool)
+        im = Image.open(ImageFullPath)
+        SourceShape = (im.size[1], im.size[0])
+    
+    if Region is not None:
+        (MinY, MinX, MaxY, MaxX) = _ClipRegion(Region, SourceShape)
+        SourceShape = (MaxY - MinY, MaxX - MinX)
+        
+        if IsArray:
+            image = image[MinY:MaxY, MinX:MaxX]
         else:
-            image = ForceGrayscale(image)
+            im = im.crop((MinX, MinY, MaxX, MaxY))
+    elif not IsArray and factor > 1 and im.format == 'JPEG':
+        # The JPEG decoder can reduce by powers of two up to eight while decoding
+        draft_factor = 8
+        while factor % draft_factor != 0:
+            draft_factor //= 2
+        
+        if draft_factor > 1:
+            im.draft(im.mode, (int(np.ceil(SourceShape[1] / float(draft_factor))), int(np.ceil(SourceShape[0] / float(draft_factor)))))
+            draft_factor = int(round(SourceShape[1] / float(im.size[0])))
+            factor = max(factor // draft_factor, 1)
+            
+    if not IsArray:
+        image = _PILImageToArray(im)
+        del im
+    
+    if factor > 1:
+        NativeDtype = image.dtype
+        image = _BlockMeans(image, factor)
+        if dtype is None:
+            if NativeDtype == bool:
+                image = image > 0.5
+            else:
+                image = np.rint(image).astype(NativeDtype)
+        elif np.issubdtype(np.dtype(dtype), np.floating):
+            if ScaleIntegers and np.issubdtype(NativeDtype, np.integer):
+                image /= np.iinfo(NativeDtype).max
+            image = image.astype(dtype)
+        else:
+            image = np.rint(image).astype(dtype)
+    else:
+        image = _ConvertImageDtype(np.array(image), dtype, ScaleIntegers=ScaleIntegers)
+        
+    if Scalar is not None:
+        TargetShape = (int(round(SourceShape[0] * Scalar)), int(round(SourceShape[1] * Scalar)))
+        if TargetShape != image.shape:
+            image = interpolation.zoom(image, (TargetShape[0] / float(image.shape[0]), TargetShape[1] / float(image.shape[1])))
         
     return image
 
@@ -528,7 +709,8 @@ def _LoadImageByExtension(ImageFullPath, bpp=8):
 def LoadImage(ImageFullPath, ImageMaskFullPath=None, MaxDimension=None):
 
     '''
-    Loads an image converts to greyscale, masks it, and removes extrema pixels.
+    Loads an image converts to greyscale, masks it, and removes extrema pixels.  PNG images are returned as float32 
+    from 0 to 1, other formats keep their stored type.  Use ReadImage to choose the type.
     
     :param str ImageFullPath: Path to image
     :param str ImageMaskFullPath: Path to mask, dimension should match input image
@@ -542,34 +724,74 @@ def LoadImage(ImageFullPath, ImageMaskFullPath=None, MaxDimension=None):
         logger.error('File does not exist: ' + ImageFullPath)
         return None
     
-    (root, ext) = os.path.splitext(ImageFullPath)
-    
-    image = _LoadImageByExtension(ImageFullPath) 
-
+    scalar = None
     if not MaxDimension is None:
-        scalar = ScalarForMaxDimension(MaxDimension, image.shape)
-        if scalar < 1.0:
-            image = ReduceImage(image, scalar)
-
-    image_mask = None
+        scalar = ScalarForMaxDimension(MaxDimension, GetImageSize(ImageFullPath))
+    
+    image = ReadImage(ImageFullPath, dtype=_LoadImageDtype(ImageFullPath), Scalar=scalar)
 
     if(not ImageMaskFullPath is None):
-        if(not os.path.isfile(ImageMaskFullPath)):
-            logger = logging.getLogger(__name__)
-            logger.error('Fixed image mask file does not exist: ' + ImageMaskFullPath)
-        else:
-            image_mask = _LoadImageByExtension(ImageMaskFullPath, bpp=1)
-            if not MaxDimension is None:
-                scalar = ScalarForMaxDimension(MaxDimension, image_mask.shape)
-                if scalar < 1.0:
-                    image_mask = ReduceImage(image_mask, scalar)
-
+        image_mask = LoadImageMask(ImageMaskFullPath, MaxDimension=MaxDimension)
+        if not image_mask is None:
             assert((image.shape == image_mask.shape))
             image = RandomNoiseMask(image, image_mask)
 
     return image
 
 
+def LoadImageMask(ImageMaskFullPath, MaxDimension=None, Scalar=None):
+    '''
+    Loads a mask image.  Use with the masked correlation functions instead of LoadImage's noise filling.
+    
+    :param str ImageMaskFullPath: Path to mask
+    :param MaxDimension: Limit the largest dimension of the returned mask to this size.  Downsample if necessary.
+    :param float Scalar: Resize the mask by this amount, see ReadImage.  Ignored if MaxDimension is specified.
+    :returns: Boolean image, True for nonzero mask pixels.  Reduced pixels are True if the majority of the pixels they were reduced from are True.  None if the mask does not exist.
+    :rtype: ndimage
+    '''
+    
+    if(not os.path.isfile(ImageMaskFullPath)):
+        logger = logging.getLogger(__name__)
+        logger.error('Image mask file does not exist: ' + ImageMaskFullPath)
+        return None
+    
+    if not MaxDimension is None:
+        Scalar = ScalarForMaxDimension(MaxDimension, GetImageSize(ImageMaskFullPath))
+        
+    if Scalar is None or Scalar >= 1.0:
+        return ReadImage(ImageMaskFullPath) != 0
+    
+    return ReadImage(ImageMaskFullPath, dtype=ComputeDtype, Scalar=Scalar) > 0.5
+
+
+def ReduceMask(mask, scalar):
+    '''
+    :return: Boolean mask resized by scalar.  Pixels are True if the majority of the pixels they were reduced from are True.
+    '''
+    return ReduceImage(AsComputeDtype(mask), scalar) > 0.5
+
+
+def MaskExtrema(image, Mask=None):
+    '''
+    Masks the min/max values in the image.  This is the masked correlation counterpart of ReplaceImageExtramaWithNoise.
+    
+    :param ndimage image: Input image
+    :param ndimage Mask: Optional boolean mask to combine with the extrema mask
+    :return: Boolean mask, False for pixels equal to the image's minimum or maximum or already masked
+    :rtype: ndimage
+    '''
+    
+    if Mask is None:
+        Valid = np.ones(image.shape, dtype=bool)
+    else:
+        assert(image.shape == Mask.shape)
+        Valid = np.array(Mask, dtype=bool)
+        
+    Valid &= image != image.min()
+    Valid &= image != image.max()
+    return Valid
+
+
 def NormalizeImage(image):
     '''Adjusts the image to have a range of 0 to 1.0'''
 
@@ -602,42 +824,37 @@ def ImageToTiles(source_image, tile_size, grid_shape=None, cval=0):
     '''    
     # Build the output dictionary
     grid = {}
-    for (iRow, iCol, tile) in ImageToTilesGenerator(source_image, tile_size):
+    for (iRow, iCol, tile) in ImageToTilesGenerator(source_image, tile_size, grid_shape=grid_shape, cval=cval):
         grid[iRow, iCol] = tile
         
     return grid  
 
 
 def ImageToTilesGenerator(source_image, tile_size, grid_shape=None, cval=0):
-    '''An iterator generating all tiles for an image
+    '''An iterator generating all tiles for an image.  Tiles inside the image are views of the source image, only 
+       tiles extending past the edge of the image are copied and padded.
     :param array tile_size: Shape of each tile
     :param array grid_shape: Dimensions of grid, if None the grid is large enough to reproduce the source_image with zero padding if needed
     :param object cval: Fill value for images that are padded.  Default is zero.  Use 'random' to generate random noise
     :return: (iCol,iRow, tile_image)
     ''' 
-    grid_shape = TileGridShape(source_image.shape, tile_size)
+    if grid_shape is None:
+        grid_shape = TileGridShape(source_image.shape, tile_size)
     
-    (required_shape) = grid_shape * tile_size 
+    (TileHeight, TileWidth) = (int(tile_size[0]), int(tile_size[1]))
     
-    source_image_padded = CropImage(source_image, Xo=0, Yo=0, Width=int(math.ceil(required_shape[1])), Height=int(math.ceil(required_shape[0])), cval=0)
-    
-    # Build the output dictionary
     StartY = 0 
-    EndY = tile_size[0]
     
     for iRow in range(0, int(grid_shape[0])):
         
         StartX = 0
-        EndX = tile_size[1]
     
         for iCol in range(0, int(grid_shape[1])):
-            yield (iRow, iCol, source_image_padded[StartY:EndY, StartX:EndX])
+            yield (iRow, iCol, CropImage(source_image, Xo=StartX, Yo=StartY, Width=TileWidth, Height=TileHeight, cval=cval))
         
-            StartX += tile_size[1]
-            EndX += tile_size[1]    
+            StartX += TileWidth
         
-        StartY += tile_size[0]
-        EndY += tile_size[0]
+        StartY += TileHeight
         
 
 def GetImageTile(source_image, iRow, iCol, tile_size):
@@ -740,6 +957,82 @@ def ReplaceImageExtramaWithNoise(image, ImageMedian=None, ImageStdDev=None):
 
     return OutputImage
 
+class PaddingPolicies(object):
+    '''How PadImageForPhaseCorrelation chooses the dimensions of a padded image'''
+    
+    POWER_OF_TWO = 'power-of-two'  # Next power of two
+    SMOOTH = 'smooth'  # Next even size with no prime factor larger than 7.  FFT libraries transform these sizes efficiently.
+    MINIMUM = 'minimum'  # Only the size the overlap requires
+    
+    Policies = [POWER_OF_TWO, SMOOTH, MINIMUM]
+    
+
+DefaultPaddingPolicy = PaddingPolicies.SMOOTH
+
+
+def _ResolvePaddingPolicy(PowerOfTwo=None, PaddingPolicy=None):
+    '''PaddingPolicy takes precedence over the older PowerOfTwo flag.  If neither is specified the DefaultPaddingPolicy is used'''
+    
+    if PaddingPolicy is None:
+        if PowerOfTwo is None:
+            return DefaultPaddingPolicy
+        
+        return PaddingPolicies.POWER_OF_TWO if PowerOfTwo else PaddingPolicies.MINIMUM
+    
+    if not PaddingPolicy in PaddingPolicies.Policies:
+        raise ValueError("Unknown padding policy %s, expected one of %s" % (PaddingPolicy, str(PaddingPolicies.Policies)))
+    
+    return PaddingPolicy
+
+
+def IsSmooth(val):
+    '''
+    :return: True if the integer has no prime factors larger than 7
+    '''
+    
+    val = int(val)
+    if val < 1:
+        return False
+    
+    for factor in (2, 3, 5, 7):
+        while val % factor == 0:
+            val //= factor
+            
+    return val == 1
+
+
+def NearestSmoothSize(val, multiple=2):
+    '''
+    :param float val: Minimum size
+    :param int multiple: The returned size is a multiple of this value.  The default keeps sizes even, which places the
+                         zero offset of an fftshifted correlation image exactly at the center.  Must have no prime factors larger than 7.
+    :return: Smallest multiple of multiple greater than or equal to val with no prime factors larger than 7
+    '''
+    
+    if not IsSmooth(multiple):
+        raise ValueError("Multiple %d has prime factors larger than 7" % multiple)
+    
+    n = max(int(math.ceil(val / float(multiple))), 1)
+    while not IsSmooth(n):
+        n += 1
+        
+    return n * multiple
+
+
+def NearestSmoothSizeWithOverlap(val, overlap=1.0):
+    '''
+    :return: Same as DimensionWithOverlap, but output dimension is increased to the next even size with no prime factor larger than 7 for faster FFT operations
+    '''
+
+    if overlap > 1.0:
+        overlap = 1.0
+
+    if overlap < 0.0:
+        overlap = 0.0
+
+    return NearestSmoothSize(DimensionWithOverlap(val, overlap))
+
+
 def NearestPowerOfTwo(val):
     return math.pow(2, math.ceil(math.log(val, 2)))
 
@@ -777,8 +1070,27 @@ def DimensionWithOverlap(val, overlap=1.0):
 
     return val + (val * (1.0 - overlap) * 2.0)
 
+def PaddedShapeForPhaseCorrelation(shape, MinOverlap=.05, PowerOfTwo=None, PaddingPolicy=None):
+    '''
+    :param tuple shape: (Height, Width) of the image to be padded
+    :param float MinOverlap: Minimum overlap allowed between the input image and images it will be registered to
+    :param bool PowerOfTwo: Pad the image to a power of two if true, or only as much as required if false.  Ignored if PaddingPolicy is specified.
+    :param str PaddingPolicy: One of PaddingPolicies, defaults to DefaultPaddingPolicy
+    :return: (Height, Width) PadImageForPhaseCorrelation will pad an image of the specified shape to
+    :rtype: tuple
+    '''
+    
+    PaddingPolicy = _ResolvePaddingPolicy(PowerOfTwo, PaddingPolicy)
+    
+    if PaddingPolicy == PaddingPolicies.POWER_OF_TWO:
+        return (int(NearestPowerOfTwoWithOverlap(shape[0], MinOverlap)), int(NearestPowerOfTwoWithOverlap(shape[1], MinOverlap)))
+    elif PaddingPolicy == PaddingPolicies.SMOOTH:
+        return (int(NearestSmoothSizeWithOverlap(shape[0], MinOverlap)), int(NearestSmoothSizeWithOverlap(shape[1], MinOverlap)))
+    
+    return (int(DimensionWithOverlap(shape[0], MinOverlap)), int(DimensionWithOverlap(shape[1], MinOverlap)))
+
 # @profile
-def PadImageForPhaseCorrelation(image, MinOverlap=.05, ImageMedian=None, ImageStdDev=None, NewWidth=None, NewHeight=None, PowerOfTwo=True):
+def PadImageForPhaseCorrelation(image, MinOverlap=.05, ImageMedian=None, ImageStdDev=None, NewWidth=None, NewHeight=None, PowerOfTwo=None, PaddingPolicy=None):
     '''
     Prepares an image for use with the phase correlation operation.  Padded areas are filled with noise matching the histogram of the 
     original image.  Optionally the min/max pixels can also replaced be replaced with noise using FillExtremaWithNoise
@@ -789,7 +1101,8 @@ def PadImageForPhaseCorrelation(image, MinOverlap=.05, ImageMedian=None, ImageSt
     :param float ImageStdDev: Standard deviation of noise, calculated or pulled from cache if none
     :param int NewWidth: Pad input image to this dimension if not none
     :param int NewHeight: Pad input image to this dimension if not none
-    :param bool PowerOfTwo: Pad the image to a power of two if true
+    :param bool PowerOfTwo: Pad the image to a power of two if true, or only as much as required if false.  Ignored if PaddingPolicy is specified.
+    :param str PaddingPolicy: One of PaddingPolicies, defaults to DefaultPaddingPolicy
     :return: An image with the input image centered surrounded by noise
     :rtype: ndimage
     
@@ -800,20 +1113,17 @@ def PadImageForPhaseCorrelation(image, MinOverlap=.05, ImageMedian=None, ImageSt
     Height = Size[0]
     Width = Size[1]
 
-    if(NewHeight is None):
-        if PowerOfTwo:
-            NewHeight = NearestPowerOfTwoWithOverlap(Height, MinOverlap)
-        else:
-            NewHeight = DimensionWithOverlap(Height, MinOverlap)  #  # Height + (Height * (1 - MinOverlap))  # + 1
-
-    if(NewWidth is None):
-        if PowerOfTwo:
-            NewWidth = NearestPowerOfTwoWithOverlap(Width, MinOverlap)
-        else:
-            NewWidth = DimensionWithOverlap(Width, MinOverlap)  #  # Height + (Height * (1 - MinOverlap))  # + 1
+    if NewHeight is None or NewWidth is None:
+        (PaddedHeight, PaddedWidth) = PaddedShapeForPhaseCorrelation(Size, MinOverlap=MinOverlap, PowerOfTwo=PowerOfTwo, PaddingPolicy=PaddingPolicy)
+        
+        if(NewHeight is None):
+            NewHeight = PaddedHeight
+    
+        if(NewWidth is None):
+            NewWidth = PaddedWidth
 
     if(Width == NewWidth and Height == NewHeight):
-        return np.copy(image)
+        return np.array(image, dtype=ComputeDtype)
 
     if(ImageMedian is None or ImageStdDev is None):
         Image1D = image.flat
@@ -823,7 +1133,7 @@ def PadImageForPhaseCorrelation(image, MinOverlap=.05, ImageMedian=None, ImageSt
         if(ImageStdDev is None):
             ImageStdDev = np.std(Image1D)
 
-    PaddedImage = np.zeros((int(NewHeight), int(NewWidth)), dtype=np.float16)
+    PaddedImage = np.zeros((int(NewHeight), int(NewWidth)), dtype=ComputeDtype)
 
     PaddedImageXOffset = int(np.floor((NewWidth - Width) / 2.0))
     PaddedImageYOffset = int(np.floor((NewHeight - Height) / 2.0))
@@ -884,20 +1194,21 @@ def ImagePhaseCorrelation(FixedImage, MovingImage):
     # CorrelationImage = real(fftpack.irfft2(T))
     #--------------------------------
 
-    FFTFixed = fftpack.rfft2(FixedImage)
-    FFTMoving = fftpack.rfft2(MovingImage)
+    FFTFixed = fft_backend.rfft2(FixedImage)
+    FFTMoving = fft_backend.rfft2(MovingImage)
     
-    return FFTPhaseCorrelation(FFTFixed, FFTMoving, True) 
+    return FFTPhaseCorrelation(FFTFixed, FFTMoving, True, shape=FixedImage.shape) 
     
     
-def FFTPhaseCorrelation(FFTFixed, FFTMoving, delete_input=False):
+def FFTPhaseCorrelation(FFTFixed, FFTMoving, delete_input=False, shape=None):
     '''
     Returns the phase shift correlation of the FFT's of two images. 
     
     Dimensions of Fixed and Moving images must match
     
-    :param ndarray FixedImage: grayscale image
-    :param ndarray MovingImage: grayscale image
+    :param ndarray FFTFixed: rfft2 of grayscale image
+    :param ndarray FFTMoving: rfft2 of grayscale image
+    :param tuple shape: (height, width) of the images the FFTs were calculated from.  Required if the width is odd.
     :returns: Correlation image of the FFT's.  Light pixels indicate the phase is well aligned at that offset.
     :rtype: ndimage
     
@@ -931,36 +1242,178 @@ def FFTPhaseCorrelation(FFTFixed, FFTMoving, delete_input=False):
 
     conjFFTFixed /= np.absolute(conjFFTFixed)  # Numerator / Divisor
 
-    CorrelationImage = np.real(fftpack.irfft2(conjFFTFixed))
+    CorrelationImage = fft_backend.irfft2(conjFFTFixed, shape)
     del conjFFTFixed
 
     return CorrelationImage 
 
 
+def FFTPhaseCorrelationBatch(FFTFixed, FFTMoving, shape=None):
+    '''
+    Returns the phase shift correlation for each pair in stacks of FFT's.  The normalized cross-power spectrum of 
+    the entire stack is calculated in one pass and inverted with one stacked transform.
+    
+    :param ndarray FFTFixed: Stack of rfft2 of grayscale images with shape (N, height, width // 2 + 1)
+    :param ndarray FFTMoving: Stack of rfft2 of grayscale images, same shape as FFTFixed
+    :param tuple shape: (height, width) of the images the FFTs were calculated from.  Required if the width is odd.
+    :returns: Stack of correlation images
+    :rtype: ndarray
+    '''
+    
+    if(not (FFTFixed.shape == FFTMoving.shape)):
+        raise ValueError("FFTPhaseCorrelationBatch: Fixed and Moving stacks do not have same dimension")
+    
+    CrossPower = np.conjugate(FFTFixed)
+    CrossPower *= FFTMoving
+    CrossPower /= np.absolute(CrossPower)  # Numerator / Divisor
+    
+    return fft_backend.irfft2_stack(CrossPower, shape)
+
+
+class PeakFindingModes(object):
+    '''How FindPeak locates the strongest response in a correlation image'''
+    
+    LABEL = 'label'  # Label every connected region above the cutoff and return the center of mass of the region with the largest sum
+    LOCAL_MAXIMA = 'local-maxima'  # Measure only the neighborhoods of the brightest local maxima above the cutoff and return the centroid of the strongest
+    
+    Modes = [LABEL, LOCAL_MAXIMA]
+    
+
+DefaultPeakFindingMode = PeakFindingModes.LABEL
+
+# Number of the brightest local maxima PeakFindingModes.LOCAL_MAXIMA measures
+PeakCandidates = 8
+
+# Pixels within this distance of a local maximum are summed to measure its strength
+PeakNeighborhoodRadius = 2
+
+
+def _ResolvePeakFindingMode(PeakMode):
+    if PeakMode is None:
+        return DefaultPeakFindingMode
+    
+    if not PeakMode in PeakFindingModes.Modes:
+        raise ValueError("Unknown peak finding mode %s, expected one of %s" % (PeakMode, str(PeakFindingModes.Modes)))
+    
+    return PeakMode
+
+
+def _FindPeakUsingLocalMaxima(image, Cutoff=0.995, SearchMask=None):
+    '''
+    Find the strongest peak without sorting or labeling the entire image.  Pixels above the cutoff are selected with a
+    partial sort.  Only the neighborhoods of the brightest local maxima among them are measured.  The sub-pixel
+    position is the centroid of the pixels above the cutoff in the neighborhood of the strongest maximum.  Pixels
+    outside the SearchMask are ignored, as if they were zero.
+    :return: Offset of peak from image center and sum of pixels values above the cutoff near the peak
+    :rtype: (tuple, float)
+    '''
+    
+    FlatImage = np.asarray(image).ravel()
+    
+    if SearchMask is None:
+        iCandidates = None
+        CandidateValues = FlatImage
+    else:
+        iCandidates = np.flatnonzero(SearchMask)
+        CandidateValues = FlatImage[iCandidates]
+        
+    NumCandidates = CandidateValues.shape[0]
+    if NumCandidates == 0:
+        raise ValueError("FindPeak: SearchMask excludes every pixel")
+    
+    NumAboveCutoff = min(max(int(math.ceil(NumCandidates * (1.0 - Cutoff))), 1), NumCandidates)
+    iBrightest = np.argpartition(CandidateValues, NumCandidates - NumAboveCutoff)[NumCandidates - NumAboveCutoff:]
+    CutoffValue = CandidateValues[iBrightest].min()
+    
+    if iCandidates is not None:
+        iBrightest = iCandidates[iBrightest]
+    
+    (Y, X) = np.unravel_index(iBrightest, image.shape)
+    Values = FlatImage[iBrightest]
+    
+    # Keep pixels at least as bright as their eight neighbors inside the search mask
+    MaxY = image.shape[0] - 1
+    MaxX = image.shape[1] - 1
+    IsLocalMax = np.ones(Values.shape, dtype=bool)
+    for dY in (-1, 0, 1):
+        for dX in (-1, 0, 1):
+            if dY == 0 and dX == 0:
+                continue
+            
+            (NeighborY, NeighborX) = (np.clip(Y + dY, 0, MaxY), np.clip(X + dX, 0, MaxX))
+            IsNotSmaller = Values >= image[NeighborY, NeighborX]
+            if SearchMask is not None:
+                IsNotSmaller |= ~SearchMask[NeighborY, NeighborX]
+                
+            IsLocalMax &= IsNotSmaller
+    
+    if not np.any(IsLocalMax):
+        # Only possible if comparisons fail, for example with NaN values.  Measure the brightest candidate.
+        IsLocalMax = np.arange(Values.shape[0]) == np.argmax(Values)
+
+    (Y, X, Values) = (Y[IsLocalMax], X[IsLocalMax], Values[IsLocalMax])
+    
+    iOrder = np.argsort(-Values, kind='stable')[:PeakCandidates]
+    
+    r = PeakNeighborhoodRadius
+    BestStrength = None
+    BestNeighborhood = None
+    for i in iOrder:
+        (MinY, MinX) = (max(Y[i] - r, 0), max(X[i] - r, 0))
+        Neighborhood = np.array(image[MinY:Y[i] + r + 1, MinX:X[i] + r + 1], dtype=np.float64)
+        Neighborhood[Neighborhood < CutoffValue] = 0
+        if SearchMask is not None:
+            Neighborhood[~SearchMask[MinY:Y[i] + r + 1, MinX:X[i] + r + 1]] = 0
+        Strength = np.sum(Neighborhood)
+        if BestStrength is None or Strength > BestStrength:
+            (BestStrength, BestNeighborhood) = (Strength, (Neighborhood, MinY, MinX))
+            
+    (Neighborhood, MinY, MinX) = BestNeighborhood
+    (NeighborhoodY, NeighborhoodX) = np.indices(Neighborhood.shape)
+    PeakCenterOfMass = (MinY + (np.sum(Neighborhood * NeighborhoodY) / BestStrength), MinX + (np.sum(Neighborhood * NeighborhoodX) / BestStrength))
+        
+    Offset = (image.shape[0] / 2.0 - PeakCenterOfMass[0], image.shape[1] / 2.0 - PeakCenterOfMass[1])
+    return (Offset, BestStrength)
+
+
 # @profile
-def FindPeak(image, Cutoff=0.995, MinOverlap=0, MaxOverlap=1):
+def FindPeak(image, Cutoff=0.995, MinOverlap=0, MaxOverlap=1, PeakMode=None, SearchMask=None):
     '''
     Find the offset of the strongest response in a phase correlation image
     
     :param ndimage image: grayscale image
     :param float Cutoff: Percentile used to threshold image.  Values below the percentile are ignored
-    :param float MinOverlap: Minimum overlap allowed
+    :param float MinOverlap: Minimum overlap allowed.  Use CreateOverlapMask to build a SearchMask enforcing overlap limits.
     :param float MaxOverlap: Maximum overlap allowed
+    :param str PeakMode: One of PeakFindingModes, defaults to DefaultPeakFindingMode
+    :param ndarray SearchMask: Optional boolean image, only peaks at True pixels are considered.  See CreateOverlapMask.
     :return: Offset of peak from image center and sum of pixels values at peak
     :rtype: (tuple, float)
     '''
+    
+    if _ResolvePeakFindingMode(PeakMode) == PeakFindingModes.LOCAL_MAXIMA:
+        return _FindPeakUsingLocalMaxima(image, Cutoff=Cutoff, SearchMask=SearchMask)
 
     # CutoffValue = ImageIntensityAtPercent(image, Cutoff)
 
-    CutoffValue = scipy.stats.scoreatpercentile(image, per=Cutoff * 100.0)
+    # np.percentile uses a partial sort instead of sorting the entire image
+    if SearchMask is None:
+        CutoffValue = np.percentile(image, Cutoff * 100.0)
+    else:
+        if not np.any(SearchMask):
+            raise ValueError("FindPeak: SearchMask excludes every pixel")
+        
+        CutoffValue = np.percentile(image[SearchMask], Cutoff * 100.0)
 
     ThresholdImage = numpy.array(image)
     ThresholdImage[ThresholdImage < CutoffValue] = 0
+    if SearchMask is not None:
+        ThresholdImage[~SearchMask] = 0
     #ThresholdImage = scipy.stats.threshold(image, threshmin=CutoffValue, threshmax=None, newval=0)
     # ShowGrayscale(ThresholdImage)
 
     [LabelImage, NumLabels] = scipy.ndimage.measurements.label(ThresholdImage)
-    LabelSums = scipy.ndimage.measurements.sum(ThresholdImage, LabelImage, list(range(0, NumLabels)))
+    LabelSums = scipy.ndimage.measurements.sum(ThresholdImage, LabelImage, list(range(0, NumLabels + 1)))
     PeakValueIndex = LabelSums.argmax()
     PeakCenterOfMass = scipy.ndimage.measurements.center_of_mass(ThresholdImage, LabelImage, PeakValueIndex)
     PeakStrength = LabelSums[PeakValueIndex]
@@ -976,6 +1429,88 @@ def FindPeak(image, Cutoff=0.995, MinOverlap=0, MaxOverlap=1):
     return (Offset, PeakStrength)
 
 
+def FindPeakBatch(images, Cutoff=0.995, MinOverlap=0, MaxOverlap=1, PeakMode=None, SearchMask=None):
+    '''
+    Find the offset of the strongest response in each image of a stack of phase correlation images.  Equivalent to 
+    calling FindPeak on each image, but thresholding, labeling and measuring the peaks is done for the entire stack at once.
+    
+    :param ndarray images: Stack of grayscale images with shape (N, height, width)
+    :param float Cutoff: Percentile used to threshold each image.  Values below the percentile are ignored
+    :param float MinOverlap: Minimum overlap allowed
+    :param float MaxOverlap: Maximum overlap allowed
+    :param str PeakMode: One of PeakFindingModes, defaults to DefaultPeakFindingMode
+    :param ndarray SearchMask: Optional boolean image applied to every image in the stack, see FindPeak
+    :return: List of (Offset of peak from image center, sum of pixels values at peak) for each image
+    :rtype: list
+    '''
+    
+    images = np.asarray(images)
+    num_images = images.shape[0]
+    
+    if _ResolvePeakFindingMode(PeakMode) == PeakFindingModes.LOCAL_MAXIMA:
+        # Local maxima are found without labeling, so there is nothing to share across the stack
+        return [_FindPeakUsingLocalMaxima(image, Cutoff=Cutoff, SearchMask=SearchMask) for image in images]
+    
+    if SearchMask is None:
+        CutoffValues = np.percentile(images.reshape((num_images, -1)), Cutoff * 100.0, axis=1)
+    else:
+        if not np.any(SearchMask):
+            raise ValueError("FindPeakBatch: SearchMask excludes every pixel")
+        
+        CutoffValues = np.percentile(images[:, SearchMask], Cutoff * 100.0, axis=1)
+    
+    ThresholdImages = numpy.array(images)
+    ThresholdImages[ThresholdImages < CutoffValues[:, np.newaxis, np.newaxis]] = 0
+    if SearchMask is not None:
+        ThresholdImages[:, ~SearchMask] = 0
+    
+    # Pixels are not connected across the stack axis, so each image is labeled independently
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = scipy.ndimage.generate_binary_structure(2, 1)
+    [LabelImage, NumLabels] = scipy.ndimage.measurements.label(ThresholdImages, structure)
+    
+    FlatLabels = LabelImage.ravel()
+    LabelSums = np.bincount(FlatLabels, ThresholdImages.ravel(), minlength=NumLabels + 1)
+    
+    # Labels are numbered in raster order, so the labels of each image are a contiguous range
+    LastLabel = np.maximum.accumulate(np.max(LabelImage.reshape((num_images, -1)), axis=1))
+    FirstLabel = np.hstack(([1], LastLabel[:-1] + 1))
+    
+    results = [None] * num_images
+    PeakLabels = np.zeros(num_images, dtype=np.int64)
+    for i in range(0, num_images):
+        if LastLabel[i] < FirstLabel[i]:
+            # No pixels above the cutoff, let FindPeak handle it
+            results[i] = FindPeak(images[i], Cutoff=Cutoff, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap, PeakMode=PeakFindingModes.LABEL, SearchMask=SearchMask)
+            continue
+        
+        PeakLabels[i] = FirstLabel[i] + np.argmax(LabelSums[FirstLabel[i]:LastLabel[i] + 1])
+        
+    # Measure the center of mass using only the pixels of the peaks
+    IsPeakLabel = np.zeros(NumLabels + 1, dtype=bool)
+    IsPeakLabel[PeakLabels[PeakLabels > 0]] = True
+    iPeakPixels = np.flatnonzero(IsPeakLabel[FlatLabels])
+    PeakPixelLabels = FlatLabels[iPeakPixels]
+    PeakPixelValues = ThresholdImages.ravel()[iPeakPixels]
+    (_, PeakPixelY, PeakPixelX) = np.unravel_index(iPeakPixels, images.shape)
+    
+    PeakMassY = np.bincount(PeakPixelLabels, PeakPixelValues * PeakPixelY, minlength=NumLabels + 1)
+    PeakMassX = np.bincount(PeakPixelLabels, PeakPixelValues * PeakPixelX, minlength=NumLabels + 1)
+    
+    for i in range(0, num_images):
+        if results[i] is not None:
+            continue
+        
+        PeakLabel = PeakLabels[i]
+        PeakStrength = LabelSums[PeakLabel]
+        PeakCenterOfMass = (PeakMassY[PeakLabel] / PeakStrength, PeakMassX[PeakLabel] / PeakStrength)
+        
+        Offset = (images.shape[1] / 2.0 - PeakCenterOfMass[0], images.shape[2] / 2.0 - PeakCenterOfMass[1])
+        results[i] = (Offset, PeakStrength)
+            
+    return results
+
+
 def CropNonOverlapping(FixedImageSize, MovingImageSize, CorrelationImage, MinOverlap=0.0, MaxOverlap=1.0):
     ''' '''
 
@@ -983,21 +1518,231 @@ def CropNonOverlapping(FixedImageSize, MovingImageSize, CorrelationImage, MinOve
         return CorrelationImage
 
 
-def CreateOverlapMask(FixedImageSize, MovingImageSize, MinOverlap=0.0, MaxOverlap=1.0):
-    '''Defines a mask that determines which peaks should be considered'''
+def CreateOverlapMask(FixedImageSize, MovingImageSize, MinOverlap=0.0, MaxOverlap=1.0, CorrelationShape=None):
+    '''Defines a mask that determines which peaks should be considered.  Each pixel of a fftshifted correlation image
+       corresponds to the offset FindPeak reports for a peak at that pixel.  The mask is True where the images,
+       centered on each other and then translated by that offset, overlap by an acceptable amount.
+       
+       :param tuple FixedImageSize: (Height, Width) of the fixed image
+       :param tuple MovingImageSize: (Height, Width) of the moving image
+       :param float MinOverlap: Minimum fraction of the smaller image that must overlap the other image
+       :param float MaxOverlap: Maximum fraction of the smaller image that may overlap the other image
+       :param tuple CorrelationShape: (Height, Width) of the correlation image.  Defaults to the sum of the image sizes, which contains every possible offset.
+       :return: Boolean mask with the shape of the correlation image
+       :rtype: ndarray
+    '''
+
+    if CorrelationShape is None:
+        CorrelationShape = (FixedImageSize[0] + MovingImageSize[0], FixedImageSize[1] + MovingImageSize[1])
 
-    MaxWidth = FixedImageSize[1] + MovingImageSize[1]
-    MaxHeight = FixedImageSize[0] + MovingImageSize[0]
+    AxisOverlap = []
+    for iAxis in range(0, 2):
+        Length = CorrelationShape[iAxis]
+        Offsets = np.abs((Length / 2.0) - np.arange(Length))
+        
+        # Length of the overlap of two centered segments when one is translated by the offset
+        Overlap = ((FixedImageSize[iAxis] + MovingImageSize[iAxis]) / 2.0) - Offsets
+        AxisOverlap.append(np.clip(Overlap, 0, min(FixedImageSize[iAxis], MovingImageSize[iAxis])))
 
-    mask = np.ones([MaxHeight, MaxWidth], dtype=np.bool)
+    SmallestArea = float(min(FixedImageSize[0] * FixedImageSize[1], MovingImageSize[0] * MovingImageSize[1]))
+    OverlapFraction = np.outer(AxisOverlap[0], AxisOverlap[1]) / SmallestArea
 
-    raise NotImplementedError()
+    return np.logical_and(OverlapFraction >= MinOverlap, OverlapFraction <= MaxOverlap)
 
 
-def FindOffset(FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FFT_Required=True):
+def _OverlapMaskForCorrelation(CorrelationShape, MinOverlap=0.0, MaxOverlap=1.0):
+    '''
+    :return: SearchMask restricting peaks of a correlation of two images with CorrelationShape to the overlap limits, or None if every offset is acceptable
+    '''
+    if MinOverlap <= 0 and MaxOverlap >= 1:
+        return None
+    
+    return CreateOverlapMask(CorrelationShape, CorrelationShape, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap, CorrelationShape=CorrelationShape)
+
+
+class CorrelationModes(object):
+    '''How FindOffset and the registration functions built on it correlate images'''
+    
+    PHASE = 'phase'  # Phase correlation.  Masked areas and padding are filled with noise.
+    MASKED_NCC = 'masked-ncc'  # Normalized cross-correlation over only the unmasked pixels the images share at each offset.  Deterministic.
+    
+    Modes = [PHASE, MASKED_NCC]
+    
+
+DefaultCorrelationMode = CorrelationModes.PHASE
+
+# Masked normalized cross-correlation ignores offsets where the masks overlap by less than this fraction of the smaller mask.
+# Correlations of a few pixels are close to +/-1 by chance.
+MaskedCorrelationMinOverlap = 0.1
+
+
+def _ResolveCorrelationMode(CorrelationMode):
+    if CorrelationMode is None:
+        return DefaultCorrelationMode
+    
+    if not CorrelationMode in CorrelationModes.Modes:
+        raise ValueError("Unknown correlation mode %s, expected one of %s" % (CorrelationMode, str(CorrelationModes.Modes)))
+    
+    return CorrelationMode
+
+
+def MaskedCorrelationShape(FixedShape, MovingShape):
+    '''
+    :return: (Height, Width) of the images MaskedNormalizedCrossCorrelation pads to.  Large enough that no offset wraps around.
+    :rtype: tuple
+    '''
+    return (NearestSmoothSize(FixedShape[0] + MovingShape[0] - 1), NearestSmoothSize(FixedShape[1] + MovingShape[1] - 1))
+
+
+def _CenterInZeros(image, shape):
+    '''Center the image in a zero filled array, using the same placement as PadImageForPhaseCorrelation'''
+    
+    Padded = np.zeros(shape, dtype=ComputeDtype)
+    YOffset = int(np.floor((shape[0] - image.shape[0]) / 2.0))
+    XOffset = int(np.floor((shape[1] - image.shape[1]) / 2.0))
+    Padded[YOffset:YOffset + image.shape[0], XOffset:XOffset + image.shape[1]] = image
+    return Padded
+
+
+def _MaskedImageTerms(image, Mask, shape):
+    '''
+    :return: (Stack of the masked image, its square and the mask each centered in an array of the specified shape, number of unmasked pixels, variance of the unmasked pixels)
+    '''
+    
+    if Mask is None:
+        Mask = np.ones(image.shape, dtype=bool)
+    elif Mask.shape != image.shape:
+        raise ValueError("Mask shape %s does not match image shape %s" % (str(Mask.shape), str(image.shape)))
+    else:
+        Mask = np.asarray(Mask, dtype=bool)
+        
+    NumPixels = np.count_nonzero(Mask)
+    if NumPixels == 0:
+        raise ValueError("Mask excludes every pixel")
+    
+    # Subtracting the mean of the unmasked pixels reduces round-off error in the variance terms
+    MaskedImage = np.where(Mask, np.asarray(image, dtype=np.float64), 0)
+    MaskedImage[Mask] -= np.sum(MaskedImage) / NumPixels
+    
+    Terms = np.empty((3,) + tuple(shape), dtype=ComputeDtype)
+    Terms[0] = _CenterInZeros(MaskedImage, shape)
+    Terms[1] = _CenterInZeros(MaskedImage * MaskedImage, shape)
+    Terms[2] = _CenterInZeros(Mask, shape)
+    
+    Variance = np.sum(MaskedImage * MaskedImage) / NumPixels
+    return (Terms, NumPixels, Variance)
+
+
+def MaskedNormalizedCrossCorrelation(FixedImage, MovingImage, FixedMask=None, MovingMask=None, MinOverlap=0.0):
+    '''
+    Returns the normalized cross-correlation of two images at every offset, using only the pixels inside both masks.
+    Masked pixels and padding do not contribute, so neither needs to be filled with noise.  Each image, its square and 
+    its mask are transformed with one stacked FFT and the six correlation terms are inverted with one stacked FFT.
+    
+    The images do not need to have the same shape.  Each is centered in a zero filled image of MaskedCorrelationShape
+    so the correlation image is arranged like an fftshifted phase correlation image of images centered in padding, and 
+    FindPeak reports offsets with the same convention as FindOffset.
+    
+    :param ndarray FixedImage: grayscale image
+    :param ndarray MovingImage: grayscale image
+    :param ndarray FixedMask: Optional boolean image, True for fixed image pixels that should be used.  Defaults to every pixel.
+    :param ndarray MovingMask: Optional boolean image, True for moving image pixels that should be used.  Defaults to every pixel.
+    :param float MinOverlap: Minimum fraction of the smaller mask which must overlap.  MaskedCorrelationMinOverlap is used if larger.
+    :return: fftshifted correlation image with coefficients from -1 to 1.  Offsets with too little overlap, or where either image is uniform, are zero.
+    :rtype: ndarray
+    '''
+    
+    shape = MaskedCorrelationShape(FixedImage.shape, MovingImage.shape)
+    
+    (FixedTerms, NumFixedPixels, FixedImageVariance) = _MaskedImageTerms(FixedImage, FixedMask, shape)
+    (MovingTerms, NumMovingPixels, MovingImageVariance) = _MaskedImageTerms(MovingImage, MovingMask, shape)
+    
+    FFTFixed = np.conjugate(fft_backend.rfft2_stack(FixedTerms))
+    del FixedTerms
+    FFTMoving = fft_backend.rfft2_stack(MovingTerms)
+    del MovingTerms
+    
+    # (Fixed, Fixed squared, Fixed mask) x (Moving, Moving squared, Moving mask) products required by the correlation
+    Products = np.stack((FFTFixed[2] * FFTMoving[2],
+                         FFTFixed[0] * FFTMoving[0],
+                         FFTFixed[0] * FFTMoving[2],
+                         FFTFixed[2] * FFTMoving[0],
+                         FFTFixed[1] * FFTMoving[2],
+                         FFTFixed[2] * FFTMoving[1]))
+    del FFTFixed
+    del FFTMoving
+    
+    (Overlap, Cross, FixedSum, MovingSum, FixedSquaredSum, MovingSquaredSum) = fft_backend.irfft2_stack(Products, shape).astype(np.float64)
+    del Products
+    
+    Overlap = np.round(Overlap)
+    MinOverlapPixels = max(MinOverlap, MaskedCorrelationMinOverlap) * min(NumFixedPixels, NumMovingPixels)
+    Valid = Overlap >= max(MinOverlapPixels, 2)
+    
+    Overlap = Overlap[Valid]
+    FixedSum = FixedSum[Valid]
+    MovingSum = MovingSum[Valid]
+    
+    Numerator = Cross[Valid] - ((FixedSum * MovingSum) / Overlap)
+    FixedVariance = FixedSquaredSum[Valid] - ((FixedSum * FixedSum) / Overlap)
+    MovingVariance = MovingSquaredSum[Valid] - ((MovingSum * MovingSum) / Overlap)
+    
+    # Overlapping regions whose variance is small compared to the image's variance are uniform or round-off error
+    FixedThreshold = 1e-3 * Overlap * FixedImageVariance
+    MovingThreshold = 1e-3 * Overlap * MovingImageVariance
+    NonUniform = np.logical_and(FixedVariance > FixedThreshold, MovingVariance > MovingThreshold)
+    
+    Coefficients = np.zeros(Numerator.shape)
+    Coefficients[NonUniform] = Numerator[NonUniform] / np.sqrt(FixedVariance[NonUniform] * MovingVariance[NonUniform])
+    
+    CorrelationImage = np.zeros(shape, dtype=ComputeDtype)
+    CorrelationImage[Valid] = np.clip(Coefficients, -1.0, 1.0)
+    
+    return np.fft.fftshift(CorrelationImage)
+
+
+def _FindOffsetMasked(FixedImage, MovingImage, FixedMask=None, MovingMask=None, MinOverlap=0.0, MaxOverlap=1.0, PeakMode=None):
+    '''FindOffset using MaskedNormalizedCrossCorrelation.  The weight is the correlation coefficient at the peak.'''
+    
+    CorrelationImage = MaskedNormalizedCrossCorrelation(FixedImage, MovingImage, FixedMask=FixedMask, MovingMask=MovingMask, MinOverlap=MinOverlap)
+    
+    # Negative correlations are never the peak
+    np.maximum(CorrelationImage, 0, out=CorrelationImage)
+    
+    weight = float(CorrelationImage.max())
+    if weight <= 0:
+        # Callers expect the same exception phase correlation raises when normalizing a uniform image
+        raise FloatingPointError("Masked images do not share a non-uniform overlapping region at any offset")
+    
+    SearchMask = None
+    if MaxOverlap < 1:
+        SearchMask = CreateOverlapMask(FixedImage.shape, MovingImage.shape, MaxOverlap=MaxOverlap, CorrelationShape=CorrelationImage.shape)
+        SearchMask &= CorrelationImage > 0
+        
+    (peak, strength) = FindPeak(CorrelationImage, PeakMode=PeakMode, SearchMask=SearchMask)
+    if SearchMask is not None:
+        weight = float(CorrelationImage[SearchMask].max())
+    
+    return nornir_imageregistration.AlignmentRecord(peak=peak, weight=weight)
+
+
+def FindOffset(FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FFT_Required=True, PeakMode=None, FixedMask=None, MovingMask=None, CorrelationMode=None):
     '''return an alignment record describing how the images overlap. The alignment record indicates how much the 
        moving image must be rotated and translated to align perfectly with the FixedImage
+       
+       :param float MinOverlap: Minimum fraction of the images which must overlap, peaks at smaller overlaps are ignored
+       :param float MaxOverlap: Maximum fraction of the images which may overlap, peaks at larger overlaps are ignored
+       :param str PeakMode: One of PeakFindingModes, defaults to DefaultPeakFindingMode
+       :param ndarray FixedMask: Optional boolean image, True for fixed image pixels that should be used.  Passing a mask selects masked correlation.
+       :param ndarray MovingMask: Optional boolean image, True for moving image pixels that should be used.  Passing a mask selects masked correlation.
+       :param str CorrelationMode: One of CorrelationModes, defaults to DefaultCorrelationMode.  Masked correlation requires FFT_Required and allows images of different shapes.
        '''
+    
+    if FixedMask is not None or MovingMask is not None or _ResolveCorrelationMode(CorrelationMode) == CorrelationModes.MASKED_NCC:
+        if not FFT_Required:
+            raise ValueError("FindOffset: Masked correlation requires images, not FFT's")
+        
+        return _FindOffsetMasked(FixedImage, MovingImage, FixedMask=FixedMask, MovingMask=MovingMask, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap, PeakMode=PeakMode)
 
     # Find peak requires both the fixed and moving images have equal size
     assert((FixedImage.shape[0] == MovingImage.shape[0]) and (FixedImage.shape[1] == MovingImage.shape[1]))
@@ -1010,13 +1755,14 @@ def FindOffset(FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FFT_Requ
         
     CorrelationImage = np.fft.fftshift(CorrelationImage)
 
-    # Crop the areas that cannot overlap
-
     CorrelationImage -= CorrelationImage.min()
     CorrelationImage /= CorrelationImage.max()
 
+    # Ignore the peaks of offsets that cannot overlap
+    SearchMask = _OverlapMaskForCorrelation(CorrelationImage.shape, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap)
+
     # Timer.Start('Find Peak')
-    (peak, weight) = FindPeak(CorrelationImage, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap)
+    (peak, weight) = FindPeak(CorrelationImage, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap, PeakMode=PeakMode, SearchMask=SearchMask)
 
     del CorrelationImage
 
@@ -1024,6 +1770,179 @@ def FindOffset(FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FFT_Requ
 
     return record
 
+def FindOffsetBatch(FixedImages, MovingImages, MinOverlap=0.0, MaxOverlap=1.0, FFT_Required=True, shape=None, PeakMode=None):
+    '''Return alignment records describing how each pair of images overlap.  Equivalent to calling FindOffset on 
+       each pair, but the FFT's, cross-power spectra and peaks are calculated for the whole stack at once.  Stacked 
+       transforms are much faster than many small transforms.
+       
+       :param ndarray FixedImages: Stack of images with shape (N, height, width), or a list of N images with the same shape
+       :param ndarray MovingImages: Stack of images with the same shape as FixedImages
+       :param bool FFT_Required: False if the stacks already contain the rfft2 of the images
+       :param tuple shape: (height, width) of the images when FFT's are passed.  Required if the width is odd.
+       :param str PeakMode: One of PeakFindingModes, defaults to DefaultPeakFindingMode
+       :return: List of N alignment records
+       :rtype: list
+       '''
+       
+    FixedImages = np.asarray(FixedImages)
+    MovingImages = np.asarray(MovingImages)
+    
+    if(not (FixedImages.shape == MovingImages.shape)):
+        raise ValueError("FindOffsetBatch: Fixed and Moving stacks do not have same dimension")
+    
+    if FixedImages.ndim != 3:
+        raise ValueError("FindOffsetBatch: Expected a stack of 2D images, got an array with shape %s" % str(FixedImages.shape))
+    
+    if FFT_Required:
+        shape = FixedImages.shape[1:]
+        FFTFixed = fft_backend.rfft2_stack(FixedImages)
+        FFTMoving = fft_backend.rfft2_stack(MovingImages)
+    else:
+        (FFTFixed, FFTMoving) = (FixedImages, MovingImages)
+        
+    CorrelationImages = FFTPhaseCorrelationBatch(FFTFixed, FFTMoving, shape=shape)
+    del FFTFixed
+    del FFTMoving
+    
+    CorrelationImages = np.fft.fftshift(CorrelationImages, axes=(-2, -1))
+    
+    CorrelationImages -= np.min(CorrelationImages, axis=(1, 2), keepdims=True)
+    CorrelationImages /= np.max(CorrelationImages, axis=(1, 2), keepdims=True)
+    
+    SearchMask = _OverlapMaskForCorrelation(CorrelationImages.shape[1:], MinOverlap=MinOverlap, MaxOverlap=MaxOverlap)
+    
+    peaks = FindPeakBatch(CorrelationImages, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap, PeakMode=PeakMode, SearchMask=SearchMask)
+    del CorrelationImages
+    
+    return [nornir_imageregistration.AlignmentRecord(peak=peak, weight=weight) for (peak, weight) in peaks]
+
+
+# NormalizedCrossCorrelation calculates the correlation directly, without FFT's, when there are at most this many positions
+MaxDirectCorrelationPositions = 81
+
+
+def _WindowSums(image, shape):
+    '''
+    :return: Sum of the image over every window of the specified shape lying entirely within the image, calculated from a summed area table
+    '''
+    
+    (Height, Width) = shape
+    SummedArea = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.float64)
+    SummedArea[1:, 1:] = np.cumsum(np.cumsum(image, axis=0, dtype=np.float64), axis=1)
+    
+    return SummedArea[Height:, Width:] - SummedArea[:-Height, Width:] - SummedArea[Height:, :-Width] + SummedArea[:-Height, :-Width]
+
+
+def NormalizedCrossCorrelation(SearchImage, Template):
+    '''
+    Returns the normalized cross-correlation of the template at every position where it lies entirely within the search
+    image.  When there are few positions the correlation is calculated directly.  Otherwise the search image is padded
+    only to an efficient FFT size and the correlation is calculated with FFT's.  Window statistics come from summed
+    area tables.
+    
+    :param ndarray SearchImage: grayscale image
+    :param ndarray Template: grayscale image no larger than the search image
+    :return: Correlation coefficients from -1 to 1 with shape SearchImage.shape - Template.shape + 1.  Positions where either image is uniform are zero.
+    :rtype: ndarray
+    '''
+    
+    if SearchImage.shape[0] < Template.shape[0] or SearchImage.shape[1] < Template.shape[1]:
+        raise ValueError("NormalizedCrossCorrelation: Template %s is larger than the search image %s" % (str(Template.shape), str(SearchImage.shape)))
+    
+    ResultShape = (SearchImage.shape[0] - Template.shape[0] + 1, SearchImage.shape[1] - Template.shape[1] + 1)
+    (Height, Width) = Template.shape
+    NumPixels = Height * Width
+    
+    # Subtracting the means does not change the result but reduces round-off error
+    SearchImage = np.asarray(SearchImage, dtype=np.float64)
+    SearchImage = SearchImage - np.mean(SearchImage)
+    Template = np.asarray(Template, dtype=np.float64)
+    Template = Template - np.mean(Template)
+    
+    TemplateNorm = np.sqrt(np.sum(Template * Template))
+    SearchNorm = np.sqrt(np.sum(SearchImage * SearchImage))
+    if TemplateNorm == 0 or SearchNorm == 0:
+        return np.zeros(ResultShape)
+    
+    if ResultShape[0] * ResultShape[1] <= MaxDirectCorrelationPositions:
+        Numerator = np.empty(ResultShape)
+        for iY in range(0, ResultShape[0]):
+            for iX in range(0, ResultShape[1]):
+                Numerator[iY, iX] = np.sum(SearchImage[iY:iY + Height, iX:iX + Width] * Template)
+    else:
+        # Positions where the template fits inside the search image do not wrap around a circular correlation at least as large as the search image
+        PaddedShape = PaddedShapeForPhaseCorrelation(SearchImage.shape, MinOverlap=1.0)
+        PaddedSearch = np.zeros(PaddedShape, dtype=ComputeDtype)
+        PaddedSearch[:SearchImage.shape[0], :SearchImage.shape[1]] = SearchImage
+        PaddedTemplate = np.zeros(PaddedShape, dtype=ComputeDtype)
+        PaddedTemplate[:Height, :Width] = Template
+        
+        FFTSearch = fft_backend.rfft2(PaddedSearch)
+        FFTSearch *= np.conjugate(fft_backend.rfft2(PaddedTemplate))
+        Numerator = fft_backend.irfft2(FFTSearch, PaddedShape)[:ResultShape[0], :ResultShape[1]]
+        del FFTSearch
+        
+    WindowSum = _WindowSums(SearchImage, Template.shape)
+    WindowVariance = _WindowSums(SearchImage * SearchImage, Template.shape) - ((WindowSum * WindowSum) / NumPixels)
+    
+    # Windows whose variance is round-off error are uniform
+    Valid = WindowVariance > (SearchNorm * SearchNorm * 1e-12)
+    
+    Result = np.zeros(ResultShape)
+    Result[Valid] = Numerator[Valid] / (np.sqrt(WindowVariance[Valid]) * TemplateNorm)
+    return np.clip(Result, -1.0, 1.0)
+
+
+def _QuadraticPeakOffset(before, peak, after):
+    '''
+    :return: Sub-pixel position of the vertex of a parabola through three evenly spaced samples, relative to the center sample
+    '''
+    
+    curvature = before - (2.0 * peak) + after
+    if curvature >= 0:
+        # Not a maximum, possibly a plateau
+        return 0.0
+    
+    return min(max(0.5 * (before - after) / curvature, -0.5), 0.5)
+
+
+def FindOffsetWithinWindow(SearchImage, Template):
+    '''Return an alignment record describing the displacement of the template from the center of the search image.
+       Only displacements keeping the template entirely within the search image are searched, so the search image
+       should be larger than the template by twice the largest expected displacement in each dimension.  The peak uses
+       the same convention as FindOffset with the search image as the fixed image.
+       
+       :param ndarray SearchImage: grayscale image, centered on the expected position of the template
+       :param ndarray Template: grayscale image
+       :return: Alignment record whose weight is the correlation coefficient at the peak.  None if either image is uniform, 
+                or if the best match lies on the edge of the search window and the true peak may be outside of it.
+       '''
+    
+    Correlation = NormalizedCrossCorrelation(SearchImage, Template)
+    
+    iPeak = np.unravel_index(np.argmax(Correlation), Correlation.shape)
+    if Correlation[iPeak] <= 0:
+        return None
+    
+    peak = np.zeros(2)
+    for iAxis in range(0, 2):
+        Length = Correlation.shape[iAxis]
+        Position = float(iPeak[iAxis])
+        if Length > 1:
+            if iPeak[iAxis] == 0 or iPeak[iAxis] == Length - 1:
+                return None
+            
+            Before = list(iPeak)
+            Before[iAxis] -= 1
+            After = list(iPeak)
+            After[iAxis] += 1
+            Position += _QuadraticPeakOffset(Correlation[tuple(Before)], Correlation[iPeak], Correlation[tuple(After)])
+            
+        peak[iAxis] = Position - ((Length - 1) / 2.0)
+    
+    return nornir_imageregistration.AlignmentRecord(peak=peak, weight=float(Correlation[iPeak]))
+
+
 def ImageIntensityAtPercent(image, Percent=0.995):
     '''Returns the intensity of the Cutoff% most intense pixel in the image'''
     NumPixels = image.size
@@ -1042,19 +1961,14 @@ def ImageIntensityAtPercent(image, Percent=0.995):
     [histogram, binEdge] = np.histogram(image, bins=NumBins)
 
     PixelNum = float(NumPixels) * Percent
-    CumulativePixelsInBins = 0
-    CutOffHistogramValue = None
-    for iBin in range(0, len(histogram)):
-        if CumulativePixelsInBins > PixelNum:
-            CutOffHistogramValue = binEdge[iBin]
-            break
-
-        CumulativePixelsInBins += histogram[iBin]
-
-    if CutOffHistogramValue is None:
-        CutOffHistogramValue = binEdge[-1]
+    
+    # Return the lower edge of the bin after the first bin where the cumulative pixel count exceeds PixelNum
+    CumulativePixelsInBins = np.cumsum(histogram)
+    iBin = np.searchsorted(CumulativePixelsInBins, PixelNum, side='right') + 1
+    if iBin >= len(histogram):
+        return binEdge[-1]
 
-    return CutOffHistogramValue
+    return binEdge[iBin]
 
 
 if __name__ == '__main__':
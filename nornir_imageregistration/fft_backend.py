@@ -0,0 +1,225 @@
+'''
+Pluggable FFT implementations used by the phase correlation functions in core.
+
+Available backends:
+
+* numpy   - numpy.fft.  Always available.
+* scipy   - scipy.fft, which preserves float32 input and can use multiple workers per transform.
+* pyfftw  - Thread local FFTW plans with aligned buffers.  Wisdom is persisted to disk.  See fftw_manager.
+
+The backend is selected with SetBackend or the NORNIR_FFT_BACKEND environment variable.  SetBackend also updates the
+environment variable so worker processes started afterwards use the same backend.
+'''
+
+import logging
+import os
+
+import numpy as np
+
+
+BackendEnvironmentVariable = 'NORNIR_FFT_BACKEND'
+
+
+def _ImageShapeForSpectrum(spectrum, shape=None):
+    '''Without an explicit shape assume the original image had an even width, which matches numpy's irfft2 default.
+       The image shape is taken from the last two axes of a stack of spectra'''
+    if shape is None:
+        return (spectrum.shape[-2], (spectrum.shape[-1] - 1) * 2)
+
+    return (int(shape[-2]), int(shape[-1]))
+
+
+class FFTBackend(object):
+    '''Base class for FFT implementations.  Images are transformed as float32 where the implementation allows it'''
+
+    name = None
+
+    def rfft2(self, image):
+        '''
+        :param ndarray image: 2D real image
+        :return: Half spectrum of the image
+        :rtype: complex ndarray
+        '''
+        raise NotImplementedError()
+
+    def irfft2(self, spectrum, shape=None):
+        '''
+        :param ndarray spectrum: Half spectrum from rfft2
+        :param tuple shape: (height, width) of the original image.  Required for images with an odd width.
+        :return: Real image
+        :rtype: ndarray
+        '''
+        raise NotImplementedError()
+
+    def rfft2_stack(self, images):
+        '''
+        :param ndarray images: Stack of 2D real images with shape (N, height, width)
+        :return: Half spectra of each image with shape (N, height, width // 2 + 1)
+        :rtype: complex ndarray
+        '''
+        return np.stack([self.rfft2(image) for image in images])
+
+    def irfft2_stack(self, spectra, shape=None):
+        '''
+        :param ndarray spectra: Stack of half spectra from rfft2_stack
+        :param tuple shape: (height, width) of the original images.  Required for images with an odd width.
+        :return: Stack of real images
+        :rtype: ndarray
+        '''
+        return np.stack([self.irfft2(spectrum, shape) for spectrum in spectra])
+
+    def __str__(self):
+        return self.name
+
+
+class NumpyFFTBackend(FFTBackend):
+    '''numpy always transforms in double precision.  Results are converted to single precision to match the other backends.'''
+
+    name = 'numpy'
+
+    def rfft2(self, image):
+        return np.fft.rfft2(np.asarray(image, dtype=np.float32)).astype(np.complex64)
+
+    def irfft2(self, spectrum, shape=None):
+        return np.fft.irfft2(spectrum, s=_ImageShapeForSpectrum(spectrum, shape)).astype(np.float32)
+
+    def rfft2_stack(self, images):
+        return np.fft.rfft2(np.asarray(images, dtype=np.float32), axes=(-2, -1)).astype(np.complex64)
+
+    def irfft2_stack(self, spectra, shape=None):
+        return np.fft.irfft2(spectra, s=_ImageShapeForSpectrum(spectra, shape), axes=(-2, -1)).astype(np.float32)
+
+
+class ScipyFFTBackend(FFTBackend):
+
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        '''
+        :param int workers: Threads used for each transform.  Defaults to one since we usually parallelize across pairs.
+        '''
+        import scipy.fft
+
+        self._fft = scipy.fft
+        self.workers = workers
+
+    def rfft2(self, image):
+        return self._fft.rfft2(np.asarray(image, dtype=np.float32), workers=self.workers)
+
+    def irfft2(self, spectrum, shape=None):
+        return self._fft.irfft2(spectrum, s=_ImageShapeForSpectrum(spectrum, shape), workers=self.workers, overwrite_x=True)
+
+    def rfft2_stack(self, images):
+        return self._fft.rfft2(np.asarray(images, dtype=np.float32), axes=(-2, -1), workers=self.workers)
+
+    def irfft2_stack(self, spectra, shape=None):
+        return self._fft.irfft2(spectra, s=_ImageShapeForSpectrum(spectra, shape), axes=(-2, -1), workers=self.workers, overwrite_x=True)
+
+
+class PyFFTWBackend(FFTBackend):
+
+    name = 'pyfftw'
+
+    def __init__(self, threads=1, WisdomFullPath=None):
+        '''
+        :param int threads: Threads FFTW may use for each transform
+        :param str WisdomFullPath: Wisdom file, defaults to fftw_manager.DefaultWisdomFullPath
+        '''
+        import nornir_imageregistration.fftw_manager as fftw_manager
+
+        self._fftw_manager = fftw_manager
+        self.threads = threads
+        self.WisdomFullPath = WisdomFullPath
+
+    def _GetManager(self):
+        return self._fftw_manager.FFTWManager.GetFFTManager(threads=self.threads, WisdomFullPath=self.WisdomFullPath)
+
+    def rfft2(self, image):
+        plan = self._GetManager().GetRealPlan(image.shape)
+        return plan.rfft2(image)
+
+    def irfft2(self, spectrum, shape=None):
+        plan = self._GetManager().GetRealPlan(_ImageShapeForSpectrum(spectrum, shape))
+        return plan.irfft2(spectrum)
+
+    def rfft2_stack(self, images):
+        plan = self._GetManager().GetRealPlan(images.shape)
+        return plan.rfft2(images)
+
+    def irfft2_stack(self, spectra, shape=None):
+        plan = self._GetManager().GetRealPlan((spectra.shape[0],) + _ImageShapeForSpectrum(spectra, shape))
+        return plan.irfft2(spectra)
+
+
+Backends = {NumpyFFTBackend.name: NumpyFFTBackend,
+            ScipyFFTBackend.name: ScipyFFTBackend,
+            PyFFTWBackend.name: PyFFTWBackend}
+
+_backend = None
+
+
+def CreateBackend(name, **kwargs):
+    '''Create an FFT backend by name.  kwargs are passed to the backend constructor'''
+
+    if not name in Backends:
+        raise ValueError("Unknown FFT backend %s, expected one of %s" % (name, str(sorted(Backends.keys()))))
+
+    return Backends[name](**kwargs)
+
+
+def SetBackend(name, **kwargs):
+    '''Select the FFT backend used by this process and by worker processes started after the call'''
+    global _backend
+
+    _backend = CreateBackend(name, **kwargs)
+    os.environ[BackendEnvironmentVariable] = name
+    return _backend
+
+
+def _DefaultBackend():
+    name = os.environ.get(BackendEnvironmentVariable, None)
+    if not name is None:
+        return CreateBackend(name)
+
+    try:
+        return ScipyFFTBackend()
+    except ImportError:
+        return NumpyFFTBackend()
+
+
+def GetBackend():
+    '''
+    :return: The FFT backend for this process
+    :rtype: FFTBackend
+    '''
+    global _backend
+
+    if _backend is None:
+        try:
+            _backend = _DefaultBackend()
+        except (ImportError, ValueError) as e:
+            log = logging.getLogger(__name__ + ".GetBackend")
+            log.warning("Unable to create requested FFT backend, using numpy: %s" % str(e))
+            _backend = NumpyFFTBackend()
+
+    return _backend
+
+
+def rfft2(image):
+    '''Real to complex 2D FFT using the current backend'''
+    return GetBackend().rfft2(image)
+
+
+def irfft2(spectrum, shape=None):
+    '''Complex to real 2D inverse FFT using the current backend'''
+    return GetBackend().irfft2(spectrum, shape)
+
+
+def rfft2_stack(images):
+    '''Real to complex 2D FFT of each image in an (N, height, width) stack using the current backend'''
+    return GetBackend().rfft2_stack(images)
+
+
+def irfft2_stack(spectra, shape=None):
+    '''Complex to real 2D inverse FFT of each spectrum in a stack using the current backend'''
+    return GetBackend().irfft2_stack(spectra, shape)
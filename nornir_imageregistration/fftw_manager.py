@@ -2,86 +2,320 @@
 Created on Jul 12, 2012
 
 @author: Jamesan
+
+Thread local pyFFTW plans.  Each plan owns pre-allocated, aligned input and output buffers so repeated transforms
+of the same shape do not allocate or re-plan.  Each thread keeps at most MaxCachedPlans plans, releasing the least
+recently used.  Planning with FFTW_MEASURE is expensive, so the accumulated wisdom is saved to disk, at most once
+every WisdomSaveInterval seconds and when the process exits, and loaded by each process the first time a manager
+is requested.  Stacks of images are first planned with FFTW_ESTIMATE because batches vary in size and many stack
+shapes are only seen once.
 '''
 
+import atexit
+import collections
+import logging
+import os
+import pickle
+import tempfile
 import threading
+import time
 
 import numpy
 import pyfftw
 
 
+DefaultWisdomFullPath = os.path.join(tempfile.gettempdir(), 'nornir_fftw_wisdom.pickle')
+
+# Plans kept by each thread's manager.  Every plan holds aligned input and output buffers the size of its transform.
+MaxCachedPlans = 16
+
+# Wisdom added by new plans is saved at most once per interval, in seconds.  The rest is saved when the process exits.
+WisdomSaveInterval = 60.0
+
+# Planner flags that choose how much effort FFTW spends planning
+_PlannerRigorFlags = ('FFTW_ESTIMATE', 'FFTW_MEASURE', 'FFTW_PATIENT', 'FFTW_EXHAUSTIVE', 'FFTW_WISDOM_ONLY')
+
+_wisdom_lock = threading.Lock()
+_wisdom_loaded = set()
+_wisdom_unsaved = set()
+_wisdom_saved_time = {}
+
+
+def LoadWisdom(WisdomFullPath=None):
+    '''Import previously saved FFTW wisdom.  Only the first call per path in a process reads the file.
+    :return: True if wisdom was loaded'''
+
+    if WisdomFullPath is None:
+        WisdomFullPath = DefaultWisdomFullPath
+
+    with _wisdom_lock:
+        if WisdomFullPath in _wisdom_loaded:
+            return False
+
+        _wisdom_loaded.add(WisdomFullPath)
+
+        if not os.path.exists(WisdomFullPath):
+            return False
+
+        try:
+            with open(WisdomFullPath, 'rb') as hFile:
+                wisdom = pickle.load(hFile)
+            pyfftw.import_wisdom(wisdom)
+        except Exception as e:
+            log = logging.getLogger(__name__ + ".LoadWisdom")
+            log.warning("Unable to load FFTW wisdom %s: %s" % (WisdomFullPath, str(e)))
+            return False
+
+    return True
+
+
+def SaveWisdom(WisdomFullPath=None):
+    '''Write the wisdom accumulated by this process to disk.  The file is replaced atomically because several
+       worker processes may save at the same time.'''
+
+    if WisdomFullPath is None:
+        WisdomFullPath = DefaultWisdomFullPath
+
+    wisdom = pyfftw.export_wisdom()
+
+    try:
+        (hTemp, TempFullPath) = tempfile.mkstemp(suffix='.wisdom', dir=os.path.dirname(WisdomFullPath))
+        with os.fdopen(hTemp, 'wb') as hFile:
+            pickle.dump(wisdom, hFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(TempFullPath, WisdomFullPath)
+    except Exception as e:
+        log = logging.getLogger(__name__ + ".SaveWisdom")
+        log.warning("Unable to save FFTW wisdom %s: %s" % (WisdomFullPath, str(e)))
+
+
+def _WisdomChanged(WisdomFullPath):
+    '''Save the wisdom a new plan added, unless it was saved within the last WisdomSaveInterval seconds.  Unsaved wisdom is saved by SaveUnsavedWisdom.'''
+
+    with _wisdom_lock:
+        now = time.time()
+        LastSaved = _wisdom_saved_time.get(WisdomFullPath, None)
+        if LastSaved is not None and now - LastSaved < WisdomSaveInterval:
+            _wisdom_unsaved.add(WisdomFullPath)
+            return
+
+        _wisdom_saved_time[WisdomFullPath] = now
+        _wisdom_unsaved.discard(WisdomFullPath)
+
+    SaveWisdom(WisdomFullPath)
+
+
+def SaveUnsavedWisdom():
+    '''Save wisdom added since the last save of each wisdom file.  Called when the process exits.'''
+
+    with _wisdom_lock:
+        paths = list(_wisdom_unsaved)
+        _wisdom_unsaved.clear()
+
+        now = time.time()
+        for WisdomFullPath in paths:
+            _wisdom_saved_time[WisdomFullPath] = now
+
+    for WisdomFullPath in paths:
+        SaveWisdom(WisdomFullPath)
+
+
+atexit.register(SaveUnsavedWisdom)
+
+
 class FFTWPlan(object):
+    '''Complex to complex plan for a fixed shape'''
 
     def __init__(self, fft, ifft, InputArray, OutputArray):
-        self.__fft = fft;
-        self.__ifft = ifft;
-        self.InputArray = InputArray;
-        self.OutputArray = OutputArray;
+        self.__fft = fft
+        self.__ifft = ifft
+        self.InputArray = InputArray
+        self.OutputArray = OutputArray
 
     def fft(self, Image):
         if Image.shape != self.InputArray.shape:
-            raise ValueError("FFT Plan dimensions do not match input image");
+            raise ValueError("FFT Plan dimensions do not match input image")
 
-        self.InputArray[:] = Image;
-        self.__fft();
-        return self.OutputArray.copy();
+        self.InputArray[:] = Image
+        self.__fft()
+        return self.OutputArray.copy()
 
     def ifft(self, Image):
+        if Image.shape != self.OutputArray.shape:
+            raise ValueError("FFT Plan dimensions do not match input image")
+
+        self.OutputArray[:] = Image
+        self.__ifft()
+        return self.InputArray.copy()
+
+
+class FFTWRealPlan(object):
+    '''Real to complex plan for a fixed 2D shape.  Input buffer is float32, the half-spectrum buffer is complex64'''
+
+    @property
+    def shape(self):
+        return self.InputArray.shape
+
+    @property
+    def spectrum_shape(self):
+        return self.OutputArray.shape
+
+    def __init__(self, fft, ifft, InputArray, OutputArray):
+        self.__fft = fft
+        self.__ifft = ifft
+        self.InputArray = InputArray
+        self.OutputArray = OutputArray
+
+    def rfft2(self, Image):
         if Image.shape != self.InputArray.shape:
-            raise ValueError("FFT Plan dimensions do not match input image");
+            raise ValueError("FFT Plan dimensions do not match input image")
+
+        self.InputArray[:] = Image
+        self.__fft()
+        return self.OutputArray.copy()
+
+    def irfft2(self, Spectrum):
+        if Spectrum.shape != self.OutputArray.shape:
+            raise ValueError("FFT Plan dimensions do not match input spectrum")
 
-        self.OutputArray[:] = Image;
-        self.__ifft();
-        return self.InputArray.copy();
+        self.OutputArray[:] = Spectrum
+        self.__ifft()
+        return self.InputArray.copy()
 
 
 class FFTWManager(object):
     '''
     Performs fft and ifft using the pyFFTW library.
     '''
-    tls = threading.local();
+    tls = threading.local()
 
-    def __init__(self):
+    def __init__(self, threads=1, flags=None, WisdomFullPath=None, MaxPlans=None):
         '''
-        Constructor
+        :param int threads: Number of threads FFTW may use for each transform
+        :param tuple flags: FFTW planner flags, defaults to FFTW_MEASURE
+        :param str WisdomFullPath: Location wisdom is saved to when new plans are created
+        :param int MaxPlans: Number of plans kept, defaults to the module's MaxCachedPlans
         '''
 
-        self.dictPlans = dict();
+        if flags is None:
+            flags = ('FFTW_MEASURE',)
+
+        if WisdomFullPath is None:
+            WisdomFullPath = DefaultWisdomFullPath
+
+        if MaxPlans is None:
+            MaxPlans = MaxCachedPlans
+
+        self.threads = threads
+        self.flags = tuple(flags)
+        self.WisdomFullPath = WisdomFullPath
+        self.MaxPlans = max(int(MaxPlans), 1)
+        self.dictPlans = collections.OrderedDict()
+        self._EstimatedKeys = set()
 
+        LoadWisdom(self.WisdomFullPath)
+
+    def Matches(self, threads=1, flags=None, WisdomFullPath=None):
+        ''':return: True if the manager was created with equivalent arguments'''
+
+        if flags is None:
+            flags = ('FFTW_MEASURE',)
+
+        if WisdomFullPath is None:
+            WisdomFullPath = DefaultWisdomFullPath
+
+        return self.threads == threads and self.flags == tuple(flags) and self.WisdomFullPath == WisdomFullPath
 
     @classmethod
-    def GetFFTManager(cls):
-        # Use thread local storage to find the plan manager if it exists
+    def GetFFTManager(cls, threads=1, flags=None, WisdomFullPath=None):
+        # Use thread local storage to find the plan manager if it exists.  Plans are built for the manager's thread
+        # count and flags, so a request with different arguments replaces the manager and its plans.
+
+        cThread = threading.current_thread()
+        FFTWMan = getattr(cls.tls, 'FFTWMan', None)
+        if FFTWMan is None or not FFTWMan.Matches(threads=threads, flags=flags, WisdomFullPath=WisdomFullPath):
+            cls.tls.FFTWMan = FFTWManager(threads=threads, flags=flags, WisdomFullPath=WisdomFullPath)
+            cls.tls.cThread = cThread
+
+        return cls.tls.FFTWMan
+
+    def _PlanFlags(self, Estimate):
+        ''':return: The manager's planner flags, with FFTW_ESTIMATE in place of its planning effort if Estimate is True'''
+        if not Estimate:
+            return self.flags
+
+        return tuple([f for f in self.flags if not f in _PlannerRigorFlags]) + ('FFTW_ESTIMATE',)
 
-        cThread = threading.current_thread();
-        if not hasattr(cls.tls, 'FFTWMan'):
-            cls.tls.FFTWMan = FFTWManager();
-            cls.tls.cThread = cThread;
+    def _GetCachedPlan(self, key):
+        ''':return: The cached plan, None if the plan is not cached or was estimated and should now be planned with the manager's flags'''
+        PlanObj = self.dictPlans.get(key, None)
+        if PlanObj is None:
+            return None
 
+        if key in self._EstimatedKeys:
+            # The shape was requested again, so planning it properly will pay off
+            self._EstimatedKeys.discard(key)
+            del self.dictPlans[key]
+            return None
 
-        return cls.tls.FFTWMan;
+        self.dictPlans.move_to_end(key)
+        return PlanObj
 
+    def _AddPlan(self, key, PlanObj, Estimated):
+        '''Cache the plan, releasing the least recently used plans beyond MaxPlans'''
+        self.dictPlans[key] = PlanObj
+        if Estimated:
+            self._EstimatedKeys.add(key)
+
+        while len(self.dictPlans) > self.MaxPlans:
+            (OldKey, OldPlan) = self.dictPlans.popitem(last=False)
+            self._EstimatedKeys.discard(OldKey)
+
+        if not Estimated:
+            _WisdomChanged(self.WisdomFullPath)
 
     def GetPlan(self, SizeTuple):
-        if SizeTuple in self.dictPlans:
-            return self.dictPlans[SizeTuple];
+        '''Complex to complex plan'''
+        key = ('c2c', tuple(SizeTuple))
+        PlanObj = self._GetCachedPlan(key)
+        if PlanObj is not None:
+            return PlanObj
 
-        InputArray = pyfftw.create_aligned_array(SizeTuple, dtype=numpy.singlecomplex);
-        OutputArray = pyfftw.create_aligned_array(SizeTuple, dtype=numpy.singlecomplex);
+        InputArray = pyfftw.empty_aligned(SizeTuple, dtype=numpy.complex64)
+        OutputArray = pyfftw.empty_aligned(SizeTuple, dtype=numpy.complex64)
 
-        fft = pyfftw.Plan(InputArray, OutputArray, direction='forward', flags=['measure']);
-        ifft = pyfftw.Plan(OutputArray, InputArray, direction='backward', flags=['measure']);
+        fft = pyfftw.FFTW(InputArray, OutputArray, axes=(0, 1), direction='FFTW_FORWARD', flags=self.flags, threads=self.threads)
+        ifft = pyfftw.FFTW(OutputArray, InputArray, axes=(0, 1), direction='FFTW_BACKWARD', flags=self.flags, threads=self.threads)
 
-        PlanObj = FFTWPlan(fft, ifft, InputArray, OutputArray);
-        self.dictPlans[SizeTuple] = PlanObj;
+        PlanObj = FFTWPlan(fft, ifft, InputArray, OutputArray)
+        self._AddPlan(key, PlanObj, Estimated=False)
 
-        return PlanObj;
+        return PlanObj
 
+    def GetRealPlan(self, SizeTuple):
+        '''Real to complex plan for a 2D image of the specified (height, width), or a stack of images of the specified (count, height, width).
+           A stack is planned with FFTW_ESTIMATE until its shape is requested again while the plan is cached.'''
+        key = ('r2c', tuple(SizeTuple))
+        Estimate = len(SizeTuple) > 2 and not key in self.dictPlans
+        PlanObj = self._GetCachedPlan(key)
+        if PlanObj is not None:
+            return PlanObj
 
-if __name__ == '__main__':
+        SpectrumSize = tuple(SizeTuple[:-1]) + ((SizeTuple[-1] // 2) + 1,)
+
+        InputArray = pyfftw.empty_aligned(SizeTuple, dtype=numpy.float32)
+        OutputArray = pyfftw.empty_aligned(SpectrumSize, dtype=numpy.complex64)
 
-    FFTMan = FFTWManager();
-    PlanObj = FFTMan.GetPlan((256, 256));
+        flags = self._PlanFlags(Estimate)
+        fft = pyfftw.FFTW(InputArray, OutputArray, axes=(-2, -1), direction='FFTW_FORWARD', flags=flags, threads=self.threads)
+        ifft = pyfftw.FFTW(OutputArray, InputArray, axes=(-2, -1), direction='FFTW_BACKWARD', flags=flags, threads=self.threads)
 
+        PlanObj = FFTWRealPlan(fft, ifft, InputArray, OutputArray)
+        self._AddPlan(key, PlanObj, Estimated=Estimate)
+
+        return PlanObj
+
+if __name__ == '__main__':
 
-    import TaskTimer;
+    FFTMan = FFTWManager()
+    PlanObj = FFTMan.GetRealPlan((256, 256))
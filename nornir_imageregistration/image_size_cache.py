@@ -0,0 +1,248 @@
+'''
+Cache of image dimensions read from file headers.
+
+Sizes are cached by path and are valid while the file's modification time and byte size are unchanged.  Only the
+file header is read for an uncached image, for .npy files the header is parsed without mapping the array.
+
+Optionally the sizes of images in a directory are also recorded in a sidecar file in that directory, so later
+processes only need to stat the images.  Directories that cannot be written to are only cached in memory.
+
+Typical use::
+
+    sizes = image_size_cache.GetImageSizes(imagepaths)
+'''
+
+import json
+import logging
+import os
+import threading
+
+from PIL import Image
+import numpy as np
+import numpy.lib.format
+
+# Name of the file recording the sizes of the images in a directory
+SidecarFilename = 'image_sizes.json'
+
+# Read and write a sidecar file in each image directory.  Useful for mosaics on network filesystems.
+UseSidecar = False
+
+# Number of paths each task in GetImageSizes stats and reads
+PathsPerTask = 64
+
+
+def ReadImageSizeFromHeader(ImageFullPath):
+    '''
+    :returns: Image (height, width) read from the file header.  The image data is not read.
+    :rtype: tuple
+    '''
+
+    (root, ext) = os.path.splitext(ImageFullPath)
+
+    try:
+        if ext == '.npy':
+            with open(ImageFullPath, 'rb') as fp:
+                version = numpy.lib.format.read_magic(fp)
+                if version == (1, 0):
+                    (shape, fortran_order, dtype) = numpy.lib.format.read_array_header_1_0(fp)
+                elif version == (2, 0):
+                    (shape, fortran_order, dtype) = numpy.lib.format.read_array_header_2_0(fp)
+                else:
+                    shape = np.load(ImageFullPath, mmap_mode='r').shape
+
+            return tuple(shape[0:2])
+        else:
+            with Image.open(ImageFullPath) as image:
+                return (image.size[1], image.size[0])
+    except (IOError, ValueError):
+        raise IOError("Unable to read size from %s" % (ImageFullPath))
+
+
+class ImageSizeCache(object):
+    '''
+    Thread safe cache of image (height, width) keyed by path, modification time and byte size
+    '''
+
+    def __init__(self, UseSidecar=None):
+        '''
+        :param bool UseSidecar: Read and write a sidecar file in each image directory.  Defaults to the module's UseSidecar.
+        '''
+        self._UseSidecar = UseSidecar
+        self._lock = threading.Lock()
+
+        # Absolute path -> (mtime_ns, byte size, (height, width))
+        self._sizes = {}
+
+        # Directories whose sidecar files were read, and directories with sizes not yet written to their sidecar
+        self._loaded_dirs = set()
+        self._dirty_dirs = set()
+
+    @property
+    def UseSidecar(self):
+        if self._UseSidecar is None:
+            return UseSidecar
+
+        return self._UseSidecar
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def Clear(self):
+        with self._lock:
+            self._sizes.clear()
+            self._loaded_dirs.clear()
+            self._dirty_dirs.clear()
+
+    def GetImageSize(self, ImageFullPath):
+        '''
+        :returns: Image (height, width)
+        :rtype: tuple
+        '''
+
+        ImageFullPath = os.path.abspath(ImageFullPath)
+
+        try:
+            stat = os.stat(ImageFullPath)
+        except OSError:
+            raise IOError("Unable to read size from %s" % (ImageFullPath))
+
+        if self.UseSidecar:
+            self._LoadSidecar(os.path.dirname(ImageFullPath))
+
+        with self._lock:
+            entry = self._sizes.get(ImageFullPath, None)
+
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+
+        size = ReadImageSizeFromHeader(ImageFullPath)
+
+        with self._lock:
+            self._sizes[ImageFullPath] = (stat.st_mtime_ns, stat.st_size, size)
+            self._dirty_dirs.add(os.path.dirname(ImageFullPath))
+
+        return size
+
+    def GetImageSizes(self, ImageFullPaths, pool=None):
+        '''
+        Stat and read the headers of uncached images in parallel.  Sidecar files are updated when finished.
+        :param list ImageFullPaths: Paths to images
+        :param pool: nornir_pools pool used to read the images, defaults to the global thread pool
+        :returns: List of image (height, width), None for images that could not be read
+        :rtype: list
+        '''
+
+        ImageFullPaths = list(ImageFullPaths)
+        if len(ImageFullPaths) <= PathsPerTask:
+            sizes = self._GetImageSizesOrNone(ImageFullPaths)
+        else:
+            if pool is None:
+                import nornir_pools
+                pool = nornir_pools.GetGlobalThreadPool()
+
+            tasks = []
+            for iStart in range(0, len(ImageFullPaths), PathsPerTask):
+                paths = ImageFullPaths[iStart:iStart + PathsPerTask]
+                tasks.append(pool.add_task("Image sizes %d-%d" % (iStart, iStart + len(paths)), self._GetImageSizesOrNone, paths))
+
+            sizes = []
+            for t in tasks:
+                sizes.extend(t.wait_return())
+
+        if self.UseSidecar:
+            self.SaveSidecars()
+
+        return sizes
+
+    def _GetImageSizesOrNone(self, ImageFullPaths):
+        sizes = []
+        for path in ImageFullPaths:
+            try:
+                sizes.append(self.GetImageSize(path))
+            except IOError:
+                sizes.append(None)
+
+        return sizes
+
+    def _SidecarPath(self, ImageDir):
+        return os.path.join(ImageDir, SidecarFilename)
+
+    def _LoadSidecar(self, ImageDir):
+        '''Add the sizes recorded in the directory's sidecar file to the cache, once per directory'''
+
+        with self._lock:
+            if ImageDir in self._loaded_dirs:
+                return
+
+            self._loaded_dirs.add(ImageDir)
+
+        SidecarPath = self._SidecarPath(ImageDir)
+        if not os.path.exists(SidecarPath):
+            return
+
+        try:
+            with open(SidecarPath, 'r') as fp:
+                records = json.load(fp)
+        except (IOError, ValueError):
+            logging.getLogger(__name__).warning('Ignoring unreadable image size sidecar: ' + SidecarPath)
+            return
+
+        with self._lock:
+            for (filename, record) in records.items():
+                path = os.path.join(ImageDir, filename)
+                if path not in self._sizes:
+                    self._sizes[path] = (record[0], record[1], (record[2], record[3]))
+
+    def SaveSidecars(self):
+        '''Write the cached sizes of each directory with new entries to its sidecar file'''
+
+        with self._lock:
+            dirs = self._dirty_dirs
+            self._dirty_dirs = set()
+
+        # Keep the sizes already recorded in the sidecar files we replace
+        for ImageDir in dirs:
+            self._LoadSidecar(ImageDir)
+
+        with self._lock:
+            records_by_dir = {}
+            for ImageDir in dirs:
+                records_by_dir[ImageDir] = {}
+
+            for (path, entry) in self._sizes.items():
+                ImageDir = os.path.dirname(path)
+                if ImageDir in records_by_dir:
+                    records_by_dir[ImageDir][os.path.basename(path)] = [entry[0], entry[1], entry[2][0], entry[2][1]]
+
+        for (ImageDir, records) in records_by_dir.items():
+            SidecarPath = self._SidecarPath(ImageDir)
+            TempPath = SidecarPath + '.%d.tmp' % os.getpid()
+            try:
+                with open(TempPath, 'w') as fp:
+                    json.dump(records, fp)
+
+                os.replace(TempPath, SidecarPath)
+            except (IOError, OSError):
+                logging.getLogger(__name__).info('Unable to write image size sidecar: ' + SidecarPath)
+                if os.path.exists(TempPath):
+                    os.remove(TempPath)
+
+
+# Cache used by core.GetImageSize
+DefaultCache = ImageSizeCache()
+
+
+def GetImageSize(ImageFullPath):
+    '''
+    :returns: Image (height, width) from the default cache
+    :rtype: tuple
+    '''
+    return DefaultCache.GetImageSize(ImageFullPath)
+
+
+def GetImageSizes(ImageFullPaths, pool=None):
+    '''
+    :returns: List of image (height, width) from the default cache, None for images that could not be read
+    :rtype: list
+    '''
+    return DefaultCache.GetImageSizes(ImageFullPaths, pool=pool)
@@ -1,3 +1,4 @@
+import collections.abc
 import logging
 import os
 
@@ -6,12 +7,24 @@ import nornir_imageregistration.tile
 import nornir_imageregistration.transforms.factory as tfactory
 #import nornir_pools
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 
 from . import alignment_record
 from . import core
 from . import spatial
 
 
+class LayoutSolvers(object):
+    '''Strategies for positioning the nodes of a layout so they agree with the offsets between nodes'''
+    
+    RELAX = 'relax'  # Iteratively move each node along its weighted net tension vector, see RelaxLayout
+    LEAST_SQUARES = 'least-squares'  # Solve the weighted least squares positions directly, see SolveLayoutLeastSquares
+    
+    Solvers = [RELAX, LEAST_SQUARES]
+
+
 def _sort_array_on_column(a, iCol, ascending=False):
     '''Sort the numpy array on the specfied column'''
     
@@ -159,9 +172,94 @@ class LayoutPosition(object):
         return "%d y:%g x:%g" % (self._ID, self.Position[0], self.Position[1]) 
         
 
+class LayoutNode(LayoutPosition):
+    '''A view of one node in a Layout.  Positions and offsets are read from and written to the layout's arrays.'''
+    
+    @property
+    def Position(self):
+        '''Our position in the layout'''
+        return self._layout._positions[self._layout._node_index[self._ID]].copy()
+    
+    @Position.setter
+    def Position(self, value):
+        '''Our position in the layout'''
+        value = np.asarray(value)
+        assert(value.ndim == 1)
+        self._layout._positions[self._layout._node_index[self._ID]] = value
+    
+    @property
+    def OffsetArray(self):
+        '''Read-only use please'''
+        return self._layout._NodeOffsetArray(self._ID)
+    
+    @property
+    def _OffsetArray(self):
+        return self._layout._NodeOffsetArray(self._ID)
+    
+    def SetOffset(self, ID, offset, weight):
+        '''Set the offset between this node and ID.  Offsets are stored once for both nodes, so this also sets the inverse offset of ID.'''
+        self._layout.SetOffset(self._ID, ID, offset, weight)
+        
+    def ScaleOffsetWeightsByPosition(self, connected_positions):
+        
+        position_difference = self.TensionVectors(connected_positions)
+        distance = np.sqrt(np.sum(position_difference ** 2, 1))
+        medianDistance = np.median(distance)
+        
+        new_weight = distance / medianDistance
+        
+        for (ID, weight) in zip(self.ConnectedIDs, new_weight):
+            self._layout._SetWeight(self._ID, ID, weight)
+            
+        return
+    
+    def __init__(self, layout, ID):
+        
+        self._layout = layout
+        self._ID = ID
+        
+
+class _LayoutNodes(collections.abc.Mapping):
+    '''Read-only mapping of node ID to LayoutNode views, iterated in the order nodes were created'''
+    
+    def __init__(self, layout):
+        self._layout = layout
+        
+    def __getitem__(self, ID):
+        if not ID in self._layout._node_index:
+            raise KeyError(ID)
+        
+        return LayoutNode(self._layout, ID)
+    
+    def __contains__(self, ID):
+        return ID in self._layout._node_index
+    
+    def __iter__(self):
+        return iter(self._layout._node_index)
+    
+    def __len__(self):
+        return len(self._layout._node_index)
+
+
+def _EnsureCapacity(a, required):
+    '''Return an array with at least the required number of rows, doubling the allocation when it must grow'''
+    
+    if a.shape[0] >= required:
+        return a
+    
+    new_shape = list(a.shape)
+    new_shape[0] = max(required, a.shape[0] * 2, 16)
+    grown = np.empty(new_shape, dtype=a.dtype)
+    grown[:a.shape[0]] = a
+    return grown
+
+
 class Layout(object):
     '''Arranges tiles in 2D space to form a mosaic.
-       IDs of nodes should be incremental and match the row index of the array'''
+    
+       Node positions are stored in a single array, one row per node in the order nodes were created.  Offsets are
+       stored once per pair of nodes in an edge list of node rows, offsets and weights.  Offsets are defined as
+       Position[B] - Position[A].  Tension calculations operate on the entire edge list at once.'''
     
     # Offsets into node position array
     iNodeID = 0
@@ -171,6 +269,28 @@ class Layout(object):
     @property
     def nodes(self):
         return self._nodes
+    
+    @property
+    def IDs(self):
+        '''Node IDs in the order the nodes were created'''
+        return self._node_IDs[:self._num_nodes]
+    
+    @property
+    def _positions(self):
+        return self._position_array[:self._num_nodes]
+    
+    @property
+    def _edges(self):
+        '''Row of node A and node B for each offset'''
+        return self._edge_array[:self._num_edges]
+    
+    @property
+    def _edge_offsets(self):
+        return self._edge_offset_array[:self._num_edges]
+    
+    @property
+    def _edge_weights(self):
+        return self._edge_weight_array[:self._num_edges]
 
     @property    
     def MaxWeightedTension(self):
@@ -186,81 +306,156 @@ class Layout(object):
         ''':rtype: bool
            :return: True if layout contains the ID
         '''
-        return ID in self._nodes
+        return ID in self._node_index
     
     def SetOffset(self, A_ID, B_ID, offset, weight=1.0):
         '''Specify the expected offset between two nodes in the spring model'''
-        A = self.nodes[A_ID]
-        B = self.nodes[B_ID]
-        A.SetOffset(B.ID, offset, weight)
-        B.SetOffset(A.ID, -offset, weight)
+        
+        if np.isnan(weight):
+            raise ValueError("weight is not a number")
+        
+        iA = self._node_index[A_ID]
+        iB = self._node_index[B_ID]
+        
+        key = (min(A_ID, B_ID), max(A_ID, B_ID))
+        iEdge = self._edge_index.get(key, None)
+        if iEdge is None:
+            iEdge = self._num_edges
+            self._edge_array = _EnsureCapacity(self._edge_array, iEdge + 1)
+            self._edge_offset_array = _EnsureCapacity(self._edge_offset_array, iEdge + 1)
+            self._edge_weight_array = _EnsureCapacity(self._edge_weight_array, iEdge + 1)
+            self._edge_index[key] = iEdge
+            self._num_edges += 1
+        
+        self._edge_array[iEdge] = (iA, iB)
+        self._edge_offset_array[iEdge] = offset
+        self._edge_weight_array[iEdge] = weight
+        self._adjacency = None
+        
+    def _SetWeight(self, A_ID, B_ID, weight):
+        key = (min(A_ID, B_ID), max(A_ID, B_ID))
+        self._edge_weight_array[self._edge_index[key]] = weight
+        
+    def _Adjacency(self):
+        '''
+        :return: (start, edges, sign) where the edges of node row i are edges[start[i]:start[i+1]].  Sign is 1 if the node
+                 is node A of the edge and -1 if it is node B.
+        '''
+        if self._adjacency is None:
+            edges = self._edges
+            endpoints = np.hstack((edges[:, 0], edges[:, 1]))
+            edge_rows = np.hstack((np.arange(self._num_edges), np.arange(self._num_edges)))
+            signs = np.hstack((np.ones(self._num_edges), -np.ones(self._num_edges)))
+            connected_IDs = self.IDs[np.hstack((edges[:, 1], edges[:, 0]))]
+            
+            # Within a node, order edges by descending connected ID to match the order of LayoutPosition.OffsetArray
+            iSorted = np.lexsort((-connected_IDs, endpoints))
+            start = np.searchsorted(endpoints[iSorted], np.arange(self._num_nodes + 1))
+            self._adjacency = (start, edge_rows[iSorted], signs[iSorted])
+            
+        return self._adjacency
+    
+    def _NodeEdges(self, ID):
+        '''
+        :return: (edge rows, connected node rows, sign) for the node
+        '''
+        iNode = self._node_index[ID]
+        (start, edge_rows, signs) = self._Adjacency()
+        node_edges = edge_rows[start[iNode]:start[iNode + 1]]
+        node_signs = signs[start[iNode]:start[iNode + 1]]
+        edges = self._edges[node_edges]
+        connected = np.where(node_signs > 0, edges[:, 1], edges[:, 0])
+        return (node_edges, connected, node_signs)
+        
+    def _NodeOffsetArray(self, ID):
+        '''Offsets of a node in the [[ID Y X Weight]] form used by LayoutPosition'''
+        
+        (node_edges, connected, node_signs) = self._NodeEdges(ID)
+        offsets = self._edge_offsets[node_edges] * node_signs[:, np.newaxis]
+        offset_array = np.hstack((self.IDs[connected][:, np.newaxis], offsets, self._edge_weights[node_edges][:, np.newaxis]))
+        return _sort_array_on_column(offset_array, 0)
         
     def GetPosition(self, ID):
         '''Return the position array for a set of nodes, sorted by node ID'''
-        return self.nodes[ID].Position
+        return self._positions[self._node_index[ID]].copy()
               
-        
     def GetPositions(self, IDs=None):
         '''Return the position array for a set of nodes, sorted by node ID'''
         
         if IDs is None:
-            IDs = list(self.nodes.keys())
-            IDs.sort()
+            return self._positions[np.argsort(self.IDs, kind='mergesort')]
             
-        positions = np.empty((len(IDs), 2))
-        for i, tileID in enumerate(IDs):
-            positions[i, :] = self.nodes[tileID].Position 
-                                         
-        return positions
+        rows = np.fromiter((self._node_index[ID] for ID in IDs), dtype=np.int64, count=len(IDs))
+        return self._positions[rows]
+    
+    def SetPositions(self, IDs, positions):
+        '''Set the position of each node in IDs to the matching row of positions'''
+        
+        rows = np.fromiter((self._node_index[ID] for ID in IDs), dtype=np.int64, count=len(IDs))
+        self._positions[rows] = positions
+    
+    def _EdgeTensionVectors(self):
+        '''For every offset, the difference between the current position of B relative to A and the offset'''
+        edges = self._edges
+        return (self._positions[edges[:, 1]] - self._positions[edges[:, 0]]) - self._edge_offsets
+    
+    def _SumEdgeVectorsByNode(self, edge_vectors):
+        '''Add each edge's vector to node A and subtract it from node B'''
+        edges = self._edges
+        output = np.zeros((self._num_nodes, 2))
+        for iAxis in range(0, 2):
+            output[:, iAxis] = np.bincount(edges[:, 0], edge_vectors[:, iAxis], minlength=self._num_nodes) - \
+                               np.bincount(edges[:, 1], edge_vectors[:, iAxis], minlength=self._num_nodes)
+        return output
     
     def NetTensionVector(self, ID):
         '''Return the net tension vector of the specified ID'''
         
-        node = self.nodes[ID]
-        linked_node_positions = self.GetPositions(node.ConnectedIDs)
-        
-        return node.NetTensionVector(linked_node_positions)
+        (node_edges, connected, node_signs) = self._NodeEdges(ID)
+        tension = self._EdgeTensionVectors()[node_edges] * node_signs[:, np.newaxis]
+        return np.sum(tension, 0)
     
     def NetTensionVectors(self):
         '''Return all net tension vectors for our nodes'''
-        IDs = list(self.nodes.keys())
-        output = np.zeros((len(IDs), 2))
-        for i in range(0, len(IDs)):
-            ID = IDs[i]
-            output[i, :] = self.NetTensionVector(ID)
-            
-        return output
+        return self._SumEdgeVectorsByNode(self._EdgeTensionVectors())
     
     def WeightedNetTensionVector(self, ID):
         '''Return the net tension vector of the specified ID'''
         
-        node = self.nodes[ID]
-        linked_node_positions = self.GetPositions(node.ConnectedIDs)
-        
-        return node.WeightedNetTensionVector(linked_node_positions)
+        (node_edges, connected, node_signs) = self._NodeEdges(ID)
+        weights = self._edge_weights[node_edges]
+        assert(np.all(weights >= 0))
+        assert(np.all(weights <= 1.0))
+        tension = self._EdgeTensionVectors()[node_edges] * (node_signs * weights)[:, np.newaxis]
+        return np.sum(tension, 0)
         
     def WeightedNetTensionVectors(self):
         '''Return all net tension vectors for our nodes'''
-        IDs = list(self.nodes.keys())
-        IDs.sort()
-        output = np.zeros((len(IDs), 2))
-        for i, TileID in enumerate(IDs):
-            output[i, :] = self.WeightedNetTensionVector(TileID)
-            
-        return output
+        weights = self._edge_weights
+        assert(np.all(weights >= 0))
+        assert(np.all(weights <= 1.0))
+        
+        output = self._SumEdgeVectorsByNode(self._EdgeTensionVectors() * weights[:, np.newaxis])
+        return output[np.argsort(self.IDs, kind='mergesort')]
     
     def _nextID(self):
         '''Generate the next ID number for a position'''
-        return self._nodepositions.shape[0]
+        return self._num_nodes
         
     def CreateNode(self, ID, position):
           
-        assert(not ID in self.nodes)
-        node = LayoutPosition(ID, position)
-        self.nodes[ID] = node
+        assert(not ID in self._node_index)
+        
+        iNode = self._num_nodes
+        self._position_array = _EnsureCapacity(self._position_array, iNode + 1)
+        self._node_IDs = _EnsureCapacity(self._node_IDs, iNode + 1)
+        self._position_array[iNode] = position
+        self._node_IDs[iNode] = ID
+        self._node_index[ID] = iNode
+        self._num_nodes += 1
+        self._adjacency = None
         return
     
-        
     def CreateOffsetNode(self, Existing_ID, New_ID, Offset, Weight):
         '''Add a new position to the layout.  Place the new relative to the specified existing position plus an offset'''
         
@@ -271,19 +466,38 @@ class Layout(object):
     
     def __init__(self):
         
-        self._nodes = {}
+        self._node_index = {}
+        self._node_IDs = np.empty((0))
+        self._position_array = np.empty((0, 2))
+        self._num_nodes = 0
+        
+        self._edge_index = {}
+        self._edge_array = np.empty((0, 2), dtype=np.int64)
+        self._edge_offset_array = np.empty((0, 2))
+        self._edge_weight_array = np.empty((0))
+        self._num_edges = 0
+        
+        self._adjacency = None
+        self._nodes = _LayoutNodes(self)
         return
     
     def Translate(self, vector):
         '''Move all nodes by offset'''
-        for node in self.nodes.values():
-            node.Position = node.Position + vector
-            
+        self._positions[:] += vector
         return
     
     def Merge(self, layoutB):
         '''Merge layout directly into our layout'''
-        self.nodes.update(layoutB.nodes)
+        
+        for (ID, position) in zip(layoutB.IDs, layoutB._positions):
+            if ID in self._node_index:
+                self._positions[self._node_index[ID]] = position
+            else:
+                self.CreateNode(ID, position)
+        
+        B_IDs = layoutB.IDs
+        for (edge, offset, weight) in zip(layoutB._edges, layoutB._edge_offsets, layoutB._edge_weights):
+            self.SetOffset(B_IDs[edge[0]], B_IDs[edge[1]], offset, weight)
     
     @classmethod
     def RelaxNodes(cls, layout_obj, vector_scalar=0.5):
@@ -294,21 +508,32 @@ class Layout(object):
         
         # TODO: Get rid of vector scalar.  Instead calculate the net tension vector at the new position.  Then add them and apply the merged vector. 
         
-        node_movement = np.zeros((len(layout_obj.nodes), 3))
+        weights = layout_obj._edge_weights
+        assert(np.all(weights >= 0))
+        assert(np.all(weights <= 1.0))
         
-        # vectors = {}
+        # Nodes are moved one at a time in creation order, later nodes see the updated positions of earlier nodes
+        (start, edge_rows, signs) = layout_obj._Adjacency()
+        edges = layout_obj._edges
+        offsets = layout_obj._edge_offsets
+        positions = layout_obj._positions
         
-        i = 0
-        first = True
-        for ID, node in layout_obj.nodes.items():
+        node_movement = np.zeros((layout_obj._num_nodes, 3))
+        node_movement[:, 0] = layout_obj.IDs
+        
+        for iNode in range(0, layout_obj._num_nodes):
+            node_edges = edge_rows[start[iNode]:start[iNode + 1]]
+            if node_edges.shape[0] == 0:
+                continue
             
-            vector = layout_obj.WeightedNetTensionVector(ID) * vector_scalar
-            # vectors[ID] = vector
-            row = np.array([ID, vector[0], vector[1]])
-            node_movement[i, :] = row
-            i += 1
-            # Skip the first node, the others can move around it
-            node.Position = node.Position + vector
+            node_signs = signs[start[iNode]:start[iNode + 1]]
+            connected = np.where(node_signs > 0, edges[node_edges, 1], edges[node_edges, 0])
+            
+            tension = (positions[connected] - positions[iNode]) - (offsets[node_edges] * node_signs[:, np.newaxis])
+            vector = np.sum(tension * weights[node_edges][:, np.newaxis], 0) * vector_scalar
+            
+            node_movement[iNode, 1:3] = vector
+            positions[iNode] += vector
         
         return node_movement
     
@@ -320,7 +545,7 @@ class Layout(object):
         '''
 
         layoutB.Translate(offset)
-        layoutA.nodes.update(layoutB.nodes) 
+        layoutA.Merge(layoutB) 
         return layoutA
     
 
@@ -329,19 +554,21 @@ def OffsetsSortedByWeight(layout):
     Return all of a layouts offsets sorted by weight.  
     :return: An array [[TileA_ID, TileB_ID, OffsetY, OffsetX, Weight]] To prevent duplicates we only report offsets where TileA_ID < TileB_ID
     ''' 
-    ret_array = np.empty((0, 5))
-    for node in layout.nodes.values():
-        if node.IsIsolated:
-            continue
-        
-        # Prevent duplicates by skipping IDs less than the nodes
-        iNewRows = node.OffsetArray[:, 0] > node.ID 
-        if not np.any(iNewRows):
-            continue 
-        
-        new_column = np.ones((np.sum(iNewRows), 1)) * node.ID
-        new_rows = np.hstack((new_column, node.OffsetArray[iNewRows, :]))
-        ret_array = np.vstack((ret_array, new_rows))
+    
+    IDs = layout.IDs
+    edges = layout._edges
+    A_IDs = IDs[edges[:, 0]]
+    B_IDs = IDs[edges[:, 1]]
+    offsets = layout._edge_offsets.copy()
+    
+    # Report each offset from the lower ID to the higher ID
+    iFlip = A_IDs > B_IDs
+    offsets[iFlip] = -offsets[iFlip]
+    
+    ret_array = np.hstack((np.minimum(A_IDs, B_IDs)[:, np.newaxis],
+                           np.maximum(A_IDs, B_IDs)[:, np.newaxis],
+                           offsets,
+                           layout._edge_weights[:, np.newaxis]))
         
     return _sort_array_on_column(ret_array, 4)  
 
@@ -361,48 +588,28 @@ def ScaleOffsetWeightsByPopulationRank(original_layout, min_allowed_weight=0, ma
     if min_allowed_weight >= max_allowed_weight:
         raise ValueError("Min allowed weight must be below the max allowed weight")
     
-    maxWeight = np.NaN
-    minWeight = np.NaN
+    # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
+    weights = original_layout._edge_weights
+    if weights.shape[0] == 0:
+        return
     
-    first = True
-    for node in original_layout.nodes.values():
-        # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
-        if node.IsIsolated:
-            continue
-        
-        weights = node.OffsetArray[:, LayoutPosition.iOffsetWeight]
-        
-        if first:
-            first = False
-            minWeight = np.min(weights)
-            maxWeight = np.max(weights)
-        else:
-            minWeight = min((minWeight, np.min(weights)))
-            maxWeight = max((maxWeight, np.max(weights)))
+    minWeight = np.min(weights)
+    maxWeight = np.max(weights)
     
     # All the weights are equal... odd
     if maxWeight == minWeight:
-        for node in original_layout.nodes.values():
-            if node.IsIsolated:
-                continue
-            
-            node.OffsetArray[:, LayoutPosition.iOffsetWeight] = max_allowed_weight
+        weights[:] = max_allowed_weight
         return
     
     maxWeight -= minWeight
     
     allowed_weight_range = max_allowed_weight - min_allowed_weight
     
-    for node in original_layout.nodes.values():
-        # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
-        if node.IsIsolated:
-            continue
-        
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] = (node.OffsetArray[:, LayoutPosition.iOffsetWeight] - minWeight) / maxWeight
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] *= allowed_weight_range
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] += min_allowed_weight
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] >= min_allowed_weight))
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] <= max_allowed_weight))
+    weights[:] = (weights - minWeight) / maxWeight
+    weights *= allowed_weight_range
+    weights += min_allowed_weight
+    assert(np.alltrue(weights >= min_allowed_weight))
+    assert(np.alltrue(weights <= max_allowed_weight))
                 
     return 
 
@@ -435,18 +642,219 @@ def RelaxLayout(layout_obj, max_tension_cutoff=5, max_iter=50):
 
         
 
+def _CauchyWeights(residuals, min_residual_scale):
+    '''Scale factors for IRLS which down-weight offsets whose residual is large compared to the typical residual'''
+    
+    # Median absolute deviation scaled to approximate the standard deviation of normally distributed residuals
+    residual_scale = max(1.4826 * np.median(residuals), min_residual_scale)
+    c = 2.385 * residual_scale
+    return 1.0 / (1.0 + (residuals / c) ** 2)
+
+
+def SolveLayoutLeastSquares(layout_obj, anchor_ID=None, reweight_iterations=0, min_residual_scale=1.0):
+    '''
+    Position every node so the offsets between nodes are satisfied in the weighted least squares sense.  Each offset
+    contributes weight * (|Position[B] - Position[A] - offset|^2).  The normal equations form a sparse graph laplacian
+    which is solved directly, once for Y and once for X.  One node of each connected group of nodes is anchored at its
+    current position, nodes without offsets are not moved.
+    
+    :param Layout layout_obj: The layout to solve
+    :param int anchor_ID: Node which keeps its position.  Defaults to the lowest ID in each connected group
+    :param int reweight_iterations: Number of iteratively reweighted rounds.  Each round scales offset weights down
+                                    according to their residual in the previous solution to reduce the influence of
+                                    incorrect offsets.  The weights stored in the layout are not changed.
+    :param float min_residual_scale: Lower bound, in pixels, of the residual scale used when reweighting
+    :return: layout_obj
+    '''
+    
+    offsets = OffsetsSortedByWeight(layout_obj)
+    offsets = offsets[np.logical_and(np.isfinite(offsets[:, 4]), offsets[:, 4] > 0), :]
+    if offsets.shape[0] == 0:
+        return layout_obj
+    
+    IDs = np.array(sorted(layout_obj.nodes.keys()))
+    iA = np.searchsorted(IDs, offsets[:, 0])
+    iB = np.searchsorted(IDs, offsets[:, 1])
+    desired = offsets[:, 2:4]
+    weights = offsets[:, 4]
+    
+    num_nodes = IDs.shape[0]
+    num_offsets = offsets.shape[0]
+    
+    positions = layout_obj.GetPositions(IDs)
+    
+    # Incidence matrix, each row is the difference Position[B] - Position[A] for one offset
+    rows = np.hstack((np.arange(num_offsets), np.arange(num_offsets)))
+    cols = np.hstack((iA, iB))
+    values = np.hstack((-np.ones(num_offsets), np.ones(num_offsets)))
+    incidence = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(num_offsets, num_nodes))
+    
+    # Anchor one node per connected group, otherwise the system is singular
+    adjacency = scipy.sparse.csr_matrix((np.ones(num_offsets), (iA, iB)), shape=(num_nodes, num_nodes))
+    (num_groups, group_labels) = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+    
+    anchored = np.zeros(num_nodes, dtype=bool)
+    for iGroup in range(num_groups):
+        anchored[np.flatnonzero(group_labels == iGroup)[0]] = True
+    
+    if not anchor_ID is None:
+        iAnchor = np.searchsorted(IDs, anchor_ID)
+        anchored[group_labels == group_labels[iAnchor]] = False
+        anchored[iAnchor] = True
+    
+    free = np.logical_not(anchored)
+    if not np.any(free):
+        return layout_obj
+    
+    # Isolated nodes form their own group and are anchored, so every free node has at least one offset
+    incidence_free = incidence[:, free].tocsc()
+    incidence_anchored = incidence[:, anchored].tocsc()
+    
+    solve_weights = weights.copy()
+    for iRound in range(0, reweight_iterations + 1):
+        W = scipy.sparse.diags(solve_weights)
+        laplacian = (incidence_free.T * W * incidence_free).tocsc()
+        rhs = incidence_free.T * (W * (desired - (incidence_anchored * positions[anchored, :])))
+        
+        solved = scipy.sparse.linalg.spsolve(laplacian, rhs)
+        positions[free, :] = np.reshape(solved, (-1, 2))
+        
+        if iRound < reweight_iterations:
+            residuals = np.sqrt(np.sum(((incidence * positions) - desired) ** 2, 1))
+            solve_weights = weights * _CauchyWeights(residuals, min_residual_scale)
+    
+    layout_obj.SetPositions(IDs, positions)
+    
+    return layout_obj
+
+
+class _LayoutComponents(object):
+    '''
+    Disjoint sets of layout nodes used to build a layout one offset at a time.  Each node stores its position relative
+    to its parent node.  The root node of each set stores its position in the set's own coordinate frame.  Merging two
+    sets translates an entire set by updating the position of a single root node.
+    
+    Nodes are dense indices.  Each set also records the order its nodes were added in, as a linked list, and the order
+    the sets were created in.
+    '''
+    
+    def __init__(self, num_nodes):
+        self._parent = list(range(num_nodes))
+        self._size = [0] * num_nodes
+        self._offset = np.zeros((num_nodes, 2))
+        
+        # Linked list of nodes in the order they were added to the set, head and tail are valid for root nodes
+        self._next = [-1] * num_nodes
+        self._head = list(range(num_nodes))
+        self._tail = list(range(num_nodes))
+        self._sequence = [-1] * num_nodes
+        self._num_sets = 0
+        
+    def Contains(self, i):
+        return self._size[self.Find(i)] > 0
+        
+    def Find(self, i):
+        '''Return the root node of the set containing i'''
+        path = []
+        while self._parent[i] != i:
+            path.append(i)
+            i = self._parent[i]
+            
+        root = i
+        
+        # Nodes nearest the root are compressed first so each parent's offset is already relative to the root
+        for node in reversed(path):
+            parent = self._parent[node]
+            if parent != root:
+                self._offset[node] += self._offset[parent]
+            self._parent[node] = root
+            
+        return root
+    
+    def Position(self, i):
+        '''Position of a node in the coordinate frame of its set'''
+        root = self.Find(i)
+        if root == i:
+            return self._offset[root].copy()
+        
+        return self._offset[i] + self._offset[root]
+    
+    def Create(self, i, position):
+        '''Create a new set containing only node i'''
+        self._offset[i] = position
+        self._size[i] = 1
+        self._sequence[i] = self._num_sets
+        self._num_sets += 1
+        
+    def Add(self, existing, new, position):
+        '''Add node new to the set containing existing at the position'''
+        root = self.Find(existing)
+        self._parent[new] = root
+        self._offset[new] = position - self._offset[root]
+        self._size[root] += 1
+        self._next[self._tail[root]] = new
+        self._tail[root] = new
+        
+    def Merge(self, rootA, rootB, translation):
+        '''Translate every node in set B and add them to set A.  The merged set keeps the creation order of set A
+        :return: The root of the merged set
+        '''
+        
+        B_position = self._offset[rootB] + translation
+        
+        if self._size[rootA] >= self._size[rootB]:
+            (root, child) = (rootA, rootB)
+            self._offset[rootB] = B_position - self._offset[rootA]
+        else:
+            (root, child) = (rootB, rootA)
+            self._offset[rootA] = self._offset[rootA] - B_position
+            self._offset[rootB] = B_position
+            
+        self._parent[child] = root
+        self._size[root] = self._size[rootA] + self._size[rootB]
+        
+        self._next[self._tail[rootA]] = self._head[rootB]
+        (self._head[root], self._tail[root]) = (self._head[rootA], self._tail[rootB])
+        self._sequence[root] = self._sequence[rootA]
+        return root
+    
+    def Members(self, root):
+        '''Nodes of a set in the order they were added'''
+        members = []
+        i = self._head[root]
+        while i >= 0:
+            members.append(i)
+            i = self._next[i]
+            
+        return members
+    
+    def Roots(self):
+        '''Roots of all sets in the order the sets were created'''
+        roots = [i for i in range(0, len(self._parent)) if self._parent[i] == i and self._size[i] > 0]
+        return sorted(roots, key=lambda i: self._sequence[i])
+    
+
 def BuildLayoutWithHighestWeightsFirst(original_layout):
     '''
     Constructs a mosaic by sorting all of the match results according to strength. 
     
-    :param dict tiles: Dictionary of tile objects containing alignment records to other tiles
+    Offsets are added from highest to lowest weight.  Groups of connected tiles are tracked with a disjoint set so
+    each offset only needs to look up the groups of its two tiles, and merging two groups only updates the position
+    of one group.  Tile positions are calculated once after all offsets are added.
+    
+    :param Layout original_layout: Layout containing the offsets between tiles
+    :return: A layout of the first group of connected tiles
     '''
 
-    placedTiles = dict()
-    
     sorted_offsets = OffsetsSortedByWeight(original_layout) 
-
-    LayoutList = [] 
+    
+    node_index = original_layout._node_index
+    components = _LayoutComponents(len(node_index))
+    
+    # The offsets in the order they would be set on the layout, (iA, iB, offset, weight)
+    layout_offsets = []
+    mapped_pairs = set()
+    
     for iRow in range(0, sorted_offsets.shape[0]):
         row = sorted_offsets[iRow, :]      
         A_ID = row[0]
@@ -461,43 +869,57 @@ def BuildLayoutWithHighestWeightsFirst(original_layout):
         if np.isnan(Weight):
             print("Skip: Invalid weight, not a number")
             continue
+        
+        iA = node_index[A_ID]
+        iB = node_index[B_ID]
+        
+        AInLayout = components.Contains(iA)
+        BInLayout = components.Contains(iB)
 
-        ALayout = GetLayoutForID(LayoutList, A_ID)
-        BLayout = GetLayoutForID(LayoutList, B_ID)
-
-        if ALayout is None and BLayout is None:
-            new_layout = Layout()
-            new_layout.CreateNode(A_ID, np.zeros((2)))
-            new_layout.CreateNode(B_ID, offset)
-            new_layout.SetOffset(A_ID, B_ID, offset, Weight) 
-            LayoutList.append(new_layout)
+        if not AInLayout and not BInLayout:
+            components.Create(iA, np.zeros((2)))
+            components.Add(iA, iB, offset)
+            layout_offsets.append((iA, iB, offset, Weight))
             print("New layout")
 
-        elif (not ALayout is None) and (not BLayout is None):
+        elif AInLayout and BInLayout:
             # Need to merge the layouts? See if they are the same
-            if ALayout == BLayout:
+            ARoot = components.Find(iA)
+            BRoot = components.Find(iB)
+            if ARoot == BRoot:
                 # Already mapped
-                if B_ID in ALayout.nodes[A_ID].ConnectedIDs: 
+                if (iA, iB) in mapped_pairs: 
                     print("Skip: Already mapped")
-                else:
-                    ALayout.SetOffset(A_ID, B_ID, offset, Weight)
+                    continue
             else:
-                MergeLayoutsWithNodeOffset(ALayout, BLayout, A_ID, B_ID, offset, Weight)
+                translation = (offset + components.Position(iA)) - components.Position(iB)
+                components.Merge(ARoot, BRoot, translation)
                 print("Merged")
-                LayoutList.remove(BLayout)
+                
+            layout_offsets.append((iA, iB, offset, Weight))
+                
+        elif BInLayout:
+            # Matches Layout.CreateOffsetNode(B_ID, A_ID, -offset, Weight)
+            components.Add(iB, iA, components.Position(iB) - offset)
+            layout_offsets.append((iA, iB, -offset, Weight))
         else:
+            # Matches Layout.CreateOffsetNode(A_ID, B_ID, offset, Weight)
+            components.Add(iA, iB, components.Position(iA) + offset)
+            layout_offsets.append((iB, iA, offset, Weight))
             
-            if ALayout is None and not BLayout is  None:
-                BLayout.CreateOffsetNode(B_ID, A_ID, -offset, Weight)
-                # We'll pick it up on the next pass
-                # print("Skip: Getting it next time")
-                # continue
-                
-            else:
-                ALayout.CreateOffsetNode(A_ID, B_ID, offset, Weight)
+        mapped_pairs.add((iA, iB))
 
     # OK, we should have a single list of layouts
-    LargestLayout = LayoutList[0]
+    root = components.Roots()[0]
+    
+    IDs = original_layout.IDs
+    LargestLayout = Layout()
+    for i in components.Members(root):
+        LargestLayout.CreateNode(IDs[i], components.Position(i))
+        
+    for (iA, iB, offset, Weight) in layout_offsets:
+        if components.Find(iA) == root:
+            LargestLayout.SetOffset(IDs[iA], IDs[iB], offset, Weight)
 
     return LargestLayout
 
@@ -206,10 +206,10 @@ class Mosaic(object):
         return values
          
 
-    def ArrangeTilesWithTranslate(self, tilesPath, excess_scalar=1.5, usecluster=False):
+    def ArrangeTilesWithTranslate(self, tilesPath, excess_scalar=1.5, usecluster=False, LayoutSolver=None):
 
         # We don't need to sort, but it makes debugging easier, and I suspect ensuring tiles are registered in the same order may increase reproducability
-        (layout, tiles) = arrange.TranslateTiles(self._TransformsSortedByKey(), self.CreateTilesPathList(tilesPath), excess_scalar)
+        (layout, tiles) = arrange.TranslateTiles(self._TransformsSortedByKey(), self.CreateTilesPathList(tilesPath), excess_scalar, LayoutSolver=LayoutSolver)
         return LayoutToMosaic(layout, tiles)
     
     def RefineLayout(self, tilesPath, usecluster=False):
@@ -225,12 +225,13 @@ class Mosaic(object):
         return score
 
 
-    def AssembleTiles(self, tilesPath, FixedRegion=None, usecluster=False, requiredScale=None):
+    def AssembleTiles(self, tilesPath, FixedRegion=None, usecluster=False, requiredScale=None, StorageDtype=None):
         '''Create a single large mosaic.
         :param str tilesPath: Directory containing tiles referenced in our transform
         :param array FixedRegion: [MinY MinX MaxY MaxX] boundary of image to assemble
         :param boolean usecluster: Offload work to other threads or nodes if true
         :param float requiredScale: Optimization parameter, eliminates need for function to compare input images with transform boundaries to determine scale
+        :param dtype StorageDtype: dtype of the assembled image, defaults to core.StorageDtype
         '''
 
         # Left off here, I need to split this function so that FixedRegion has a consistent meaning
@@ -246,7 +247,24 @@ class Mosaic(object):
 
         if usecluster and len(tilesPathList) > 1:
             cpool = nornir_pools.GetGlobalMultithreadingPool()
-            return at.TilesToImageParallel(self._TransformsSortedByKey(), tilesPathList, pool=cpool, FixedRegion=FixedRegion, requiredScale=requiredScale)
+            return at.TilesToImageParallel(self._TransformsSortedByKey(), tilesPathList, pool=cpool, FixedRegion=FixedRegion, requiredScale=requiredScale, StorageDtype=StorageDtype)
         else:
             # return at.TilesToImageParallel(self.ImageToTransform.values(), tilesPathList)
-            return at.TilesToImage(self._TransformsSortedByKey(), tilesPathList, FixedRegion=FixedRegion, requiredScale=requiredScale)
+            return at.TilesToImage(self._TransformsSortedByKey(), tilesPathList, FixedRegion=FixedRegion, requiredScale=requiredScale, StorageDtype=StorageDtype)
+
+    def AssembleTilesToFile(self, tilesPath, OutputImageFullPath, OutputMaskFullPath=None, ChunkSize=None, MemoryBudget=None, requiredScale=None, StorageDtype=None):
+        '''Create a single large mosaic in .npy files on disk.  The output is assembled in chunks so the full mosaic is never held in memory.
+        :param str tilesPath: Directory containing tiles referenced in our transform
+        :param str OutputImageFullPath: .npy file to write the image to
+        :param str OutputMaskFullPath: .npy file to write the mask to, defaults to OutputImageFullPath with a _mask suffix
+        :param int ChunkSize: Width and height of each chunk in output pixels.  Calculated from MemoryBudget if not specified
+        :param int MemoryBudget: Bytes available for assembly, defaults to assemble_tiles.DefaultMemoryBudget
+        :param float requiredScale: Optimization parameter, eliminates need for function to compare input images with transform boundaries to determine scale
+        :param dtype StorageDtype: dtype of the assembled image, defaults to core.StorageDtype
+        :return: (image, mask) as read-only memory mapped arrays
+        '''
+
+        tilesPathList = self.CreateTilesPathList(tilesPath)
+
+        return at.TilesToImageChunked(self._TransformsSortedByKey(), tilesPathList, OutputImageFullPath, OutputMaskFullPath=OutputMaskFullPath,
+                                      ChunkSize=ChunkSize, MemoryBudget=MemoryBudget, requiredScale=requiredScale, StorageDtype=StorageDtype)
@@ -90,6 +90,16 @@ def __CreateArgParser(ExecArgs=None):
                         dest='minoverlap'
                         )
 
+    parser.add_argument('-mode', '-m',
+                        action='store',
+                        required=False,
+                        type=str,
+                        default=sb.AngleSearchMode.BRUTE,
+                        choices=sb.AngleSearchMode.Modes,
+                        help='Angle search strategy.  brute scores every angle, fourier-mellin scores only the strongest candidates from a log-polar correlation, pyramid sweeps angles on downsampled images and refines the strongest candidates',
+                        dest='searchmode'
+                        )
+
     return parser
 
 def ParseArgs(ExecArgs=None):
@@ -178,7 +188,7 @@ def Execute(ExecArgs=None):
 
     stosArgs = StosBruteArgs(Args)
 
-    alignRecord = sb.SliceToSliceBruteForce(stosArgs.ControlImage, stosArgs.WarpedImage, stosArgs.ControlMask, stosArgs.WarpedMask, MinOverlap=Args.minoverlap)
+    alignRecord = sb.SliceToSliceBruteForce(stosArgs.ControlImage, stosArgs.WarpedImage, stosArgs.ControlMask, stosArgs.WarpedMask, MinOverlap=Args.minoverlap, SearchMode=Args.searchmode)
 
     if not (stosArgs.ControlMask is None or stosArgs.WarpedMask is None):
         stos = alignRecord.ToStos(stosArgs.ControlImage,
@@ -62,6 +62,23 @@ def __CreateArgParser(ExecArgs=None):
                         dest='scalar'
                         );
 
+    parser.add_argument('-order',
+                        action='store',
+                        required=False,
+                        type=int,
+                        default=3,
+                        help='Order of the spline used to interpolate the warped image',
+                        dest='order'
+                        );
+
+    parser.add_argument('-stream',
+                        action='store_true',
+                        required=False,
+                        default=False,
+                        help='Warp the image in tiles and write them to a memory mapped .npy output file instead of warping the whole image in memory',
+                        dest='stream'
+                        );
+
     return parser;
 
 def ParseArgs(ExecArgs=None):
@@ -100,6 +117,9 @@ def ValidateArgs(Args):
     if not os.path.exists(Args.inputpath):
         OnUseError("Input stos file not found: " + Args.inputpath)
 
+    if Args.stream and os.path.splitext(Args.outputpath)[1].lower() != '.npy':
+        OnUseError("Streamed output must be a .npy file: " + Args.outputpath)
+
 def Execute(ExecArgs=None):
     if ExecArgs is None:
         ExecArgs = sys.argv[1:]
@@ -108,11 +128,13 @@ def Execute(ExecArgs=None):
 
     ValidateArgs(Args)
 
-    nornir_imageregistration.assemble.TransformStos(transformFullpath=Args.inputpath,
+    nornir_imageregistration.assemble.TransformStos(transformData=Args.inputpath,
                                    OutputFilename=Args.outputpath,
                                    fixedImageFilename=Args.fixedimagepath,
                                    warpedImageFilename=Args.warpedimagepath,
-                                   scalar=Args.scalar)
+                                   scalar=Args.scalar,
+                                   order=Args.order,
+                                   Stream=Args.stream)
 
     if os.path.exists(Args.outputpath):
         print("Wrote: " + Args.outputpath)
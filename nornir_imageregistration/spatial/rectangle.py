@@ -83,6 +83,22 @@ class RectangleSet():
         rset = RectangleSet(rects_array)
         return rset
     
+    def Intersect(self, bounds):
+        '''
+        :param object bounds: Rectangle or (MinY, MinX, MaxY, MaxX) to query
+        :return: Indicies of the rectangles passed to the Create function which overlap bounds
+        :rtype: ndarray
+        '''
+
+        if isinstance(bounds, Rectangle):
+            bounds = bounds.BoundingBox
+
+        rects = self._rects_array
+        overlapping = np.logical_and(np.logical_and(rects['MinY'] < bounds[iRect.MaxY], rects['MaxY'] > bounds[iRect.MinY]),
+                                     np.logical_and(rects['MinX'] < bounds[iRect.MaxX], rects['MaxX'] > bounds[iRect.MinX]))
+
+        return rects['ID'][overlapping]
+
     def _AddOverlapPairToDict(self, OverlapDict, ID, MatchingID):
         
         if ID in OverlapDict:
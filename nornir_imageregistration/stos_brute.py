@@ -5,21 +5,34 @@ Created on Oct 4, 2012
 '''
 import ctypes
 import logging
+import math
 import multiprocessing
 import multiprocessing.sharedctypes
 import os
-from time import sleep
 
 import nornir_imageregistration
 import nornir_imageregistration
 from numpy.fft import fftshift
 
+import nornir_imageregistration.completion_queue as completion_queue
 import nornir_imageregistration.core as core
+import nornir_imageregistration.fft_backend as fft_backend
 import nornir_pools
 import numpy as np
+import scipy.ndimage
 import scipy.ndimage.interpolation as interpolation
 
 
+class AngleSearchMode(object):
+    '''Strategies SliceToSliceBruteForce can use to find candidate rotation angles'''
+    
+    BRUTE = 'brute'  # Score every angle in a 2 degree sweep
+    FOURIER_MELLIN = 'fourier-mellin'  # Estimate rotation from log-polar magnitude spectra and score only the strongest candidates
+    PYRAMID = 'pyramid'  # Sweep on a downsampled image pyramid and refine only the strongest candidates at higher resolutions
+    
+    Modes = [BRUTE, FOURIER_MELLIN, PYRAMID]
+
+
 # from memory_profiler import profile
 def SliceToSliceBruteForce(FixedImageInput,
                            WarpedImageInput,
@@ -29,63 +42,389 @@ def SliceToSliceBruteForce(FixedImageInput,
                            AngleSearchRange=None,
                            MinOverlap=0.75,
                            SingleThread=False,
-                           Cluster=False):
+                           Cluster=False,
+                           SearchMode=None,
+                           NumAngleCandidates=3,
+                           NumPyramidLevels=3,
+                           CorrelationMode=None,
+                           EstimateScale=False):
     '''Given two images this function returns the rotation angle which best aligns them
-       Largest dimension determines how large the images used for alignment should be'''
+       Largest dimension determines how large the images used for alignment should be
+       
+       :param str SearchMode: One of the AngleSearchMode values.  Defaults to AngleSearchMode.BRUTE.  Ignored if AngleSearchRange is specified.
+       :param int NumAngleCandidates: Number of log-polar correlation peaks scored when using AngleSearchMode.FOURIER_MELLIN, or angles kept at each level when using AngleSearchMode.PYRAMID
+       :param int NumPyramidLevels: Number of image pyramid levels used by AngleSearchMode.PYRAMID
+       :param str CorrelationMode: One of core.CorrelationModes, defaults to core.DefaultCorrelationMode.  core.CorrelationModes.MASKED_NCC 
+                                   excludes masked and extrema pixels from the correlation instead of replacing them with noise.
+       :param bool EstimateScale: When using AngleSearchMode.FOURIER_MELLIN also estimate the scale between the images from the log-polar correlation and 
+                                  record it in the ScaleEstimate of the returned AlignmentRecord.  The scale is not applied to the alignment, and 
+                                  is None if no log-polar peak agrees with the best angle.  Angles are scored without scaling, so large scale 
+                                  differences can prevent the correct angle from being found.
+       '''
 
     logger = logging.getLogger(__name__ + '.SliceToSliceBruteForce')
-
-    imFixed = None
-    if isinstance(FixedImageInput, str):
-        imFixed = core.LoadImage(FixedImageInput, FixedImageMaskPath)
-    else:
-        imFixed = FixedImageInput
-
-    imWarped = None
-    if isinstance(WarpedImageInput, str):
-        imWarped = core.LoadImage(WarpedImageInput, WarpedImageMaskPath)
-    else:
-        imWarped = WarpedImageInput
+    
+    Masked = core._ResolveCorrelationMode(CorrelationMode) == core.CorrelationModes.MASKED_NCC
 
     scalar = 1.0
     if not LargestDimension is None:
-        scalar = core.ScalarForMaxDimension(LargestDimension, [imFixed.shape, imWarped.shape])
+        scalar = core.ScalarForMaxDimension(LargestDimension, [_ImageInputShape(FixedImageInput), _ImageInputShape(WarpedImageInput)])
 
-    if scalar < 1.0:
-        imFixed = core.ReduceImage(imFixed, scalar)
-        imWarped = core.ReduceImage(imWarped, scalar)
+    (imFixed, FixedMask) = _LoadImageAndMask(FixedImageInput, FixedImageMaskPath, Masked, scalar)
+    (imWarped, WarpedMask) = _LoadImageAndMask(WarpedImageInput, WarpedImageMaskPath, Masked, scalar)
 
-    # Replace extrema with noise
-    imFixed = core.ReplaceImageExtramaWithNoise(imFixed, ImageMedian=0.5, ImageStdDev=0.25)
-    imWarped = core.ReplaceImageExtramaWithNoise(imWarped, ImageMedian=0.5, ImageStdDev=0.25)
+    imFixed = core.AsComputeDtype(imFixed)
+    imWarped = core.AsComputeDtype(imWarped)
 
+    if Masked:
+        # Mask extrema
+        FixedMask = core.MaskExtrema(imFixed, FixedMask)
+        WarpedMask = core.MaskExtrema(imWarped, WarpedMask)
+    else:
+        # Replace extrema with noise
+        imFixed = core.ReplaceImageExtramaWithNoise(imFixed, ImageMedian=0.5, ImageStdDev=0.25)
+        imWarped = core.ReplaceImageExtramaWithNoise(imWarped, ImageMedian=0.5, ImageStdDev=0.25)
+
+    if SearchMode is None:
+        SearchMode = AngleSearchMode.BRUTE
+
+    FourierMellinCandidates = None
     UserDefinedAngleSearchRange = not AngleSearchRange is None
     if not UserDefinedAngleSearchRange:
-        AngleSearchRange = list(range(-180, 180, 2))
+        if SearchMode == AngleSearchMode.BRUTE or SearchMode == AngleSearchMode.PYRAMID:
+            AngleSearchRange = list(range(-180, 180, 2))
+        elif SearchMode == AngleSearchMode.FOURIER_MELLIN:
+            FourierMellinCandidates = FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=NumAngleCandidates, EstimateScale=EstimateScale)
+            AngleSearchRange = _CandidateAngles(FourierMellinCandidates)
+            logger.info("Fourier-Mellin candidate angles: " + str(AngleSearchRange))
+        else:
+            raise ValueError("Unknown angle search mode %s, expected one of %s" % (str(SearchMode), str(AngleSearchMode.Modes)))
 
-    BestMatch = FindBestAngle(imFixed, imWarped, AngleSearchRange, SingleThread=SingleThread, Cluster=Cluster)
+    # The pyramid search refines its own result
+    RefinementRequired = not UserDefinedAngleSearchRange
+
+    if SearchMode == AngleSearchMode.PYRAMID and not UserDefinedAngleSearchRange:
+        BestMatch = FindBestAnglePyramid(imFixed, imWarped, AngleSearchRange, NumLevels=NumPyramidLevels, NumCandidates=NumAngleCandidates, SingleThread=SingleThread, Cluster=Cluster, 
+                                         FixedMask=FixedMask, WarpedMask=WarpedMask, CorrelationMode=CorrelationMode)
+        RefinementRequired = False
+    else:
+        BestMatch = FindBestAngle(imFixed, imWarped, AngleSearchRange, SingleThread=SingleThread, Cluster=Cluster, FixedMask=FixedMask, WarpedMask=WarpedMask, CorrelationMode=CorrelationMode)
 
     # Find the best match
 
-    if not UserDefinedAngleSearchRange:
-        BestRefinedMatch = FindBestAngle(imFixed, imWarped, [(x * 0.1) + BestMatch.angle - 1 for x in range(0, 20)], SingleThread=SingleThread)
+    if RefinementRequired:
+        BestRefinedMatch = FindBestAngle(imFixed, imWarped, [(x * 0.1) + BestMatch.angle - 1 for x in range(0, 20)], SingleThread=SingleThread, 
+                                         FixedMask=FixedMask, WarpedMask=WarpedMask, CorrelationMode=CorrelationMode)
     else:
         BestRefinedMatch = BestMatch
 
+    ScaleEstimate = None
+    if EstimateScale and FourierMellinCandidates:
+        ScaleEstimate = _CandidateScale(FourierMellinCandidates, BestRefinedMatch.angle)
+        logger.info("Fourier-Mellin scale estimate: %s" % str(ScaleEstimate))
+
     if scalar > 1.0:
         AdjustedPeak = (BestRefinedMatch.peak[0] * scalar, BestRefinedMatch.peak[1] * scalar)
         BestRefinedMatch = nornir_imageregistration.AlignmentRecord(AdjustedPeak, BestRefinedMatch.weight, BestRefinedMatch.angle)
 
+    if ScaleEstimate is not None:
+        BestRefinedMatch = nornir_imageregistration.AlignmentRecord(BestRefinedMatch.peak, BestRefinedMatch.weight, BestRefinedMatch.angle, ScaleEstimate=ScaleEstimate)
+
    # BestRefinedMatch.CorrectPeakForOriginalImageSize(imFixed.shape, imWarped.shape)
 
     return BestRefinedMatch
 
 
-def ScoreOneAngle(imFixed, imWarped, angle, fixedStats=None, warpedStats=None, FixedImagePrePadded=True, MinOverlap=0.75):
-    '''Returns an alignment score for a fixed image and an image rotated at a specified angle'''
+def _ImageInputShape(ImageInput):
+    '''
+    :return: Shape of an image or image file, read from the file header if needed
+    '''
+    if isinstance(ImageInput, str):
+        return core.GetImageSize(ImageInput)
+    
+    return ImageInput.shape
+
+
+def _LoadImageAndMask(ImageInput, ImageMaskPath, Masked, scalar=1.0):
+    '''
+    Image files are decoded at reduced resolution and converted to core.ComputeDtype only after they are reduced.
+    :param bool Masked: Load the mask separately instead of filling the masked pixels with noise
+    :param float scalar: Resize the image and mask by this amount
+    :return: (image, mask).  The mask is None unless Masked is True and a mask path was specified.
+    '''
+    
+    if scalar >= 1.0:
+        scalar = None
+    
+    if not isinstance(ImageInput, str):
+        if scalar is not None:
+            ImageInput = core.ReduceImage(ImageInput, scalar)
+        return (ImageInput, None)
+    
+    image = core.ReadImage(ImageInput, dtype=core.ComputeDtype, Scalar=scalar)
+    
+    mask = None
+    if ImageMaskPath is not None:
+        mask = core.LoadImageMask(ImageMaskPath, Scalar=scalar)
+        if mask is not None:
+            assert(mask.shape == image.shape)
+        
+    if not Masked and mask is not None:
+        image = core.RandomNoiseMask(image, mask)
+        mask = None
+        
+    return (image, mask)
+
+
+def _PadToSquare(image, size):
+    '''Center the image in a size x size array filled with the image mean'''
+    
+    PaddedImage = np.full((size, size), np.mean(image), dtype=core.ComputeDtype)
+    
+    YOffset = (size - image.shape[0]) // 2
+    XOffset = (size - image.shape[1]) // 2
+    PaddedImage[YOffset:YOffset + image.shape[0], XOffset:XOffset + image.shape[1]] = image
+    
+    return PaddedImage
+
+
+def _FullMagnitudeSpectrum(HalfSpectrum, size):
+    '''
+    :return: The size x size magnitude spectrum of a real image from its half spectrum.  The spectrum of a real image is
+             conjugate symmetric, so the missing columns are the magnitudes at the negated frequencies.
+    '''
+    
+    HalfWidth = HalfSpectrum.shape[1]
+    Magnitude = np.empty((size, size), dtype=core.ComputeDtype)
+    Magnitude[:, :HalfWidth] = np.absolute(HalfSpectrum)
+    
+    NegatedRows = (-np.arange(size)) % size
+    NegatedColumns = size - np.arange(HalfWidth, size)
+    Magnitude[:, HalfWidth:] = Magnitude[NegatedRows][:, NegatedColumns]
+    return Magnitude
+
+
+def LogPolarMagnitudeSpectrum(image, size, NumAngles, NumRadii):
+    '''
+    Resample the high-pass filtered magnitude spectrum of an image onto a log-polar grid.  The magnitude spectrum is point symmetric
+    so only angles from 0 to 180 degrees are sampled.  A rotation of the image becomes a circular shift along the angle axis and a 
+    change of scale becomes a shift along the log radius axis.
+    
+    :param ndarray image: Input image
+    :param int size: The image is centered in a square array of this size before the FFT
+    :param int NumAngles: Number of samples between 0 and 180 degrees
+    :param int NumRadii: Number of log spaced radius samples
+    :return: (log-polar image indexed [angle, log radius], natural log of the radius step between columns)
+    :rtype: (ndarray, float)
+    '''
+    
+    PaddedImage = _PadToSquare(image, size)
+    PaddedImage -= np.mean(PaddedImage)
+    
+    # Window to prevent the image borders from adding a strong cross to the spectrum
+    window = np.hanning(size).astype(core.ComputeDtype)
+    PaddedImage *= np.outer(window, window)
+    
+    Magnitude = fftshift(_FullMagnitudeSpectrum(fft_backend.rfft2(PaddedImage), size))
+    del PaddedImage
+    
+    # High-pass emphasis filter.  Low frequencies dominate the spectrum but carry little rotation information.
+    freq = np.cos(np.pi * fftshift(np.fft.fftfreq(size)))
+    X = np.outer(freq, freq)
+    Magnitude *= ((1.0 - X) * (2.0 - X)).astype(core.ComputeDtype)
+    
+    center = size / 2.0
+    MaxRadius = size / 2.0
+    LogStep = np.log(MaxRadius) / NumRadii
+    
+    theta = np.linspace(0, np.pi, NumAngles, endpoint=False)
+    radii = np.exp(np.arange(NumRadii) * LogStep)
+    
+    (Theta, Radii) = np.meshgrid(theta, radii, indexing='ij')
+    coords = np.vstack(((center + (Radii * np.sin(Theta))).flat, (center + (Radii * np.cos(Theta))).flat))
+    
+    LogPolar = interpolation.map_coordinates(Magnitude, coords, order=1, mode='constant', cval=0)
+    return (LogPolar.reshape((NumAngles, NumRadii)), LogStep)
+
+
+def FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=3, EstimateScale=False, MinAngularSamples=512):
+    '''
+    Estimate the rotation between two images with a single phase correlation of their log-polar magnitude spectra.
+    Magnitude spectra cannot distinguish a rotation of theta from theta + 180, callers should score both.
+    
+    :param ndarray imFixed: Fixed image
+    :param ndarray imWarped: Warped image
+    :param int NumCandidates: Number of correlation peaks to return
+    :param bool EstimateScale: Search for peaks at any scale.  If false only peaks near a scale of 1.0 are considered.
+    :param int MinAngularSamples: Minimum number of samples between 0 and 180 degrees, sets the angular resolution
+    :return: List of (angle, scale, strength) tuples sorted by descending strength.  Angle is in degrees from -90 to 90.  Scale is the size of warped image features relative to the fixed image.
+    :rtype: list
+    '''
+    
+    size = int(core.NearestPowerOfTwo(max(max(imFixed.shape), max(imWarped.shape))))
+    NumAngles = max(size, MinAngularSamples)
+    NumRadii = size
+    
+    (FixedLogPolar, LogStep) = LogPolarMagnitudeSpectrum(imFixed, size, NumAngles, NumRadii)
+    (WarpedLogPolar, LogStep) = LogPolarMagnitudeSpectrum(imWarped, size, NumAngles, NumRadii)
+    
+    CorrelationImage = fftshift(core.ImagePhaseCorrelation(FixedLogPolar, WarpedLogPolar))
+    del FixedLogPolar
+    del WarpedLogPolar
+    
+    CenterY = NumAngles // 2
+    CenterX = NumRadii // 2
+    
+    if not EstimateScale:
+        # Only consider peaks within a column of no scale change
+        ScaleMask = np.ones(CorrelationImage.shape, dtype=bool)
+        ScaleMask[:, CenterX - 1:CenterX + 2] = False
+        CorrelationImage[ScaleMask] = CorrelationImage.min()
+    
+    # The angle axis is circular, so peaks may wrap around the top and bottom of the image
+    LocalMaxima = CorrelationImage == scipy.ndimage.maximum_filter(CorrelationImage, size=5, mode='wrap')
+    (PeakY, PeakX) = np.nonzero(LocalMaxima)
+    PeakStrength = CorrelationImage[PeakY, PeakX]
+    
+    iSorted = np.argsort(PeakStrength)[::-1][:NumCandidates]
+    
+    candidates = []
+    for i in iSorted:
+        angle = (PeakY[i] - CenterY) * 180.0 / NumAngles
+        scale = np.exp(-(PeakX[i] - CenterX) * LogStep)
+        candidates.append((float(angle), float(scale), float(PeakStrength[i])))
+    
+    return candidates
+
+
+def FourierMellinCandidateAngles(imFixed, imWarped, NumCandidates=3, EstimateScale=False):
+    '''
+    :return: Candidate angles from FourierMellinRotationCandidates, including the 180 degree alternative for each peak, in the range -180 to 180
+    :rtype: list
+    '''
+    
+    return _CandidateAngles(FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=NumCandidates, EstimateScale=EstimateScale))
+
+
+def _CandidateAngles(candidates):
+    '''Angles of (angle, scale, strength) candidates and the 180 degree alternative of each'''
+    
+    AngleList = []
+    for (angle, scale, strength) in candidates:
+        AngleList.append(angle)
+        
+        alternate = angle + 180.0
+        if alternate >= 180.0:
+            alternate -= 360.0
+        
+        AngleList.append(alternate)
+        
+    return AngleList
+
+
+def _CandidateScale(candidates, angle, MaxAngleDistance=2.0):
+    '''
+    :return: Scale of the strongest (angle, scale, strength) candidate within MaxAngleDistance degrees of the angle.  Candidate 
+             angles are ambiguous by 180 degrees.  None if no candidate agrees with the angle.
+    :rtype: float
+    '''
+    
+    for (CandidateAngle, scale, strength) in candidates:
+        if min(_AngleDistance(angle, CandidateAngle), _AngleDistance(angle, CandidateAngle + 180.0)) <= MaxAngleDistance:
+            return scale
+        
+    return None
+
+
+def _RotatedImageShape(shape, angle):
+    '''Returns the shape interpolation.rotate produces when it reshapes an image of the given shape'''
+    
+    if angle == 0:
+        return tuple(shape)
+    
+    theta = np.deg2rad(angle)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    rot_matrix = np.array([[c, s], [-s, c]])
+    
+    out_bounds = np.dot(rot_matrix, np.array([[0, 0, shape[0], shape[0]], [0, shape[1], 0, shape[1]]]))
+    out_plane_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    return (int(out_plane_shape[0]), int(out_plane_shape[1]))
+
+
+def _PhaseCorrelationTargetShape(PaddedFixedShape, WarpedShape, AngleList, MinOverlap=0.75):
+    '''
+    Returns the (Height, Width) ScoreOneAngle pads both images to for every angle in AngleList.  The shape is padded for the 
+    largest rotated warped image so every angle shares one fixed image spectrum.
+    '''
+    
+    LargestRotatedShape = np.max(np.array([_RotatedImageShape(WarpedShape, angle) for angle in AngleList]), axis=0)
+    RotatedPaddedShape = core.PaddedShapeForPhaseCorrelation(LargestRotatedShape, MinOverlap=MinOverlap)
+    
+    return (int(max(PaddedFixedShape[0], RotatedPaddedShape[0])), int(max(PaddedFixedShape[1], RotatedPaddedShape[1])))
+
+
+def _CreateFixedFFTs(PaddedFixed, TargetShape, fixedStats, UseMemmap=True):
+    '''
+    Calculate the FFT of the padded fixed image once for the target shape of a search
+    :return: Dictionary mapping (Height, Width) to the rfft2 of the fixed image padded to that shape.  Values are memmap_metadata if UseMemmap is True.
+    '''
+    
+    TargetPaddedFixed = core.PadImageForPhaseCorrelation(PaddedFixed, NewWidth=TargetShape[1], NewHeight=TargetShape[0], ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std, MinOverlap=1.0)
+    FFTFixed = fft_backend.rfft2(TargetPaddedFixed)
+    del TargetPaddedFixed
+    
+    if UseMemmap:
+        return {TargetShape: core.CreateTemporaryReadonlyMemmapFile(FFTFixed)}
+        
+    return {TargetShape: FFTFixed}
+
+
+def _RotateMask(mask, angle):
+    '''
+    Rotate a mask the same way ScoreOneAngle rotates the warped image.  Pixels interpolated from outside the 
+    image are masked, as are pixels adjacent to them because spline interpolation spreads the zero border.
+    '''
+    
+    RotatedMask = interpolation.rotate(core.AsComputeDtype(mask), axes=(1, 0), angle=angle, order=1) > 0.999
+    return scipy.ndimage.binary_erosion(RotatedMask)
+
+
+def _ScoreOneAngleMasked(imFixed, imWarped, angle, FixedMask=None, WarpedMask=None, MinOverlap=0.75):
+    '''ScoreOneAngle using core.MaskedNormalizedCrossCorrelation.  Neither image is padded.'''
+    
+    if WarpedMask is None:
+        WarpedMask = np.ones(imWarped.shape, dtype=bool)
+    
+    if angle != 0:
+        imWarped = interpolation.rotate(imWarped, axes=(1, 0), angle=angle)
+        WarpedMask = _RotateMask(WarpedMask, angle)
+        
+    record = core.FindOffset(imFixed, imWarped, MinOverlap=MinOverlap, FixedMask=FixedMask, MovingMask=WarpedMask, CorrelationMode=core.CorrelationModes.MASKED_NCC)
+    return nornir_imageregistration.AlignmentRecord(record.peak, record.weight, angle)
+
+
+def ScoreOneAngle(imFixed, imWarped, angle, fixedStats=None, warpedStats=None, FixedImagePrePadded=True, MinOverlap=0.75, FixedFFTs=None, FixedMask=None, WarpedMask=None, CorrelationMode=None, TargetShape=None):
+    '''Returns an alignment score for a fixed image and an image rotated at a specified angle
+    
+    :param tuple TargetShape: Optional (Height, Width) to pad both images to.  Enlarged if the rotated warped image requires more padding.
+    :param dict FixedFFTs: Optional dictionary mapping (Height, Width) to the rfft2 of the padded fixed image at that size, as an ndarray or memmap_metadata.  
+                           When the target size for this angle is present only the rotated warped image is transformed.
+    :param ndarray FixedMask: Optional boolean image, True for fixed pixels used by masked correlation.  The fixed image must not be padded.
+    :param ndarray WarpedMask: Optional boolean image, True for warped pixels used by masked correlation.  Rotated with the warped image.
+    :param str CorrelationMode: One of core.CorrelationModes, defaults to core.DefaultCorrelationMode.  Statistics, padding and FixedFFTs are ignored by masked correlation.
+    '''
 
     imFixed = core.ImageParamToImageArray(imFixed)
     imWarped = core.ImageParamToImageArray(imWarped)
+    
+    if FixedMask is not None or WarpedMask is not None or core._ResolveCorrelationMode(CorrelationMode) == core.CorrelationModes.MASKED_NCC:
+        if FixedMask is not None:
+            FixedMask = core.ImageParamToImageArray(FixedMask)
+        if WarpedMask is not None:
+            WarpedMask = core.ImageParamToImageArray(WarpedMask)
+            
+        return _ScoreOneAngleMasked(imFixed, imWarped, angle, FixedMask=FixedMask, WarpedMask=WarpedMask, MinOverlap=MinOverlap)
 
     # gc.set_debug(gc.DEBUG_LEAK)
     if fixedStats is None:
@@ -112,22 +451,39 @@ def ScoreOneAngle(imFixed, imWarped, angle, fixedStats=None, warpedStats=None, F
 
     # print str(PaddedFixed.shape) + ' ' +  str(RotatedPaddedWarped.shape)
 
-    TargetHeight = max([PaddedFixed.shape[0], RotatedWarped.shape[0]])
-    TargetWidth = max([PaddedFixed.shape[1], RotatedWarped.shape[1]])
+    if TargetShape is None:
+        TargetShape = (0, 0)
+
+    TargetHeight = int(max([PaddedFixed.shape[0], RotatedWarped.shape[0], TargetShape[0]]))
+    TargetWidth = int(max([PaddedFixed.shape[1], RotatedWarped.shape[1], TargetShape[1]]))
+    TargetShape = (TargetHeight, TargetWidth)
+    
+    FFTFixed = None
+    if not FixedFFTs is None and TargetShape in FixedFFTs:
+        FFTFixed = core.ImageParamToImageArray(FixedFFTs[TargetShape])
 
-    PaddedFixed = core.PadImageForPhaseCorrelation(imFixed, NewWidth=TargetWidth, NewHeight=TargetHeight, ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std, MinOverlap=1.0)
     RotatedPaddedWarped = core.PadImageForPhaseCorrelation(RotatedWarped, NewWidth=TargetWidth, NewHeight=TargetHeight, ImageMedian=warpedStats.median, ImageStdDev=warpedStats.std, MinOverlap=1.0)
 
     if OKToDelimWarped:
         del imWarped
 
     del RotatedWarped
+    
+    if FFTFixed is None:
+        PaddedFixed = core.PadImageForPhaseCorrelation(imFixed, NewWidth=TargetWidth, NewHeight=TargetHeight, ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std, MinOverlap=1.0)
+    
+        assert(PaddedFixed.shape == RotatedPaddedWarped.shape)
+    
+        CorrelationImage = core.ImagePhaseCorrelation(PaddedFixed, RotatedPaddedWarped)
+        
+        del PaddedFixed
+    else:
+        FFTWarped = fft_backend.rfft2(RotatedPaddedWarped)
+        CorrelationImage = core.FFTPhaseCorrelation(FFTFixed, FFTWarped, delete_input=True, shape=TargetShape)
+        
+        del FFTFixed
+        del FFTWarped
 
-    assert(PaddedFixed.shape == RotatedPaddedWarped.shape)
-
-    CorrelationImage = core.ImagePhaseCorrelation(PaddedFixed, RotatedPaddedWarped)
-
-    del PaddedFixed
     del RotatedPaddedWarped
 
     CorrelationImage = fftshift(CorrelationImage)
@@ -156,9 +512,31 @@ def GetFixedAndWarpedImageStats(imFixed, imWarped):
     return (fixedStats, warpedStats)
 
 
-def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False):
+def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False, MaxInFlight=None, FixedMask=None, WarpedMask=None, CorrelationMode=None):
     '''Find the best angle to align two images.  This function can be very memory intensive.
-       Setting SingleThread=True makes debugging easier'''
+       Setting SingleThread=True makes debugging easier
+       :param int MaxInFlight: Maximum number of angles scored concurrently, see completion_queue.DefaultMaxInFlight
+       :param str CorrelationMode: One of core.CorrelationModes, see ScoreAngles'''
+    
+    AngleMatchValues = ScoreAngles(imFixed, imWarped, AngleList, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster, MaxInFlight=MaxInFlight, 
+                                   FixedMask=FixedMask, WarpedMask=WarpedMask, CorrelationMode=CorrelationMode)
+    
+    BestMatch = max(AngleMatchValues, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+    return BestMatch
+
+
+def ScoreAngles(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False, MaxInFlight=None, FixedMask=None, WarpedMask=None, CorrelationMode=None):
+    '''Score every angle in AngleList.  This function can be very memory intensive.
+       Setting SingleThread=True makes debugging easier
+       :param int MaxInFlight: Maximum number of angles scored concurrently.  Bounds the memory used by queued tasks.
+       :param ndarray FixedMask: Optional boolean image, True for fixed pixels used by masked correlation
+       :param ndarray WarpedMask: Optional boolean image, True for warped pixels used by masked correlation
+       :param str CorrelationMode: One of core.CorrelationModes, defaults to core.DefaultCorrelationMode.  Passing a mask selects masked correlation.
+       :return: List of alignment records, one for each angle, in no particular order
+       :rtype: list'''
+       
+    if FixedMask is not None or WarpedMask is not None or core._ResolveCorrelationMode(CorrelationMode) == core.CorrelationModes.MASKED_NCC:
+        return _ScoreAnglesMasked(imFixed, imWarped, AngleList, MinOverlap=MinOverlap, SingleThread=SingleThread, MaxInFlight=MaxInFlight, FixedMask=FixedMask, WarpedMask=WarpedMask)
 
     Debug = False
     pool = None
@@ -175,7 +553,6 @@ def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=Fa
 
 
     AngleMatchValues = list()
-    taskList = list()
 
     (fixedStats, warpedStats) = GetFixedAndWarpedImageStats(imFixed, imWarped)
 
@@ -198,53 +575,31 @@ def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=Fa
     else:
         SharedPaddedFixed = PaddedFixed
         SharedWarped = imWarped
+        
+    # The fixed image spectrum only depends on the padded size, so every angle is padded to one size and shares one spectrum
+    TargetShape = _PhaseCorrelationTargetShape(PaddedFixed.shape, imWarped.shape, AngleList, MinOverlap=MinOverlap)
+    FixedFFTs = _CreateFixedFFTs(PaddedFixed, TargetShape, fixedStats, UseMemmap=not Cluster)
 
-    CheckTaskInterval = 16
+    # Results are collected as tasks finish so completed records do not wait behind slower angles
+    taskQueue = None
+    if not SingleThread:
+        taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=MaxInFlight)
 
-    for i, theta in enumerate(AngleList):
+    for theta in AngleList:
 
         if SingleThread:
-            record = ScoreOneAngle(temp_padded_fixed_memmap, temp_shared_warp_memmap, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap)
+            record = ScoreOneAngle(temp_padded_fixed_memmap, temp_shared_warp_memmap, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap, FixedFFTs=FixedFFTs, TargetShape=TargetShape)
             AngleMatchValues.append(record)
         else:
-            task = pool.add_task(str(theta), ScoreOneAngle, temp_padded_fixed_memmap, temp_shared_warp_memmap, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap)
-            taskList.append(task)
-
-        if not i % CheckTaskInterval == 0:
-            continue
-
-        # I don't like this, but it lets me delete tasks before filling the queue which may save some memory.
-        # No sense checking unless we've already filled the queue though
-        if len(taskList) > multiprocessing.cpu_count() * 1.5:
-            for iTask in range(len(taskList) - 1, -1, -1):
-                if taskList[iTask].iscompleted:
-                    record = taskList[iTask].wait_return()
-                    AngleMatchValues.append(record)
-                    del taskList[iTask]
-
-        # TestOneAngle(SharedPaddedFixed, SharedWarped, angle, None, MinOverlap)
-
-   # taskList.sort(key=tpool.Task.name)
-
-
-    while len(taskList) > 0:
-        for iTask in range(len(taskList) - 1, -1, -1):
-            if taskList[iTask].iscompleted:
-                record = taskList[iTask].wait_return()
-                AngleMatchValues.append(record)
-                del taskList[iTask]
+            taskQueue.add_task(str(theta), ScoreOneAngle, temp_padded_fixed_memmap, temp_shared_warp_memmap, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap, FixedFFTs=FixedFFTs, TargetShape=TargetShape)
 
-        if len(taskList) > 0:
-            # Wait a bit before checking the task list
-            sleep(0.5)
+            for task in taskQueue.completed():
+                AngleMatchValues.append(task.wait_return())
 
+    if not taskQueue is None:
+        for task in taskQueue.as_completed():
+            AngleMatchValues.append(task.wait_return())
 
-        # print(str(record.angle) + ' = ' + str(record.peak) + ' weight: ' + str(record.weight) + '\n')
-
-        # ShowGrayscale(NormCorrelationImage)
-
-    # print str(AngleMatchValues)
-    
     # Delete the pool to ensure extra python threads do not stick around
     pool.wait_completion()
 
@@ -253,10 +608,163 @@ def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=Fa
     if not Cluster:
         os.remove(temp_padded_fixed_memmap.path)
         os.remove(temp_shared_warp_memmap.path)
+        
+        for FixedFFT in FixedFFTs.values():
+            os.remove(FixedFFT.path)
         # del SharedPaddedFixed
         # del SharedWarped
 
-    BestMatch = max(AngleMatchValues, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+    return AngleMatchValues
+
+
+def _ScoreAnglesMasked(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, MaxInFlight=None, FixedMask=None, WarpedMask=None):
+    '''ScoreAngles using masked correlation.  No statistics, padding or noise are required.'''
+    
+    AngleMatchValues = list()
+    
+    if SingleThread:
+        for theta in AngleList:
+            AngleMatchValues.append(_ScoreOneAngleMasked(imFixed, imWarped, theta, FixedMask=FixedMask, WarpedMask=WarpedMask, MinOverlap=MinOverlap))
+            
+        return AngleMatchValues
+    
+    pool = nornir_pools.GetGlobalMultithreadingPool()
+    
+    # Share the images and masks through read-only memory maps
+    shared = [core.CreateTemporaryReadonlyMemmapFile(imFixed), core.CreateTemporaryReadonlyMemmapFile(imWarped)]
+    shared.append(None if FixedMask is None else core.CreateTemporaryReadonlyMemmapFile(FixedMask))
+    shared.append(None if WarpedMask is None else core.CreateTemporaryReadonlyMemmapFile(WarpedMask))
+    
+    taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=MaxInFlight)
+    for theta in AngleList:
+        taskQueue.add_task(str(theta), ScoreOneAngle, shared[0], shared[1], theta, MinOverlap=MinOverlap, FixedMask=shared[2], WarpedMask=shared[3], CorrelationMode=core.CorrelationModes.MASKED_NCC)
+        
+        for task in taskQueue.completed():
+            AngleMatchValues.append(task.wait_return())
+            
+    for task in taskQueue.as_completed():
+        AngleMatchValues.append(task.wait_return())
+        
+    pool.wait_completion()
+    
+    for memmap in shared:
+        if memmap is not None:
+            os.remove(memmap.path)
+    
+    return AngleMatchValues
+
+
+def _NormalizeAngle(angle):
+    '''Map an angle in degrees to the range -180 to 180'''
+    angle = math.fmod(angle + 180.0, 360.0)
+    if angle < 0:
+        angle += 360.0
+        
+    return angle - 180.0
+
+
+def _AngleDistance(A, B):
+    return abs(_NormalizeAngle(A - B))
+
+
+def _BestDistinctAngles(records, count, separation):
+    '''
+    :return: The strongest records whose angles are at least separation degrees apart
+    :rtype: list
+    '''
+    
+    chosen = []
+    for record in sorted(records, key=nornir_imageregistration.AlignmentRecord.WeightKey, reverse=True):
+        if any([_AngleDistance(record.angle, c.angle) < separation for c in chosen]):
+            continue
+        
+        chosen.append(record)
+        if len(chosen) >= count:
+            break
+        
+    return chosen
+
+
+def _AngleWindows(centers, step):
+    '''Angles one step on either side of each center, without duplicates'''
+    
+    angles = set()
+    for center in centers:
+        for delta in (-step, 0, step):
+            angles.add(round(_NormalizeAngle(center + delta), 6))
+            
+    return sorted(angles)
+
+
+def FindBestAnglePyramid(imFixed, imWarped, AngleList, NumLevels=3, NumCandidates=3, FinalAngleStep=0.1, MinOverlap=0.75, SingleThread=False, Cluster=False, MinDimension=64, FixedMask=None, WarpedMask=None, CorrelationMode=None):
+    '''
+    Coarse to fine angle search.  AngleList is scored on the most downsampled level of an image pyramid.  The NumCandidates best 
+    angles survive to the next level, where only the angles half a step on either side of each survivor are scored.  At full resolution 
+    the best angle is refined in FinalAngleStep increments.
+    
+    :param list AngleList: Evenly spaced angles to sweep on the coarsest level
+    :param int NumLevels: Number of pyramid levels, each level is half the size of the level below it.  Level 0 is full resolution.
+    :param int NumCandidates: Number of angles kept at each level
+    :param float FinalAngleStep: Angular resolution of the result in degrees
+    :param int MinDimension: Levels are dropped if the smallest image dimension would be smaller than this
+    :param str CorrelationMode: One of core.CorrelationModes, see ScoreAngles.  Masks are reduced with the images.
+    :return: Alignment record for the best angle at full resolution
+    :rtype: AlignmentRecord
+    '''
+    
+    logger = logging.getLogger(__name__ + '.FindBestAnglePyramid')
+    
+    AngleList = sorted(AngleList)
+    if len(AngleList) > 1:
+        step = float(np.min(np.diff(AngleList)))
+    else:
+        step = 2.0
+    
+    SmallestDimension = min(min(imFixed.shape), min(imWarped.shape))
+    while NumLevels > 1 and SmallestDimension / (2 ** (NumLevels - 1)) < MinDimension:
+        NumLevels -= 1
+    
+    angles = AngleList
+    records = None
+    for level in range(NumLevels - 1, -1, -1):
+        scalar = 1.0 / (2 ** level)
+        
+        (LevelFixedMask, LevelWarpedMask) = (FixedMask, WarpedMask)
+        if scalar < 1.0:
+            LevelFixed = core.ReduceImage(imFixed, scalar)
+            LevelWarped = core.ReduceImage(imWarped, scalar)
+            
+            if FixedMask is not None:
+                LevelFixedMask = core.ReduceMask(FixedMask, scalar)
+            if WarpedMask is not None:
+                LevelWarpedMask = core.ReduceMask(WarpedMask, scalar)
+        else:
+            LevelFixed = imFixed
+            LevelWarped = imWarped
+        
+        if records is not None:
+            survivors = _BestDistinctAngles(records, NumCandidates, separation=step)
+            step = step / 2.0
+            angles = _AngleWindows([r.angle for r in survivors], step)
+            
+        logger.info("Level %d: scoring %d angles" % (level, len(angles)))
+        records = ScoreAngles(LevelFixed, LevelWarped, angles, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster, 
+                              FixedMask=LevelFixedMask, WarpedMask=LevelWarpedMask, CorrelationMode=CorrelationMode)
+        
+        del LevelFixed
+        del LevelWarped
+    
+    BestMatch = max(records, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+    
+    # The best angle is known to within half a step, score the remaining angles at the requested resolution
+    NumFineSteps = int(math.floor((step / 2.0) / FinalAngleStep))
+    FineAngles = [BestMatch.angle + (i * FinalAngleStep) for i in range(-NumFineSteps, NumFineSteps + 1) if i != 0]
+    if len(FineAngles) > 0:
+        FineRecords = ScoreAngles(imFixed, imWarped, FineAngles, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster, 
+                                  FixedMask=FixedMask, WarpedMask=WarpedMask, CorrelationMode=CorrelationMode)
+        FineRecords.append(BestMatch)
+        BestMatch = max(FineRecords, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+    
     return BestMatch
 
 
@@ -4,13 +4,23 @@ Created on Feb 21, 2014
 @author: u0490822
 '''
 
+import collections
 import logging
 import os
+import threading
+import uuid
 
 import nornir_imageregistration.core as core
+import nornir_imageregistration.fft_backend as fft_backend
 import nornir_imageregistration.spatial as spatial
 import numpy as np
 
+# The largest number of decoded tile images a worker process keeps in memory
+MaxCachedTileImages = 128
+
+# The most bytes of decoded tile images a worker process keeps in memory.  The most recently used image is kept even if it is larger.
+MaxCachedTileImageBytes = 1 << 30
+
 
 def CreateTiles(transforms, imagepaths):
     '''Create tiles from pairs of transforms and image paths
@@ -47,6 +57,236 @@ def IterateOverlappingTiles(list_tiles, minOverlap=0.05):
             yield (list_tiles[A], list_tiles[B])
             
 
+def OrderOverlappingPairsByTile(list_tiles, pairs):
+    '''
+    Order pairs of overlapping tiles so each tile's pairs are processed close together.  Tiles are visited in rows
+    across the short axis of the mosaic, sweeping along the long axis, which limits the tiles waiting for the
+    rest of their pairs to about two rows.  Each pair is scheduled when its second tile is visited.
+    
+    :param list list_tiles: List of tiles
+    :param list pairs: List of (A, B) overlapping tile pairs, such as the output of IterateOverlappingTiles
+    :return: (ordered pairs, the smallest TileImageCache size which decodes each tile once when the pairs are processed in order)
+    '''
+    
+    if len(pairs) == 0:
+        return ([], 0)
+    
+    index = {t.ID: i for (i, t) in enumerate(list_tiles)}
+    iA = np.array([index[A.ID] for (A, B) in pairs])
+    iB = np.array([index[B.ID] for (A, B) in pairs])
+    
+    num_tiles = len(list_tiles)
+    centers = np.array([t.ControlBoundingBox.Center for t in list_tiles])
+    tile_size = np.median(np.array([t.ControlBoundingBox.Size for t in list_tiles]), axis=0)
+    
+    iLongAxis = np.argmax(np.ptp(centers, axis=0))
+    iShortAxis = 1 - iLongAxis
+    
+    # Pairs more than half a tile apart along the long axis are in adjacent rows, use them to measure the row spacing
+    pair_distance = np.abs(centers[iA, iLongAxis] - centers[iB, iLongAxis])
+    row_steps = pair_distance[pair_distance > tile_size[iLongAxis] / 2.0]
+    if row_steps.shape[0] > 0:
+        rows = np.round((centers[:, iLongAxis] - np.min(centers[:, iLongAxis])) / np.median(row_steps))
+    else:
+        rows = np.zeros(num_tiles)
+        
+    visit_order = np.lexsort((centers[:, iShortAxis], rows))
+    
+    rank = np.empty(num_tiles, dtype=np.int64)
+    rank[visit_order] = np.arange(num_tiles)
+    
+    first = np.minimum(rank[iA], rank[iB])
+    last = np.maximum(rank[iA], rank[iB])
+    
+    iSorted = np.lexsort((first, last))
+    ordered_pairs = [pairs[i] for i in iSorted]
+    
+    return (ordered_pairs, CacheSizeForPairOrder(ordered_pairs))
+
+
+def CacheSizeForPairOrder(pairs):
+    '''
+    :param list pairs: List of (A, B) tile pairs in the order they will be processed
+    :return: The smallest TileImageCache size which decodes each tile once when the pairs are processed in order
+    '''
+    
+    # The least recently used cache must hold every tile loaded between two uses of the same tile.  Count the
+    # distinct tiles between uses with a Fenwick tree marking the time each tile was last used.
+    accesses = [tile_obj.ID for pair in pairs for tile_obj in pair]
+    if len(accesses) == 0:
+        return 0
+    
+    tree = [0] * (len(accesses) + 1)
+    
+    def _update(i, delta):
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & (-i)
+            
+    def _prefix_sum(i):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & (-i)
+        return total
+    
+    last_used = {}
+    cache_size = 1
+    for (time, ID) in enumerate(accesses):
+        previous = last_used.get(ID, None)
+        if previous is not None:
+            # Distinct tiles used since the previous use of this tile, plus the tile itself
+            cache_size = max(cache_size, _prefix_sum(time) - _prefix_sum(previous + 1) + 1)
+            _update(previous, -1)
+            
+        _update(time, 1)
+        last_used[ID] = time
+    
+    return cache_size
+
+
+class TileImageCache(object):
+    '''
+    A bounded cache of decoded tile images.  The least recently used image is discarded when the cache holds more than
+    MaxTiles images or MaxBytes bytes.  When several threads request the same image at once it is only decoded by the
+    first thread.  Cached images are shared, callers must not modify them.
+    '''
+    
+    @property
+    def MaxTiles(self):
+        return self._max_tiles
+    
+    @MaxTiles.setter
+    def MaxTiles(self, value):
+        with self._lock:
+            self._max_tiles = max(int(value), 1)
+            self._evict()
+            
+    @property
+    def MaxBytes(self):
+        if self._max_bytes is None:
+            return MaxCachedTileImageBytes
+        
+        return self._max_bytes
+    
+    @property
+    def nbytes(self):
+        return self._nbytes
+    
+    @property
+    def PassID(self):
+        '''Identifies the pass the cached images were loaded for, see BeginPass'''
+        return self._pass_id
+    
+    def __init__(self, MaxTiles=None, MaxBytes=None):
+        '''
+        :param int MaxTiles: Number of images kept, defaults to the module's MaxCachedTileImages
+        :param int MaxBytes: Bytes of images kept, defaults to the module's MaxCachedTileImageBytes
+        '''
+        if MaxTiles is None:
+            MaxTiles = MaxCachedTileImages
+            
+        self._max_tiles = max(int(MaxTiles), 1)
+        self._max_bytes = MaxBytes
+        self._images = collections.OrderedDict()
+        self._nbytes = 0
+        self._loading = {}
+        self._pass_id = None
+        self._lock = threading.Lock()
+        
+    def _evict(self):
+        while len(self._images) > self._max_tiles or (len(self._images) > 1 and self._nbytes > self.MaxBytes):
+            (key, image) = self._images.popitem(last=False)
+            self._nbytes -= image.nbytes
+            
+    def BeginPass(self, PassID):
+        '''
+        Discard the cached images if they were loaded for a different pass.  Worker processes cannot be reached when a
+        pass ends, so tasks carry the ID of their pass and the first task of a new pass releases the previous pass's images.
+        '''
+        with self._lock:
+            if PassID != self._pass_id:
+                self._images.clear()
+                self._nbytes = 0
+                self._pass_id = PassID
+            
+    def GetImage(self, ImagePath, dtype=None):
+        '''
+        :param str ImagePath: Path to the tile image
+        :param dtype dtype: Convert the loaded image to this type before caching it
+        :return: The decoded image, loaded from disk if it is not cached
+        '''
+        
+        key = (ImagePath, os.path.getmtime(ImagePath), np.dtype(dtype).str if dtype is not None else None)
+        
+        while True:
+            with self._lock:
+                if key in self._images:
+                    self._images.move_to_end(key)
+                    return self._images[key]
+                
+                loading_event = self._loading.get(key, None)
+                if loading_event is None:
+                    loading_event = threading.Event()
+                    self._loading[key] = loading_event
+                    break
+                
+            # Another thread is decoding this image, wait for it and check the cache again
+            loading_event.wait()
+        
+        try:
+            if dtype is None:
+                image = core.LoadImage(ImagePath)
+            else:
+                # Convert from the stored type while decoding instead of copying a decoded float image
+                image = core.ReadImage(ImagePath, dtype=dtype)
+                
+            with self._lock:
+                self._images[key] = image
+                self._nbytes += image.nbytes
+                self._evict()
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading_event.set()
+            
+        return image
+    
+    def Clear(self):
+        with self._lock:
+            self._images.clear()
+            self._nbytes = 0
+            
+
+__tile_image_cache = TileImageCache()
+
+def NewCachePassID():
+    '''
+    :return: An ID for a pass over a set of tiles.  Passed to GetCachedTileImage by the pass's tasks.
+    :rtype: str
+    '''
+    return uuid.uuid4().hex
+
+def GetCachedTileImage(ImagePath, dtype=None, CacheSize=None, PassID=None):
+    '''
+    Load a tile image through the cache of this process.  Intended for functions running on pool workers.
+    :param int CacheSize: Resize the cache to hold this many images
+    :param str PassID: ID from NewCachePassID.  Images cached by other passes are released.
+    '''
+    if PassID is not None:
+        __tile_image_cache.BeginPass(PassID)
+        
+    if CacheSize is not None and CacheSize != __tile_image_cache.MaxTiles:
+        __tile_image_cache.MaxTiles = CacheSize
+        
+    return __tile_image_cache.GetImage(ImagePath, dtype=dtype)
+
+def ClearTileImageCache():
+    '''Release the cached tile images of this process'''
+    __tile_image_cache.Clear()
+    
+
 class Tile(object):
     '''
     A combination of a transform and a path to an image on disk.  Image will be loaded on demand
@@ -96,7 +336,7 @@ class Tile(object):
     @property
     def FFTImage(self):
         if self._fftimage is None:
-            self._fftimage = np.fft.rfft2(self.PaddedImage)
+            self._fftimage = fft_backend.rfft2(self.PaddedImage)
 
         return self._fftimage
     
@@ -50,15 +50,12 @@ def MostCommonScalar(transforms, imagepaths):
        Return the most common scale factor required to make the transforms match the image dimensions'''
 
     scales = []
+    
+    # Read the image headers in parallel, a serial loop is slow for large mosaics on network filesystems
+    sizes = core.GetImageSizes(imagepaths)
 
     for i, transform in enumerate(transforms):
-        imagefullpath = imagepaths[i]
-
-        try:
-            size = core.GetImageSize(imagefullpath)
-        except IOError:
-            continue 
-        
+        size = sizes[i]
         if size is None:
             continue
 
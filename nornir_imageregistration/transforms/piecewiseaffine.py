@@ -0,0 +1,224 @@
+'''
+Rasterize a triangulation transform over a region of pixels.
+
+Inside each triangle a triangulation transform is an affine map.  Instead of locating the triangle containing each
+pixel, as LinearNDInterpolator does, each triangle is rasterized: the span of columns it covers is calculated for every
+row it crosses and the triangle's affine map is applied to the whole span.  Pixels outside the triangulation are
+passed to the transform, so transforms with a fallback, such as MeshWithRBFFallback, extrapolate as usual.  When a
+tolerance is given they are evaluated on a sparse lattice instead, see sparsegrid.
+'''
+
+import numpy as np
+
+from . import meshwithrbffallback, sparsegrid, triangulation
+
+# Tolerance on barycentric coordinates for pixels on triangle edges.  Pixels on the edge of the triangulation are mapped.
+BarycentricEpsilon = 1e-8
+
+# Number of pixels mapped at once.  Bounds the size of temporary arrays for large regions.
+PixelsPerBatch = 1 << 21
+
+
+def SupportsPiecewiseAffine(transform, inverse):
+    '''
+    :param bool inverse: True if fixed space points are mapped to warped space
+    :return: True if the transform's mapping in that direction is the linear interpolation of its triangulation
+    '''
+
+    if not isinstance(transform, triangulation.Triangulation):
+        return False
+
+    SupportedClasses = (triangulation.Triangulation, meshwithrbffallback.MeshWithRBFFallback)
+    if inverse:
+        return type(transform).InverseTransform in [c.InverseTransform for c in SupportedClasses]
+
+    return type(transform).Transform in [c.Transform for c in SupportedClasses]
+
+
+def _TriangleAffineMaps(Vertices, MappedVertices):
+    '''
+    :return: (Barycentric, Affine, Valid).  Barycentric is Tx3x3, multiplying [Y X 1] by Barycentric[t] gives the
+             barycentric coordinates of a point in triangle t.  Affine is Tx3x2, multiplying [Y X 1] by Affine[t] maps
+             the point.  Valid is False for degenerate triangles.
+    '''
+
+    NumTriangles = Vertices.shape[0]
+    M = np.concatenate((Vertices, np.ones((NumTriangles, 3, 1))), axis=2)
+
+    # Triangles with no area do not contain any pixels the neighboring triangles do not
+    Area = np.abs(np.linalg.det(M))
+    Scale = np.max(np.abs(Vertices), axis=(1, 2)) + 1.0
+    Valid = Area > 1e-12 * Scale * Scale
+    M[~Valid] = np.eye(3)
+
+    Barycentric = np.linalg.inv(M)
+    Affine = np.matmul(Barycentric, MappedVertices)
+    return (Barycentric, Affine, Valid)
+
+
+def _TriangleRowSpans(Vertices, Barycentric, Valid, area):
+    '''
+    :return: (Triangle, Row, FirstColumn, Count) for every row each triangle crosses, sorted by row and column.  Columns 
+             FirstColumn to FirstColumn + Count - 1 of the row are inside the triangle.  Spans do not overlap.
+    '''
+
+    (Height, Width) = area
+    eps = BarycentricEpsilon
+
+    FirstRow = np.maximum(np.ceil(np.min(Vertices[:, :, 0], axis=1) - 1e-6), 0).astype(np.int64)
+    LastRow = np.minimum(np.floor(np.max(Vertices[:, :, 0], axis=1) + 1e-6), Height - 1).astype(np.int64)
+    NumRows = np.where(Valid, np.maximum(LastRow - FirstRow + 1, 0), 0)
+
+    Triangle = np.repeat(np.arange(Vertices.shape[0]), NumRows)
+    RowStarts = np.cumsum(NumRows) - NumRows
+    Row = FirstRow[Triangle] + (np.arange(Triangle.shape[0]) - RowStarts[Triangle])
+
+    # Each barycentric coordinate is linear along the row, b = Slope * x + Intercept, and must be at least -eps
+    Low = np.zeros(Triangle.shape[0])
+    High = np.full(Triangle.shape[0], Width - 1, dtype=np.float64)
+    Empty = np.zeros(Triangle.shape[0], dtype=bool)
+    for i in range(3):
+        Slope = Barycentric[Triangle, 1, i]
+        Intercept = Barycentric[Triangle, 0, i] * Row + Barycentric[Triangle, 2, i]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Bound = (-eps - Intercept) / Slope
+
+        Low = np.where(Slope > 0, np.maximum(Low, Bound), Low)
+        High = np.where(Slope < 0, np.minimum(High, Bound), High)
+        Empty |= (Slope == 0) & (Intercept < -eps)
+
+    FirstColumn = np.ceil(Low).astype(np.int64)
+    Count = np.floor(High).astype(np.int64) - FirstColumn + 1
+    Count[Empty] = 0
+    Count = np.maximum(Count, 0)
+
+    NonEmpty = Count > 0
+    (Triangle, Row, FirstColumn, Count) = (Triangle[NonEmpty], Row[NonEmpty], FirstColumn[NonEmpty], Count[NonEmpty])
+
+    # Order the spans along each row and remove pixels on shared edges that an earlier span in the row already covers
+    order = np.lexsort((FirstColumn, Row))
+    (Triangle, Row, FirstColumn, Count) = (Triangle[order], Row[order], FirstColumn[order], Count[order])
+
+    RowOffset = Row * (Width + 1)
+    LastColumn = FirstColumn + Count - 1
+    # Last column covered by the preceding spans of the span's row, negative for the first span of a row
+    CoveredColumn = np.maximum.accumulate(LastColumn + RowOffset)[:-1] - RowOffset[1:]
+    FirstColumn[1:] = np.maximum(FirstColumn[1:], CoveredColumn + 1)
+    Count = LastColumn - FirstColumn + 1
+
+    NonEmpty = Count > 0
+    return (Triangle[NonEmpty], Row[NonEmpty], FirstColumn[NonEmpty], Count[NonEmpty])
+
+
+def PiecewiseAffineGrid(Vertices, Triangles, MappedVertices, botleft, area):
+    '''
+    Map every pixel of a region through the piecewise affine function defined on a set of triangles.
+
+    :param ndarray Vertices: Nx2 (Y,X) triangle vertices
+    :param ndarray Triangles: Tx3 indices of each triangle's vertices
+    :param ndarray MappedVertices: Nx2 (Y,X) coordinates each vertex maps to
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner of the region
+    :param 1x2_array area: The (Height, Width) of the region
+    :return: HxWx2 float32 array of mapped coordinates.  NaN for pixels outside every triangle.
+    :rtype: ndarray
+    '''
+
+    area = (int(area[0]), int(area[1]))
+    botleft = np.asarray(botleft, dtype=np.float64)
+
+    # Work relative to the region so pixel coordinates are row and column indices
+    TriangleVertices = np.asarray(Vertices, dtype=np.float64)[Triangles] - botleft
+    TriangleMapped = np.asarray(MappedVertices, dtype=np.float64)[Triangles]
+
+    Mapped = np.full((area[0] * area[1], 2), np.nan, dtype=np.float32)
+    if TriangleVertices.shape[0] == 0 or Mapped.shape[0] == 0:
+        return Mapped.reshape((area[0], area[1], 2))
+
+    (Barycentric, Affine, Valid) = _TriangleAffineMaps(TriangleVertices, TriangleMapped)
+    (Triangle, Row, FirstColumn, Count) = _TriangleRowSpans(TriangleVertices, Barycentric, Valid, area)
+
+    # Along a row the mapped coordinates are FirstValue + (Column - FirstColumn) * ColumnStep
+    ColumnStep = Affine[Triangle, 1, :]
+    FirstValue = Affine[Triangle, 0, :] * Row[:, np.newaxis] + Affine[Triangle, 2, :] + ColumnStep * FirstColumn[:, np.newaxis]
+    LastValue = FirstValue + ColumnStep * (Count - 1)[:, np.newaxis]
+    FirstFlatIndex = Row * area[1] + FirstColumn
+
+    # Map the spans in batches of about PixelsPerBatch pixels
+    SpanEnds = np.cumsum(Count)
+    BatchBoundaries = np.searchsorted(SpanEnds, np.arange(PixelsPerBatch, SpanEnds[-1], PixelsPerBatch), side='right')
+    BatchBoundaries = np.concatenate(([0], BatchBoundaries, [Count.shape[0]]))
+
+    for iBatch in range(len(BatchBoundaries) - 1):
+        spans = slice(BatchBoundaries[iBatch], BatchBoundaries[iBatch + 1])
+        SpanCount = Count[spans]
+        if SpanCount.shape[0] == 0:
+            continue
+
+        SpanStarts = np.cumsum(SpanCount) - SpanCount
+        NumPixels = SpanStarts[-1] + SpanCount[-1]
+        SpanFlatIndex = FirstFlatIndex[spans]
+
+        # Each pixel's value is the previous pixel's value plus the step of its span, with a jump at the start of each span
+        for iAxis in range(2):
+            Delta = np.repeat(ColumnStep[spans, iAxis], SpanCount)
+            Delta[SpanStarts[1:]] = FirstValue[spans, iAxis][1:] - LastValue[spans, iAxis][:-1]
+            Delta[0] = FirstValue[spans, iAxis][0]
+            Values = np.cumsum(Delta)
+            del Delta
+
+            if SpanFlatIndex[-1] - SpanFlatIndex[0] == SpanStarts[-1]:
+                # The spans cover a contiguous range of pixels
+                Mapped[SpanFlatIndex[0]:SpanFlatIndex[0] + NumPixels, iAxis] = Values
+            else:
+                FlatIndex = np.ones(NumPixels, dtype=np.int64)
+                FlatIndex[SpanStarts[1:]] = SpanFlatIndex[1:] - (SpanFlatIndex[:-1] + SpanCount[:-1] - 1)
+                FlatIndex[0] = SpanFlatIndex[0]
+                Mapped[np.cumsum(FlatIndex), iAxis] = Values
+
+    return Mapped.reshape((area[0], area[1], 2))
+
+
+def TransformGrid(transform, botleft, area, inverse=True, extrapolate=False, SparseGridTolerance=None):
+    '''
+    Map every pixel of a region through a triangulation transform.  Equivalent to passing the coordinates of every
+    pixel to transform.InverseTransform, or transform.Transform, but much faster for large regions.
+
+    :param transform transform: Transform, SupportsPiecewiseAffine must be true
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner of the region
+    :param 1x2_array area: The (Height, Width) of the region
+    :param bool inverse: True to map fixed space to warped space
+    :param bool extrapolate: Passed to the transform for pixels outside the triangulation
+    :param float SparseGridTolerance: If not None pixels outside the triangulation are interpolated from a sparse lattice with this error tolerance in pixels
+    :return: HxWx2 float32 array of mapped coordinates.  NaN for pixels the transform cannot map.
+    :rtype: ndarray
+    '''
+
+    if inverse:
+        Mapped = PiecewiseAffineGrid(transform.FixedPoints, transform.fixedtri.simplices, transform.WarpedPoints, botleft, area)
+    else:
+        Mapped = PiecewiseAffineGrid(transform.WarpedPoints, transform.warpedtri.simplices, transform.FixedPoints, botleft, area)
+
+    if extrapolate:
+        Outside = np.isnan(Mapped[:, :, 0])
+        if not np.any(Outside):
+            return Mapped
+
+        if SparseGridTolerance is None:
+            Outside = np.nonzero(Outside)
+            OutsidePoints = np.vstack(Outside).transpose() + np.asarray(botleft, dtype=np.float64)
+            if inverse:
+                Mapped[Outside] = transform.InverseTransform(OutsidePoints, extrapolate=extrapolate)
+            else:
+                Mapped[Outside] = transform.Transform(OutsidePoints, extrapolate=extrapolate)
+        else:
+            # Interpolate over the bounding box of the pixels outside the triangulation
+            (Rows, Columns) = (np.flatnonzero(np.any(Outside, axis=1)), np.flatnonzero(np.any(Outside, axis=0)))
+            Box = (slice(Rows[0], Rows[-1] + 1), slice(Columns[0], Columns[-1] + 1))
+            BoxBotLeft = np.asarray(botleft, dtype=np.float64) + (Rows[0], Columns[0])
+            BoxArea = (Rows[-1] + 1 - Rows[0], Columns[-1] + 1 - Columns[0])
+
+            Interpolated = sparsegrid.TransformGrid(transform, BoxBotLeft, BoxArea, SparseGridTolerance, inverse=inverse, extrapolate=extrapolate, Mask=Outside[Box])
+            Mapped[Box][Outside[Box]] = Interpolated[Outside[Box]]
+
+    return Mapped
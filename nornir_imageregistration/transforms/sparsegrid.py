@@ -0,0 +1,140 @@
+'''
+Evaluate a smooth transform over a region of pixels on a sparse lattice.
+
+The transform is evaluated every GridSpacing pixels and the mapped coordinates of the pixels in between are bilinearly
+interpolated.  The interpolation error is estimated by comparing the interpolated and transformed coordinates at the
+midpoint of every lattice cell.  The spacing is halved, down to MinGridSpacing, until the estimate is within the
+tolerance.  Pixels in cells that still exceed the tolerance, or that have a corner the transform does not map, are
+passed to the transform individually.
+
+If only some pixels are needed a mask can be passed.  The transform may be discontinuous at the edge of the mask, for
+example at the convex hull of a MeshWithRBFFallback, so cells only partly inside the mask are also evaluated per pixel.
+'''
+
+import numpy as np
+
+# Largest and smallest spacing of the lattice in pixels
+MaxGridSpacing = 64
+MinGridSpacing = 4
+
+
+def _MapPoints(transform, points, inverse, extrapolate):
+    if inverse:
+        return transform.InverseTransform(points, extrapolate=extrapolate)
+
+    return transform.Transform(points, extrapolate=extrapolate)
+
+
+def _Lattice(transform, botleft, area, spacing, inverse, extrapolate):
+    '''
+    :return: (Nodes, Midpoints, Error).  Nodes is the mapped lattice, RxCx2.  The lattice covers the region and its
+             last row and column may lie outside it.  Midpoints is the mapped center of each lattice cell,
+             (R-1)x(C-1)x2.  Error is the distance between each mapped cell center and its bilinear estimate, NaN if
+             the cell has a corner or center the transform does not map.
+    '''
+
+    NumRows = max(int(np.ceil((area[0] - 1) / spacing)) + 1, 2)
+    NumColumns = max(int(np.ceil((area[1] - 1) / spacing)) + 1, 2)
+
+    Y = botleft[0] + np.arange(NumRows, dtype=np.float64) * spacing
+    X = botleft[1] + np.arange(NumColumns, dtype=np.float64) * spacing
+
+    (NodeY, NodeX) = np.meshgrid(Y, X, indexing='ij')
+    (MidY, MidX) = np.meshgrid(Y[:-1] + spacing / 2.0, X[:-1] + spacing / 2.0, indexing='ij')
+    points = np.vstack((np.concatenate((NodeY.flat, MidY.flat)), np.concatenate((NodeX.flat, MidX.flat)))).transpose()
+
+    Mapped = np.asarray(_MapPoints(transform, points, inverse, extrapolate), dtype=np.float64)
+    Nodes = Mapped[:NodeY.size].reshape((NumRows, NumColumns, 2))
+    Midpoints = Mapped[NodeY.size:].reshape((NumRows - 1, NumColumns - 1, 2))
+
+    Estimate = (Nodes[:-1, :-1] + Nodes[1:, :-1] + Nodes[:-1, 1:] + Nodes[1:, 1:]) / 4.0
+    Error = np.sqrt(np.sum(np.square(Estimate - Midpoints), axis=2))
+    return (Nodes, Midpoints, Error)
+
+
+def _CellIndicies(length, spacing, NumCells):
+    '''
+    :return: (Cell, Fraction) the lattice cell containing each pixel along an axis and the pixel's fractional position within it
+    '''
+    Position = np.arange(length)
+    Cell = np.minimum(Position // spacing, NumCells - 1)
+    Fraction = (Position - Cell * spacing) / float(spacing)
+    return (Cell, Fraction)
+
+
+def _CellCoverage(Mask, spacing, NumCells):
+    '''
+    :return: (Needed, Partial).  Needed is True for lattice cells containing a pixel in the mask.  Partial is True for
+             needed cells where the mask does not cover the cell and its corners, which are the first row and column
+             of the neighboring cells.
+    '''
+    RowStarts = np.arange(NumCells[0]) * spacing
+    ColumnStarts = np.arange(NumCells[1]) * spacing
+    Missing = ~Mask
+
+    Needed = np.logical_or.reduceat(np.logical_or.reduceat(Mask, RowStarts, axis=0), ColumnStarts, axis=1)
+
+    Partial = np.logical_or.reduceat(np.logical_or.reduceat(Missing, RowStarts, axis=0), ColumnStarts, axis=1)
+    Partial[:-1] |= np.logical_or.reduceat(Missing[RowStarts[1:]], ColumnStarts, axis=1)
+    Partial[:, :-1] |= np.logical_or.reduceat(Missing[:, ColumnStarts[1:]], RowStarts, axis=0)
+    Partial[:-1, :-1] |= Missing[RowStarts[1:]][:, ColumnStarts[1:]]
+
+    return (Needed, Partial & Needed)
+
+
+def TransformGrid(transform, botleft, area, tolerance, inverse=True, extrapolate=False, Mask=None):
+    '''
+    Map every pixel of a region through a transform, evaluating the transform on a sparse lattice where the
+    bilinear interpolation error is estimated to be within the tolerance.
+
+    :param transform transform: Transform, should be smooth for the lattice to be effective
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner of the region
+    :param 1x2_array area: The (Height, Width) of the region
+    :param float tolerance: Largest acceptable distance, in pixels, between interpolated and transformed coordinates
+    :param bool inverse: True to map fixed space to warped space
+    :param bool extrapolate: Passed to the transform
+    :param ndarray Mask: Optional HxW boolean array, True for the pixels that are needed
+    :return: HxWx2 float32 array of mapped coordinates.  NaN for pixels the transform cannot map.  Pixels outside the
+             mask are undefined.
+    :rtype: ndarray
+    '''
+
+    area = (int(area[0]), int(area[1]))
+    botleft = np.asarray(botleft, dtype=np.float64)
+
+    if Mask is None:
+        Mask = np.ones(area, dtype=bool)
+
+    spacing = int(min(MaxGridSpacing, max(area)))
+    while True:
+        with np.errstate(invalid='ignore'):
+            (Nodes, Midpoints, Error) = _Lattice(transform, botleft, area, spacing, inverse, extrapolate)
+
+        (Needed, Partial) = _CellCoverage(Mask, spacing, Error.shape)
+
+        Unmapped = np.isnan(Error)
+        with np.errstate(invalid='ignore'):
+            Inaccurate = (Error > tolerance) & Needed & ~Partial
+
+        if spacing <= MinGridSpacing or not np.any(Inaccurate):
+            break
+
+        spacing = max(spacing // 2, MinGridSpacing)
+
+    (Row, RowFraction) = _CellIndicies(area[0], spacing, Error.shape[0])
+    (Column, ColumnFraction) = _CellIndicies(area[1], spacing, Error.shape[1])
+
+    # Interpolate along the lattice rows, then between them
+    Mapped = np.empty((area[0], area[1], 2), dtype=np.float32)
+    for iAxis in range(2):
+        AlongRows = Nodes[:, Column, iAxis] * (1.0 - ColumnFraction) + Nodes[:, Column + 1, iAxis] * ColumnFraction
+        Mapped[:, :, iAxis] = AlongRows[Row] * (1.0 - RowFraction)[:, np.newaxis] + AlongRows[Row + 1] * RowFraction[:, np.newaxis]
+        del AlongRows
+
+    ExactCells = Unmapped | Inaccurate | Partial
+    if np.any(ExactCells):
+        Exact = np.nonzero(ExactCells[Row][:, Column] & Mask)
+        points = np.vstack(Exact).transpose() + botleft
+        Mapped[Exact] = _MapPoints(transform, points, inverse, extrapolate)
+
+    return Mapped
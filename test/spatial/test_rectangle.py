@@ -86,6 +86,15 @@ class Test(unittest.TestCase):
         overlap_rect_list = list(self.OverlapRects.values())
         self.EnumerateOverlappingRectangles(overlap_rect_list)
         
+    def testRectangleSetIntersect(self):
+        rect_list = list(self.ARects.values()) + list(self.BRects.values()) + list(self.OverlapRects.values())
+        rset = spatial.RectangleSet.Create(rect_list)
+
+        for query in rect_list:
+            intersecting = set(rset.Intersect(query))
+            for i, rect in enumerate(rect_list):
+                self.assertEqual(i in intersecting, spatial.Rectangle.contains(query, rect), "Intersect disagrees with Rectangle.contains for %s and %s" % (str(query), str(rect)))
+
     def EnumerateOverlappingRectangles(self, rect_list):
          
         rset = spatial.RectangleSet.Create(rect_list)
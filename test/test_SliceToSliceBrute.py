@@ -16,6 +16,7 @@ import nornir_imageregistration.core as core
 import nornir_imageregistration.scripts.nornir_rotate_translate
 import nornir_imageregistration.stos_brute as stos_brute
 import nornir_shared.images as images
+import numpy as np
 
 from . import setup_imagetest
 
@@ -122,6 +123,108 @@ class TestStosBrute(setup_imagetest.ImageTestBase):
         self.assertIsNotNone(loadedTransform)
 
 
+    def testStosBruteFourierMellin(self):
+
+        WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(WarpedImagePath), "Missing test input")
+        FixedImagePath = os.path.join(self.ImportedDataPath, "mini_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(FixedImagePath), "Missing test input")
+
+        AlignmentRecord = stos_brute.SliceToSliceBruteForce(FixedImagePath,
+                               WarpedImagePath, SearchMode=stos_brute.AngleSearchMode.FOURIER_MELLIN)
+
+        self.Logger.info("Best alignment: " + str(AlignmentRecord))
+        CheckAlignmentRecord(self, AlignmentRecord, angle=-132.0, X=-4, Y=22)
+
+    def testStosBruteFourierMellinScale(self):
+        '''The Fourier-Mellin search should estimate the scale between synthetic rotated images'''
+        import scipy.ndimage
+
+        # Extrema are replaced with random noise
+        np.random.seed(0)
+        rng = np.random.RandomState(0)
+        image = scipy.ndimage.gaussian_filter(rng.rand(512, 512), 3).astype(np.float32)
+        image = (image - image.min()) / (image.max() - image.min())
+        FixedImage = image[128:384, 128:384]
+
+        def RotatedWarpedImage(scale):
+            Enlarged = scipy.ndimage.rotate(scipy.ndimage.zoom(image, scale, order=1), 20, reshape=False)
+            (CenterY, CenterX) = (Enlarged.shape[0] // 2, Enlarged.shape[1] // 2)
+            return Enlarged[CenterY - 128:CenterY + 128, CenterX - 128:CenterX + 128]
+
+        for scale in [0.85, 1.15]:
+            candidates = stos_brute.FourierMellinRotationCandidates(FixedImage, RotatedWarpedImage(scale), NumCandidates=1, EstimateScale=True)
+            self.assertAlmostEqual(candidates[0][0], -20.0, delta=0.5)
+            self.assertAlmostEqual(candidates[0][1], scale, delta=0.02)
+
+        WarpedImage = RotatedWarpedImage(1.0)
+        AlignmentRecord = stos_brute.SliceToSliceBruteForce(FixedImage, WarpedImage, SearchMode=stos_brute.AngleSearchMode.FOURIER_MELLIN,
+                                                            SingleThread=True, EstimateScale=True)
+        # The noise padding the images moves the refined angle of these small images by about a degree
+        CheckAlignmentRecord(self, AlignmentRecord, angle=-20.0, X=0, Y=0, adelta=1.5)
+        self.assertAlmostEqual(AlignmentRecord.ScaleEstimate, 1.0, delta=0.02)
+        self.assertAlmostEqual(AlignmentRecord.Invert().ScaleEstimate, 1.0 / AlignmentRecord.ScaleEstimate)
+
+        AlignmentRecord = stos_brute.SliceToSliceBruteForce(FixedImage, WarpedImage, SearchMode=stos_brute.AngleSearchMode.FOURIER_MELLIN, SingleThread=True)
+        self.assertIsNone(AlignmentRecord.ScaleEstimate, "Scale is only estimated when requested")
+
+        # Estimating the scale should not change the translation of downsampled images.  Both searches score the same
+        # candidate angles with the same noise.
+        WarpedImage = scipy.ndimage.shift(WarpedImage, (8, -8), mode='nearest')
+        records = []
+        for EstimateScale in (False, True):
+            np.random.seed(1)
+            records.append(stos_brute.SliceToSliceBruteForce(FixedImage, WarpedImage, SearchMode=stos_brute.AngleSearchMode.FOURIER_MELLIN, SingleThread=True,
+                                                             LargestDimension=200, NumAngleCandidates=1, EstimateScale=EstimateScale))
+        self.assertIsNotNone(records[1].ScaleEstimate)
+        self.assertEqual(records[0].angle, records[1].angle)
+        self.assertTrue(np.array_equal(records[0].peak, records[1].peak), "Peak should not depend on EstimateScale: %s != %s" % (str(records[0].peak), str(records[1].peak)))
+
+    def testSearchTargetShape(self):
+        '''Every angle of a search should be padded to one shape, large enough for the rotated warped image'''
+        import scipy.ndimage
+
+        (FixedShape, WarpedShape) = ((900, 1200), (900, 1200))
+        AngleList = list(range(-180, 180, 2))
+        PaddedFixedShape = core.PaddedShapeForPhaseCorrelation(FixedShape, MinOverlap=0.75)
+        TargetShape = stos_brute._PhaseCorrelationTargetShape(PaddedFixedShape, WarpedShape, AngleList, MinOverlap=0.75)
+
+        for angle in AngleList:
+            RotatedPaddedShape = core.PaddedShapeForPhaseCorrelation(stos_brute._RotatedImageShape(WarpedShape, angle), MinOverlap=0.75)
+            self.assertTrue(np.all(np.array(TargetShape) >= RotatedPaddedShape), "Target shape %s is smaller than the padded image at %g degrees" % (str(TargetShape), angle))
+
+        # Scoring at the shared shape finds the same offset as scoring at the size the angle requires
+        rng = np.random.RandomState(0)
+        image = scipy.ndimage.gaussian_filter(rng.rand(160, 200), 2).astype(np.float32)
+        FixedImage = image[10:150, 20:180]
+        WarpedImage = scipy.ndimage.shift(image, (4, -6), mode='nearest')[10:150, 20:180]
+        AngleList = [-30, 0, 30]
+
+        (fixedStats, warpedStats) = (core.ImageStats.CalcStats(FixedImage), core.ImageStats.CalcStats(WarpedImage))
+        PaddedFixed = core.PadImageForPhaseCorrelation(FixedImage, MinOverlap=0.75, ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std)
+        TargetShape = stos_brute._PhaseCorrelationTargetShape(PaddedFixed.shape, WarpedImage.shape, AngleList, MinOverlap=0.75)
+        FixedFFTs = stos_brute._CreateFixedFFTs(PaddedFixed, TargetShape, fixedStats, UseMemmap=False)
+        self.assertEqual(list(FixedFFTs.keys()), [TargetShape])
+
+        np.random.seed(0)
+        expected = stos_brute.ScoreOneAngle(PaddedFixed, WarpedImage, 0, fixedStats=fixedStats, warpedStats=warpedStats)
+        np.random.seed(0)
+        record = stos_brute.ScoreOneAngle(PaddedFixed, WarpedImage, 0, fixedStats=fixedStats, warpedStats=warpedStats, FixedFFTs=FixedFFTs, TargetShape=TargetShape)
+        self.assertTrue(np.allclose(record.peak, expected.peak, atol=0.5), "%s != %s" % (str(record), str(expected)))
+
+    def testStosBrutePyramid(self):
+
+        WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(WarpedImagePath), "Missing test input")
+        FixedImagePath = os.path.join(self.ImportedDataPath, "mini_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(FixedImagePath), "Missing test input")
+
+        AlignmentRecord = stos_brute.SliceToSliceBruteForce(FixedImagePath,
+                               WarpedImagePath, SearchMode=stos_brute.AngleSearchMode.PYRAMID)
+
+        self.Logger.info("Best alignment: " + str(AlignmentRecord))
+        CheckAlignmentRecord(self, AlignmentRecord, angle=-132.0, X=-4, Y=22)
+
     def testStosBruteWithMask(self):
         WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
         self.assertTrue(os.path.exists(WarpedImagePath), "Missing test input")
@@ -159,6 +262,26 @@ class TestStosBrute(setup_imagetest.ImageTestBase):
         self.assertEqual(loadedStosObj.ControlMaskName, controlMaskName, "Mask in .stos does not match mask used in alignment\n")
         self.assertEqual(loadedStosObj.MappedMaskName, warpedMaskName, "Mask in .stos does not match mask used in alignment\n")
         
+    def testStosBruteMaskedCorrelation(self):
+        WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(WarpedImagePath), "Missing test input")
+        FixedImagePath = os.path.join(self.ImportedDataPath, "mini_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(FixedImagePath), "Missing test input")
+
+        WarpedImageMaskPath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_mask__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(WarpedImageMaskPath), "Missing test input")
+        FixedImageMaskPath = os.path.join(self.ImportedDataPath, "mini_TEM_Leveled_mask__feabinary_Cel64_Mes8_sp4_Mes8.png")
+        self.assertTrue(os.path.exists(FixedImageMaskPath), "Missing test input")
+
+        AlignmentRecord = stos_brute.SliceToSliceBruteForce(FixedImagePath,
+                               WarpedImagePath,
+                               FixedImageMaskPath,
+                               WarpedImageMaskPath,
+                               CorrelationMode=core.CorrelationModes.MASKED_NCC)
+
+        self.Logger.info("Best alignment: " + str(AlignmentRecord))
+        CheckAlignmentRecord(self, AlignmentRecord, angle=-132.0, X=-4, Y=22)
+
     def testStosBruteExecute(self):
          
         WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
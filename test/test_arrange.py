@@ -94,6 +94,55 @@ class TestBasicTileAlignment(setup_imagetest.MosaicTestBase):
         # self.assertAlmostEqual(alignrecord.peak[0], ExpectedOffset[0], delta=2, msg="Y dimension incorrect: " + str(alignrecord.peak) + " != " + str(ExpectedOffset))
 
 
+class TestSyntheticTileAlignment(setup_imagetest.TestBase):
+
+    def test_FindTileOffsets(self):
+        '''Offsets between tiles cut from one image should be found whether pairs are registered individually or in batches'''
+        from scipy import ndimage
+        from nornir_imageregistration.tile import Tile
+        from nornir_imageregistration.transforms.triangulation import Triangulation
+
+        os.makedirs(self.TestOutputPath, exist_ok=True)
+
+        rng = np.random.RandomState(0)
+        image = ndimage.gaussian_filter(rng.rand(600, 600), 2).astype(np.float32)
+
+        (grid_dim, tile_size, spacing) = (3, 200, 170)
+        tiles = {}
+        positions = {}
+        for iY in range(grid_dim):
+            for iX in range(grid_dim):
+                ID = (iY * grid_dim) + iX
+                (Y, X) = (iY * spacing, iX * spacing)
+                positions[ID] = np.array((Y, X)) + rng.randint(0, 12, size=2)
+                ImagePath = os.path.join(self.TestOutputPath, "%d.npy" % ID)
+                np.save(ImagePath, image[positions[ID][0]:positions[ID][0] + tile_size, positions[ID][1]:positions[ID][1] + tile_size])
+
+                transform = Triangulation(np.array([[Y, X, 0, 0],
+                                                    [Y + tile_size, X, tile_size, 0],
+                                                    [Y, X + tile_size, 0, tile_size],
+                                                    [Y + tile_size, X + tile_size, tile_size, tile_size]], dtype=np.float64))
+                tiles[ID] = Tile(transform, ImagePath, ID)
+
+        original_batch_size = arrange.PhaseCorrelationBatchSize
+        try:
+            for batch_size in (1, original_batch_size):
+                arrange.PhaseCorrelationBatchSize = batch_size
+                layout = arrange._FindTileOffsets(tiles, excess_scalar=1.5, imageScale=1.0)
+
+                num_offsets = 0
+                for A_ID in layout.nodes:
+                    for B_ID in layout.nodes[A_ID].ConnectedIDs:
+                        num_offsets += 1
+                        expected = positions[B_ID] - positions[A_ID]
+                        offset = layout.nodes[A_ID].GetOffset(B_ID)
+                        self.assertTrue(np.allclose(offset, expected, atol=1.0), "%d -> %d offset %s != %s with batch size %d" % (A_ID, B_ID, str(offset), str(expected), batch_size))
+
+                self.assertGreater(num_offsets, 0)
+        finally:
+            arrange.PhaseCorrelationBatchSize = original_batch_size
+
+
 class TestMosaicArrange(setup_imagetest.MosaicTestBase, setup_imagetest.PickleHelper):
 
     @property
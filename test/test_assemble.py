@@ -89,6 +89,123 @@ class TestTransformROI(setup_imagetest.ImageTestBase):
         self.assertAlmostEqual(min(points[:, spatial.iPoint.X]), 0, delta=0.01)
         self.assertAlmostEqual(max(points[:, spatial.iPoint.X]), 1, delta=0.01)
 
+    def test_CoordinateMapCache(self):
+        import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
+        from nornir_imageregistration.transforms.triangulation import Triangulation
+
+        # Rotate a 20x60 tile by 30 degrees
+        canvasShape = (20, 60)
+        WarpedPoints = numpy.array([[0, 0], [0, 60], [20, 0], [20, 60]], dtype=numpy.float64)
+        rotation = numpy.array([[numpy.cos(numpy.pi / 6), -numpy.sin(numpy.pi / 6)], [numpy.sin(numpy.pi / 6), numpy.cos(numpy.pi / 6)]])
+        FixedPoints = WarpedPoints.dot(rotation.T)
+        transform = Triangulation(numpy.hstack((FixedPoints, WarpedPoints)))
+
+        cache = coordinate_map_cache.DefaultCache
+        cache.Clear()
+        (fixedpoints, points) = assemble.DestinationROI_to_SourceROI(transform, (-5, -5), canvasShape)
+        self.assertEqual(len(cache), 1)
+        self.assertLess(points.shape[0], numpy.prod(canvasShape), "Rotated corners should not map")
+        self.assertEqual(fixedpoints.shape, points.shape)
+
+        # The second call reuses the cached map
+        (cachedfixedpoints, cachedpoints) = assemble.DestinationROI_to_SourceROI(transform, (-5, -5), canvasShape)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(numpy.array_equal(fixedpoints, cachedfixedpoints))
+        self.assertTrue(numpy.array_equal(points, cachedpoints))
+
+        # Changing the region or the transform creates a new map
+        assemble.DestinationROI_to_SourceROI(transform, (-4, -5), canvasShape)
+        transform.Scale(2.0)
+        assemble.DestinationROI_to_SourceROI(transform, (-5, -5), canvasShape)
+        self.assertEqual(len(cache), 3)
+
+        # Maps saved to the cache directory are loaded by other caches
+        CacheDir = os.path.join(self.TestOutputPath, 'CoordinateMapCache')
+        diskCache = coordinate_map_cache.CoordinateMapCache(MaxBytes=0, CacheDirectory=CacheDir)
+        os.makedirs(CacheDir, exist_ok=True)
+        key = coordinate_map_cache.CoordinateMapKey(transform, (-5, -5), canvasShape, True, False, WarpMethod=assemble.DefaultWarpMethod)
+        diskCache.Add(key, *cache.Get(key))
+        self.assertEqual(len(diskCache), 0)
+
+        loadingCache = coordinate_map_cache.CoordinateMapCache(CacheDirectory=CacheDir)
+        (ValidMask, MappedCoords) = loadingCache.Get(key)
+        self.assertTrue(numpy.array_equal(ValidMask, cache.Get(key)[0]))
+        self.assertTrue(numpy.array_equal(MappedCoords, cache.Get(key)[1]))
+
+        # Trimming the directory deletes the least recently used maps
+        keys = [key]
+        for iY in range(2):
+            keys.append(coordinate_map_cache.CoordinateMapKey(transform, (iY, -5), canvasShape, True, False, WarpMethod=assemble.DefaultWarpMethod))
+            diskCache.Add(keys[-1], *cache.Get(key))
+
+        for (i, k) in enumerate(keys):
+            os.utime(os.path.join(CacheDir, k + '_mask.npy'), (1000 + i, 1000 + i))
+
+        self.assertIsNotNone(coordinate_map_cache.CoordinateMapCache(MaxBytes=0, CacheDirectory=CacheDir).Get(keys[0]))
+        MapBytes = sum([os.path.getsize(os.path.join(CacheDir, key + suffix)) for suffix in ('_mask.npy', '_coords.npy')])
+        coordinate_map_cache.TrimCacheDirectory(CacheDir, MaxBytes=2 * MapBytes)
+        self.assertEqual(sorted(os.listdir(CacheDir)), sorted([k + suffix for k in (keys[0], keys[2]) for suffix in ('_mask.npy', '_coords.npy')]),
+                         "The map loaded most recently and the newest map should be kept")
+        cache.Clear()
+
+    def test_PiecewiseAffine(self):
+        import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
+        from nornir_imageregistration.transforms.meshwithrbffallback import MeshWithRBFFallback
+        from nornir_imageregistration.transforms.triangulation import Triangulation
+
+        # Randomly perturbed grid over a 100x150 tile
+        rng = numpy.random.RandomState(0)
+        (y, x) = numpy.meshgrid(numpy.linspace(0, 100, 6), numpy.linspace(0, 150, 7), indexing='ij')
+        WarpedPoints = numpy.vstack((y.flat, x.flat)).transpose()
+        FixedPoints = WarpedPoints + rng.uniform(-3, 3, WarpedPoints.shape) + (10, 20)
+
+        cache = coordinate_map_cache.DefaultCache
+        cache.Clear()
+        for TransformClass in [Triangulation, MeshWithRBFFallback]:
+            transform = TransformClass(numpy.hstack((FixedPoints, WarpedPoints)))
+            for extrapolate in [False, True]:
+                for ROIFunction in [assemble.DestinationROI_to_SourceROI, assemble.SourceROI_to_DestinationROI]:
+                    NumCached = len(cache)
+                    expected = ROIFunction(transform, (-0.5, 3.25), (120, 180), extrapolate=extrapolate, WarpMethod=assemble.WarpMethods.POINTS)
+                    actual = ROIFunction(transform, (-0.5, 3.25), (120, 180), extrapolate=extrapolate, WarpMethod=assemble.WarpMethods.PIECEWISE_AFFINE)
+                    self.assertEqual(len(cache), NumCached + 2, "Maps of each warp method should be cached separately")
+
+                    # The same pixels are mapped to the same coordinates
+                    for (e, a) in zip(expected, actual):
+                        self.assertEqual(e.shape, a.shape, "%s mapped different pixels" % TransformClass.__name__)
+                        self.assertTrue(numpy.allclose(e, a, atol=1e-3), "%s mapped pixels to different coordinates" % TransformClass.__name__)
+
+        cache.Clear()
+
+    def test_SparseGrid(self):
+        import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
+        from nornir_imageregistration.transforms.meshwithrbffallback import MeshWithRBFFallback
+        from nornir_imageregistration.transforms.rbftransform import RBFWithLinearCorrection
+        from nornir_imageregistration.transforms.triangulation import Triangulation
+
+        rng = numpy.random.RandomState(0)
+        WarpedPoints = rng.uniform(0, 300, (40, 2))
+        FixedPoints = WarpedPoints * 1.02 + rng.uniform(-2, 2, WarpedPoints.shape) + (10, 20)
+        PointPairs = numpy.hstack((FixedPoints, WarpedPoints))
+
+        tolerance = 0.1
+        cache = coordinate_map_cache.DefaultCache
+        for (transform, ROIFunction, extrapolate) in [(RBFWithLinearCorrection(WarpedPoints, FixedPoints), assemble.SourceROI_to_DestinationROI, False),
+                                                     (MeshWithRBFFallback(PointPairs), assemble.DestinationROI_to_SourceROI, True),
+                                                     (Triangulation(PointPairs), assemble.DestinationROI_to_SourceROI, False)]:
+            cache.Clear()
+            expected = ROIFunction(transform, (-50, -40), (400, 420), extrapolate=extrapolate, WarpMethod=assemble.WarpMethods.POINTS)
+            cache.Clear()
+            actual = ROIFunction(transform, (-50, -40), (400, 420), extrapolate=extrapolate, SparseGridTolerance=tolerance)
+
+            # The same pixels are mapped.  The error is estimated from the cell midpoints so allow some margin.
+            for (e, a) in zip(expected, actual):
+                self.assertEqual(e.shape, a.shape, "%s mapped different pixels" % transform.__class__.__name__)
+                Error = numpy.sqrt(numpy.sum(numpy.square(e - a), axis=1))
+                self.assertLess(numpy.max(Error), tolerance * 2, "%s interpolation error is too large" % transform.__class__.__name__)
+
+        cache.Clear()
+
 class TestAssemble(setup_imagetest.ImageTestBase):
     
     def test_TransformImageIdentity(self):
@@ -114,7 +231,66 @@ class TestAssemble(setup_imagetest.ImageTestBase):
         self.assertIsNotNone(outputImage, msg="No image produced by TransformImage")
         self.assertEqual(outputImage.shape[0], Height, msg="Output image height should match")
         self.assertEqual(outputImage.shape[1], Width, msg="Output image width should match")
-        
+
+    def test_TransformImagePrefilter(self):
+        from scipy import ndimage
+
+        # Large enough to require more than one tile
+        (Height, Width) = (2100, 300)
+        warpedImage = ndimage.gaussian_filter(numpy.random.RandomState(0).rand(Height, Width), 2).astype(numpy.float32)
+
+        corners = numpy.array([[0, 0], [Height, 0], [0, Width], [Height, Width]], dtype=numpy.float64)
+        shift = numpy.array([0.5, 0.25])
+        transform = nornir_imageregistration.transforms.triangulation.Triangulation(numpy.hstack((corners, corners + shift)))
+
+        (y, x) = numpy.mgrid[0:Height, 0:Width]
+        for order in [1, 3]:
+            expected = ndimage.map_coordinates(warpedImage, [y + shift[0], x + shift[1]], order=order, mode='constant')
+            outputImage = assemble.TransformImage(transform, numpy.array([Height, Width]), warpedImage, order=order, prefilter=True)
+
+            # Prefiltering the whole image once matches interpolating the whole image, ignoring the edge the triangulation does not map
+            self.assertTrue(numpy.allclose(outputImage[:-1, :-1], expected[:-1, :-1], atol=1e-5), "Order %d interpolation does not match map_coordinates" % order)
+
+    def test_TransformStosStreamed(self):
+        from PIL import Image
+        from scipy import ndimage
+
+        (Height, Width) = (2100, 300)
+        image = ndimage.gaussian_filter(numpy.random.RandomState(0).rand(Height, Width), 2)
+        image = (image - image.min()) / (image.max() - image.min())
+
+        FixedImagePath = os.path.join(self.VolumeDir, "StreamedFixed.png")
+        core.SaveImage(FixedImagePath, image[:2000, :280])
+
+        # Image files are decoded to a temporary .npy file, .npy files are read directly.  The 16-bit TIFF keeps its stored range.
+        WarpedImagePaths = [os.path.join(self.VolumeDir, "StreamedWarped" + ext) for ext in (".png", ".tif", ".npy")]
+        core.SaveImage(WarpedImagePaths[0], image)
+        Image.fromarray((image * 65535).astype(numpy.uint16)).save(WarpedImagePaths[1])
+        numpy.save(WarpedImagePaths[2], image.astype(numpy.float32))
+
+        corners = numpy.array([[0, 0], [Height, 0], [0, Width], [Height, Width]], dtype=numpy.float64)
+        transform = nornir_imageregistration.transforms.triangulation.Triangulation(numpy.hstack((corners * 0.95 + (10, -5), corners)))
+
+        OutputPath = os.path.join(self.VolumeDir, "StreamedOutput.npy")
+        for WarpedImagePath in WarpedImagePaths:
+            expected = assemble.TransformStos(transform, None, FixedImagePath, WarpedImagePath)
+            tolerance = 1e-5 * max(numpy.max(expected), 1.0)
+
+            streamedImage = assemble.TransformStos(transform, OutputPath, FixedImagePath, WarpedImagePath, Stream=True)
+            self.assertTrue(os.path.exists(OutputPath), "Streamed image does not exist")
+            self.assertEqual(streamedImage.shape, expected.shape)
+            self.assertTrue(numpy.allclose(streamedImage, expected, atol=tolerance), "Streamed image should match the image warped in memory for %s" % WarpedImagePath)
+
+            # Small tiles read separate regions of the warped image
+            streamedImage = assemble.TransformStosStreamed(transform, OutputPath, FixedImagePath, WarpedImagePath, TileSize=(256, 128))
+            self.assertTrue(numpy.allclose(streamedImage, expected, atol=tolerance), "Streamed image should not depend on the tile size for %s" % WarpedImagePath)
+            del streamedImage
+
+        self.assertGreater(numpy.max(expected), 0.5, "The .npy image should not be rescaled")
+
+        # The temporary .npy copies of the warped images are removed
+        self.assertEqual(sorted(os.listdir(self.VolumeDir)), sorted([os.path.basename(path) for path in WarpedImagePaths + [FixedImagePath, OutputPath]]))
+
     def test_warpedImageToFixedSpaceTranslate(self):
         WarpedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
         self.assertTrue(os.path.exists(WarpedImagePath), "Missing test input")
@@ -223,6 +399,15 @@ class TestStosFixedMovingAssemble(setup_imagetest.ImageTestBase):
     
         
 
+    def RunStosAssembleStreamed(self, stosFullPath):
+        OutputPath = os.path.join(self.VolumeDir, "test_StosAssemble.npy");
+
+        warpedImage = assemble.TransformStos(stosFullPath, OutputPath, self.FixedImagePath, self.WarpedImagePath, Stream=True)
+        self.assertIsNotNone(warpedImage)
+
+        self.assertTrue(os.path.exists(OutputPath), "RegisteredImage does not exist")
+        self.assertEqual(core.GetImageSize(self.FixedImagePath), core.GetImageSize(OutputPath))
+
     def test_GridStosAssemble(self):
         stosFullPath = os.path.join(self.ImportedDataPath, "..", "Transforms", "FixedMoving_Grid.stos")
         self.RunStosAssemble(stosFullPath)
@@ -230,6 +415,10 @@ class TestStosFixedMovingAssemble(setup_imagetest.ImageTestBase):
     def test_MeshStosAssemble(self):
         stosFullPath = os.path.join(self.ImportedDataPath, "..", "Transforms", "FixedMoving_Mesh.stos")
         self.RunStosAssemble(stosFullPath)
+
+    def test_MeshStosAssembleStreamed(self):
+        stosFullPath = os.path.join(self.ImportedDataPath, "..", "Transforms", "FixedMoving_Mesh.stos")
+        self.RunStosAssembleStreamed(stosFullPath)
          
 
 
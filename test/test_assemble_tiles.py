@@ -16,6 +16,7 @@ import nornir_imageregistration.assemble_tiles as at
 import nornir_imageregistration.core as core
 import nornir_imageregistration.tileset as tiles
 import nornir_imageregistration.transforms.factory as tfactory
+from nornir_imageregistration.transforms import triangulation
 from nornir_shared.tasktimer import TaskTimer
 import numpy as np
 
@@ -213,6 +214,48 @@ class BasicTests(TestMosaicAssemble):
         self.assertAlmostEqual(dMatrix[0, 5], 5, 2, "Distance matrix incorrect")
         self.assertAlmostEqual(dMatrix[4, 0], 5.53, 2, "Distance matrix incorrect")
 
+    def test_AnalyticCenterDistance(self):
+        '''The analytic z-buffer should match the distance image at every pixel'''
+
+        for shape in [(10, 10), (11, 11), (10, 11)]:
+            dMatrix = at.CreateDistanceImage(shape)
+
+            (i_y, i_x) = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+            coords = np.vstack((i_y.flat, i_x.flat)).transpose().astype(np.float32)
+
+            distance = at.CenterDistanceForCoords(coords, shape)
+            self.assertTrue(np.allclose(distance.reshape(shape), dMatrix, atol=1e-4), "Analytic distance does not match distance image for shape %s" % str(shape))
+
+        outside = at.CenterDistanceForCoords(np.array([[-1, 0], [0, 10.5]], dtype=np.float32), (10, 10))
+        self.assertTrue(np.all(np.isinf(outside)), "Coordinates outside the image should have infinite distance")
+
+    def test_StorageDtype(self):
+        '''Assembled images and z-buffers should use the requested storage dtype'''
+
+        tile_shape = (64, 64)
+        transforms = []
+        imagepaths = []
+        for (i, offset) in enumerate([(0, 0), (0, 48)]):
+            imagepath = os.path.join(self.TestOutputPath, 'storage_tile_%d.npy' % i)
+            np.save(imagepath, np.random.rand(*tile_shape).astype(np.float32))
+            imagepaths.append(imagepath)
+
+            corners = np.array([[0, 0], [0, tile_shape[1]], [tile_shape[0], 0], [tile_shape[0], tile_shape[1]]], dtype=np.float64)
+            transforms.append(triangulation.Triangulation(np.hstack((corners + np.array(offset), corners))))
+
+        (halfImage, halfMask) = at.TilesToImage(transforms, imagepaths, requiredScale=1.0)
+        self.assertEqual(halfImage.dtype, core.StorageDtype)
+        self.assertEqual(halfImage.dtype, np.float16, "Mosaics should be stored as float16 by default")
+
+        (image, mask) = at.TilesToImage(transforms, imagepaths, requiredScale=1.0, StorageDtype=np.float32)
+        self.assertEqual(image.dtype, np.float32)
+        self.assertTrue(np.array_equal(mask, halfMask), "Storage dtype should not change which pixels are mapped")
+        self.assertLess(np.max(np.abs(image - halfImage.astype(image.dtype))), 1e-2, "float16 storage should only lose precision")
+
+        tile = at.TransformTile(transforms[0], imagepaths[0], requiredScale=1.0, StorageDtype=np.float32)
+        self.assertEqual(tile.image.dtype, np.float32)
+        self.assertEqual(tile.centerDistanceImage.dtype, np.float32)
+
 
     def test_MosaicBoundsEachMosaicType(self):
 
@@ -271,6 +314,24 @@ class IDOCTests(TestMosaicAssemble):
 
         self.ParallelAssembleEachMosaic(mosaicFiles, tilesDir)
 
+    def test_AssembleIDOCChunked(self):
+        '''Chunked assembly to disk should produce the same mosaic as assembling in memory'''
+
+        mosaicFiles = self.GetMosaicFiles()
+        tilesDir = self.GetTileFullPath(downsamplePath='004')
+
+        mosaic = Mosaic.LoadFromMosaicFile(mosaicFiles[0])
+        mosaic.TranslateToZeroOrigin()
+
+        OutputImagePath = os.path.join(self.TestOutputPath, 'ChunkedIDOC.npy')
+        (chunkedImage, chunkedMask) = mosaic.AssembleTilesToFile(tilesDir, OutputImagePath, ChunkSize=512)
+        self.assertTrue(os.path.exists(OutputImagePath), "Chunked output image not found")
+
+        (wholeImage, wholeMask) = mosaic.AssembleTiles(tilesDir, usecluster=False)
+
+        self.assertEqual(chunkedImage.shape, wholeImage.shape, "Chunked assembly should produce an image the same size as in memory assembly")
+        self.assertGreater(np.mean(chunkedMask == wholeMask), 0.99, "Chunked assembly mask should match in memory assembly")
+
     def test_AssembleTilesIDoc(self):
         '''Assemble small 256x265 tiles from a transform and image in a mosaic'''
 
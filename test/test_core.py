@@ -5,16 +5,26 @@ Created on Mar 25, 2013
 '''
 import logging
 import os
+import time
 import unittest
 
 from pylab import *
 
+import nornir_imageregistration.completion_queue as completion_queue
 import nornir_imageregistration.core as core
+import nornir_imageregistration.fft_backend as fft_backend
 import nornir_imageregistration.stos_brute as stos_brute
+import nornir_pools
+import scipy.ndimage
 
 from . import setup_imagetest
 
 
+def _SquareAfterDelay(value):
+    time.sleep(0.01)
+    return value * value
+
+
 class Test(setup_imagetest.ImageTestBase):
 
 
@@ -50,6 +60,314 @@ class Test(setup_imagetest.ImageTestBase):
         self.__CheckRangeForPowerOfTwo(1.0)
         self.__CheckRangeForPowerOfTwo(0.5)
 
+    def testNearestSmoothSize(self):
+
+        for overlap in [1.0, 0.5, 0.05]:
+            for v in range(2, 513):
+                newDim = core.NearestSmoothSizeWithOverlap(v, overlap=overlap)
+                requiredDim = core.DimensionWithOverlap(v, overlap=overlap)
+
+                self.assertTrue(newDim % 2 == 0, "%d is not even" % newDim)
+                self.assertTrue(core.IsSmooth(newDim), "%d has a prime factor larger than 7" % newDim)
+                self.assertGreaterEqual(newDim, requiredDim, "%d padded to %d, smaller than required size %g" % (v, newDim, requiredDim))
+                self.assertLessEqual(newDim, core.NearestPowerOfTwoWithOverlap(v, overlap=overlap), "%d padded to %d, larger than the power of two" % (v, newDim))
+
+        self.assertEqual(core.NearestSmoothSize(1000, multiple=32), 1024)
+        self.assertEqual(core.NearestSmoothSize(1100, multiple=32), 1120)
+
+        image = np.random.rand(100, 130).astype(np.float32)
+        self.assertEqual(core.PadImageForPhaseCorrelation(image, MinOverlap=1.0, PaddingPolicy=core.PaddingPolicies.SMOOTH).shape, (100, 140))
+        self.assertEqual(core.PadImageForPhaseCorrelation(image, MinOverlap=1.0, PowerOfTwo=True).shape, (128, 256))
+        self.assertEqual(core.PaddedShapeForPhaseCorrelation(image.shape, MinOverlap=1.0, PowerOfTwo=False), image.shape)
+
+    def testFFTBackends(self):
+        '''Every installed backend should round trip an image with an odd width'''
+        image = np.random.rand(64, 63).astype(np.float32)
+
+        for name in sorted(fft_backend.Backends.keys()):
+            try:
+                backend = fft_backend.CreateBackend(name)
+            except ImportError:
+                # Backend is not installed
+                continue
+
+            spectrum = backend.rfft2(image)
+            self.assertEqual(spectrum.shape, (64, 32), "%s backend returned an unexpected spectrum shape" % name)
+
+            restored = backend.irfft2(spectrum, image.shape)
+            self.assertTrue(np.allclose(restored, image, atol=1e-5), "%s backend did not round trip the image" % name)
+
+            stack = np.stack((image, image[::-1, :], image[:, ::-1]))
+            spectra = backend.rfft2_stack(stack)
+            self.assertEqual(spectra.shape, (3, 64, 32), "%s backend returned an unexpected stack of spectra" % name)
+            self.assertTrue(np.allclose(spectra[1], backend.rfft2(stack[1]), atol=1e-3), "%s backend stacked transform does not match a single transform" % name)
+
+            restored = backend.irfft2_stack(spectra, image.shape)
+            self.assertTrue(np.allclose(restored, stack, atol=1e-5), "%s backend did not round trip the stack" % name)
+
+    def testFFTWPlanCache(self):
+        '''FFTW managers should keep a bounded number of plans and estimate plans for new stack shapes'''
+        try:
+            import nornir_imageregistration.fftw_manager as fftw_manager
+        except ImportError:
+            # pyfftw is not installed
+            return
+
+        os.makedirs(self.TestOutputPath, exist_ok=True)
+        WisdomFullPath = os.path.join(self.TestOutputPath, 'PlanCache.wisdom')
+        manager = fftw_manager.FFTWManager(WisdomFullPath=WisdomFullPath, MaxPlans=2)
+
+        plans = [manager.GetRealPlan((16, Width)) for Width in (8, 10, 12)]
+        self.assertEqual(len(manager.dictPlans), 2)
+        self.assertFalse(('r2c', (16, 8)) in manager.dictPlans, "Least recently used plan should be released")
+        self.assertIs(manager.GetRealPlan((16, 12)), plans[2])
+        self.assertTrue(os.path.exists(WisdomFullPath), "Wisdom from the first plan should be saved")
+
+        # Stacks are estimated, then planned with the manager's flags when the shape is requested again
+        stack = np.random.rand(3, 16, 8).astype(np.float32)
+        EstimatedPlan = manager.GetRealPlan(stack.shape)
+        self.assertTrue(('r2c', stack.shape) in manager._EstimatedKeys)
+        MeasuredPlan = manager.GetRealPlan(stack.shape)
+        self.assertIsNot(MeasuredPlan, EstimatedPlan)
+        self.assertFalse(('r2c', stack.shape) in manager._EstimatedKeys)
+        self.assertIs(manager.GetRealPlan(stack.shape), MeasuredPlan)
+        self.assertTrue(np.allclose(MeasuredPlan.irfft2(MeasuredPlan.rfft2(stack)), stack, atol=1e-5))
+
+    def testFindOffsetBatch(self):
+        '''Registering a stack of pairs should match registering each pair'''
+        rng = np.random.RandomState(0)
+        texture = scipy.ndimage.gaussian_filter(rng.rand(400, 400), 2)
+
+        FixedImages = []
+        MovingImages = []
+        for i in range(6):
+            (Y, X) = rng.randint(40, 240, size=2)
+            (dY, dX) = rng.randint(-15, 15, size=2)
+            FixedImages.append(texture[Y:Y + 96, X:X + 80])
+            MovingImages.append(texture[Y + dY:Y + dY + 96, X + dX:X + dX + 80])
+
+        records = core.FindOffsetBatch(FixedImages, MovingImages)
+        self.assertEqual(len(records), len(FixedImages))
+
+        for (Fixed, Moving, record) in zip(FixedImages, MovingImages, records):
+            expected = core.FindOffset(Fixed, Moving)
+            self.assertTrue(np.allclose(record.peak, expected.peak, atol=1e-3), "Batched peak %s does not match %s" % (str(record.peak), str(expected.peak)))
+            self.assertAlmostEqual(record.weight, expected.weight, places=3)
+
+        self.assertRaises(ValueError, core.FindOffsetBatch, FixedImages, MovingImages[:-1])
+
+    def testFindPeakModes(self):
+        '''Both peak finding modes should locate a sub-pixel peak, and the search mask should exclude peaks outside the allowed overlap'''
+        rng = np.random.RandomState(0)
+        (Y, X) = np.indices((128, 128))
+
+        image = rng.rand(128, 128) * 0.1
+        with np.errstate(under='ignore'):
+            image += np.exp(-(((Y - 40.3) ** 2) + ((X - 90.6) ** 2)) / 2.0)
+            image += 2 * np.exp(-(((Y - 64) ** 2) + ((X - 5) ** 2)) / 2.0)
+        expected = (64 - 40.3, 64 - 90.6)
+
+        for mode in core.PeakFindingModes.Modes:
+            ((dY, dX), weight) = core.FindPeak(image, PeakMode=mode)
+            self.assertTrue(np.allclose((dY, dX), (0, 59), atol=0.1), "%s mode should find the strongest peak" % mode)
+
+            # The stronger peak requires the images to overlap by less than 60%
+            mask = core.CreateOverlapMask(image.shape, image.shape, MinOverlap=0.6, CorrelationShape=image.shape)
+            ((dY, dX), weight) = core.FindPeak(image, PeakMode=mode, SearchMask=mask)
+            self.assertTrue(np.allclose((dY, dX), expected, atol=0.1), "%s mode found (%g, %g) instead of %s" % (mode, dY, dX, str(expected)))
+
+        mask = core.CreateOverlapMask((100, 100), (50, 50), MinOverlap=0.5, MaxOverlap=0.9)
+        self.assertEqual(mask.shape, (150, 150))
+        self.assertFalse(mask[75, 75], "Complete overlap should exceed the maximum")
+        self.assertTrue(mask[75, 75 + 40], "Half of the smaller image overlaps")
+        self.assertFalse(mask[75, 75 + 60], "Images do not overlap")
+
+        self.assertRaises(ValueError, core.FindPeak, image, SearchMask=np.zeros(image.shape, dtype=bool))
+
+        # The brightest pixels of a ramp are outside the mask, the peak should be found at the edge of the mask
+        ramp = np.tile(np.arange(128, dtype=np.float64), (128, 1))
+        mask = np.zeros(ramp.shape, dtype=bool)
+        mask[:, :64] = True
+        for mode in core.PeakFindingModes.Modes:
+            ((dY, dX), weight) = core.FindPeak(ramp, PeakMode=mode, SearchMask=mask)
+            self.assertGreaterEqual(64 - dX, 61, "%s mode should find the brightest pixels inside the mask" % mode)
+            self.assertLessEqual(64 - dX, 63, "%s mode should not measure pixels outside the mask" % mode)
+
+    def testFindOffsetWithinWindow(self):
+        '''Normalized cross-correlation should agree between the direct and FFT paths and locate the template within the window'''
+        rng = np.random.RandomState(0)
+        texture = scipy.ndimage.gaussian_filter(rng.rand(200, 200), 2)
+
+        Search = texture[40:140, 50:150]
+        Template = Search[5:90, 20:95] + (rng.rand(85, 75) * 0.01)
+        ncc = core.NormalizedCrossCorrelation(Search, Template)
+        self.assertEqual(ncc.shape, (16, 26))
+
+        bruteforce = np.array([[np.corrcoef(Search[y:y + 85, x:x + 75].flat, Template.flat)[0, 1] for x in range(26)] for y in range(16)])
+        self.assertTrue(np.allclose(ncc, bruteforce, atol=1e-5))
+        self.assertEqual(np.unravel_index(np.argmax(ncc), ncc.shape), (5, 20))
+
+        # Small windows are correlated directly rather than with FFTs
+        direct = core.NormalizedCrossCorrelation(Search[0:90, 15:100], Template)
+        self.assertEqual(direct.shape, (6, 11))
+        self.assertTrue(np.allclose(direct, ncc[0:6, 15:26], atol=1e-5))
+
+        # The window is centered, so the template's displacement is measured from (7.5, 12.5)
+        record = core.FindOffsetWithinWindow(Search, Template)
+        self.assertTrue(np.allclose(record.peak, (5 - 7.5, 20 - 12.5), atol=0.1), str(record.peak))
+        self.assertGreater(record.weight, 0.9)
+
+        self.assertIsNone(core.FindOffsetWithinWindow(Search, np.ones((85, 75))), "A uniform template cannot be registered")
+        self.assertIsNone(core.FindOffsetWithinWindow(Search, Search[0:85, 0:75]), "A peak on the edge of the window may lie outside it")
+
+    def testMaskedNormalizedCrossCorrelation(self):
+        '''Masked pixels should not influence the offset, and repeated registrations should be identical'''
+        rng = np.random.RandomState(0)
+        texture = scipy.ndimage.gaussian_filter(rng.rand(300, 300), 2)
+
+        Fixed = texture[100:228, 100:228]
+        Moving = texture[107:235, 88:216].copy()
+        expected = core.FindOffset(Fixed, Moving).peak
+
+        # Corrupt part of the moving image and mask it
+        Moving[:40, :] = 5.0
+        MovingMask = np.ones(Moving.shape, dtype=bool)
+        MovingMask[:40, :] = False
+
+        record = core.FindOffset(Fixed, Moving, MovingMask=MovingMask)
+        self.assertTrue(np.allclose(record.peak, (7, -12), atol=0.25), "Masked peak %s, phase correlation peak %s" % (str(record.peak), str(expected)))
+        self.assertGreater(record.weight, 0.9)
+        self.assertLessEqual(record.weight, 1.0)
+
+        repeated = core.FindOffset(Fixed, Moving, MovingMask=MovingMask)
+        self.assertTrue(np.array_equal(record.peak, repeated.peak))
+
+        # Images with different shapes use the same peak convention as images centered in padding
+        Small = texture[110:190, 104:204]
+        record = core.FindOffset(Fixed, Small, CorrelationMode=core.CorrelationModes.MASKED_NCC)
+        self.assertTrue(np.allclose(record.peak, (10 + 40 - 64, 4 + 50 - 64), atol=0.25), str(record.peak))
+
+        Correlation = core.MaskedNormalizedCrossCorrelation(Fixed[:20, :24], Small[:16, :18])
+        self.assertEqual(Correlation.shape, core.MaskedCorrelationShape((20, 24), (16, 18)))
+        self.assertLessEqual(np.max(np.abs(Correlation)), 1.0)
+
+        self.assertRaises(FloatingPointError, core.FindOffset, Fixed, np.ones(Moving.shape), CorrelationMode=core.CorrelationModes.MASKED_NCC)
+
+    def testScoreAnglesMasked(self):
+        '''Masked correlation should find the rotation without padding the fixed image'''
+        rng = np.random.RandomState(0)
+        texture = scipy.ndimage.gaussian_filter(rng.rand(160, 160), 2).astype(np.float32)
+
+        Fixed = texture[16:144, 16:144]
+        Warped = scipy.ndimage.rotate(texture, axes=(1, 0), angle=-20, reshape=False)[16:144, 16:144]
+
+        records = stos_brute.ScoreAngles(Fixed, Warped, [0, 10, 20, 30], SingleThread=True, CorrelationMode=core.CorrelationModes.MASKED_NCC)
+        BestMatch = max(records, key=lambda r: r.weight)
+        self.assertEqual(BestMatch.angle, 20)
+        self.assertTrue(np.allclose(BestMatch.peak, (0, 0), atol=1.0), str(BestMatch.peak))
+
+    def testReadImage(self):
+        '''Images should load in their native dtype, reduce with block means, and read sub-regions'''
+        from PIL import Image
+
+        image = (np.arange(60 * 80, dtype=np.uint32).reshape((60, 80)) * 13 % 65536).astype(np.uint16)
+        PngFullPath = os.path.join(self.TestOutputPath, 'ReadImage.png')
+        NpyFullPath = os.path.join(self.TestOutputPath, 'ReadImage.npy')
+        Image.fromarray(image).save(PngFullPath)
+        np.save(NpyFullPath, image)
+
+        for ImageFullPath in [PngFullPath, NpyFullPath]:
+            native = core.ReadImage(ImageFullPath)
+            self.assertEqual(native.dtype, np.uint16)
+            self.assertTrue(np.array_equal(native, image))
+
+            region = core.ReadImage(ImageFullPath, Region=(10, 20, 30, 50))
+            self.assertTrue(np.array_equal(region, image[10:30, 20:50]))
+
+            reduced = core.ReadImage(ImageFullPath, dtype=np.float64, Scalar=0.25)
+            self.assertEqual(reduced.shape, core.ReduceImage(image, 0.25).shape)
+
+        # Integer images from image files are scaled to 0-1 when a float dtype is requested, numpy arrays are not
+        reduced = core.ReadImage(PngFullPath, dtype=np.float64, Scalar=0.25)
+        BlockMeans = image.astype(np.float64).reshape((15, 4, 20, 4)).mean(axis=(1, 3))
+        self.assertTrue(np.allclose(reduced, BlockMeans / 65535.0))
+        self.assertTrue(np.allclose(core.ReadImage(NpyFullPath, dtype=np.float64, Scalar=0.25), BlockMeans))
+
+        # Like LoadImage, other image formats keep their stored range unless scaling is requested
+        TifFullPath = os.path.join(self.TestOutputPath, 'ReadImage.tif')
+        Image.fromarray(image).save(TifFullPath)
+        self.assertTrue(np.allclose(core.ReadImage(TifFullPath, dtype=np.float64, Scalar=0.25), BlockMeans))
+        self.assertTrue(np.allclose(core.ReadImage(TifFullPath, dtype=np.float32), image))
+        self.assertTrue(np.allclose(core.ReadImage(TifFullPath, dtype=np.float64, ScaleIntegers=True), image / 65535.0))
+
+        # LoadImage keeps returning 0-1 floats for PNG files
+        self.assertEqual(core.LoadImage(PngFullPath).dtype, np.float32)
+        self.assertEqual(core.LoadImage(PngFullPath, MaxDimension=40).shape, (30, 40))
+
+    def testImageSizeCache(self):
+        '''Image sizes should be read from headers, cached until the file changes, and recorded in sidecar files'''
+        from PIL import Image
+        import nornir_imageregistration.image_size_cache as image_size_cache
+
+        ImageDir = os.path.join(self.TestOutputPath, 'ImageSizeCache')
+        os.makedirs(ImageDir, exist_ok=True)
+        SidecarPath = os.path.join(ImageDir, image_size_cache.SidecarFilename)
+        if os.path.exists(SidecarPath):
+            os.remove(SidecarPath)
+
+        PngFullPath = os.path.join(ImageDir, 'Size.png')
+        NpyFullPath = os.path.join(ImageDir, 'Size.npy')
+        Image.fromarray(np.zeros((30, 40), dtype=np.uint8)).save(PngFullPath)
+        np.save(NpyFullPath, np.zeros((50, 60, 3), dtype=np.float32))
+
+        cache = image_size_cache.ImageSizeCache(UseSidecar=True)
+        MissingFullPath = os.path.join(ImageDir, 'Missing.png')
+        self.assertEqual(cache.GetImageSizes([PngFullPath, NpyFullPath, MissingFullPath]), [(30, 40), (50, 60), None])
+        self.assertRaises(IOError, cache.GetImageSize, MissingFullPath)
+        self.assertTrue(os.path.exists(SidecarPath))
+
+        # A new cache reads sizes from the sidecar without opening the image
+        cache = image_size_cache.ImageSizeCache(UseSidecar=True)
+        cache._LoadSidecar(ImageDir)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.GetImageSize(PngFullPath), (30, 40))
+
+        # Changed files are read again
+        Image.fromarray(np.zeros((35, 45), dtype=np.uint8)).save(PngFullPath)
+        os.utime(PngFullPath, ns=(0, 0))
+        self.assertEqual(cache.GetImageSize(PngFullPath), (35, 45))
+        self.assertEqual(core.GetImageSize(NpyFullPath), (50, 60))
+
+    def testImageIntensityAtPercent(self):
+        image = np.arange(10000, dtype=np.float64).reshape((100, 100))
+        self.assertAlmostEqual(core.ImageIntensityAtPercent(image, 0.5), 5000, delta=20)
+        self.assertEqual(core.ImageIntensityAtPercent(image, 1.0), image.max())
+
+    def testCompletionQueue(self):
+        '''Every task should be returned once, exceptions are raised by wait_return'''
+        pool = nornir_pools.GetGlobalThreadPool()
+        taskQueue = completion_queue.CompletionQueue(pool, MaxInFlight=2)
+
+        results = []
+        for i in range(10):
+            task = taskQueue.add_task(str(i), _SquareAfterDelay, i)
+            task.index = i
+
+            for t in taskQueue.completed():
+                results.append(t.wait_return())
+
+        for t in taskQueue.as_completed():
+            self.assertEqual(t.wait_return(), t.index * t.index, "Task attributes should be readable from the completed task")
+            results.append(t.wait_return())
+
+        self.assertEqual(sorted(results), [i * i for i in range(10)])
+        self.assertEqual(taskQueue.outstanding, 0)
+
+        taskQueue.add_task("Fail", _SquareAfterDelay, None)
+        failed = list(taskQueue.as_completed())
+        self.assertEqual(len(failed), 1)
+        self.assertRaises(TypeError, failed[0].wait_return)
+
     def testROIRange(self):
 
         r = core.ROIRange(0, 16, 32)
@@ -184,7 +502,30 @@ class Test(setup_imagetest.ImageTestBase):
             self.assertGreaterEqual(cropped[i, i], 0, "Cropped region outside original image should use random value")
         
         core.ShowGrayscale(cropped, title="The bottom left quadrant is a gradient.  The remainder is random noise.")
-            
+
+        # Crops inside the image share its memory unless a copy is requested
+        cropped = core.CropImage(image, 2, 3, 4, 5)
+        self.assertTrue(np.shares_memory(cropped, image))
+        self.assertTrue(np.array_equal(cropped, image[3:8, 2:6]))
+        cropped = core.CropImage(image, 2, 3, 4, 5, copy=True)
+        self.assertFalse(np.shares_memory(cropped, image))
+        self.assertTrue(np.array_equal(cropped, image[3:8, 2:6]))
+
+    def testImageToTilesGenerator(self):
+        image = np.arange(10 * 13, dtype=np.float32).reshape((10, 13))
+        tiles = core.ImageToTiles(image, tile_size=(4, 5))
+        self.assertEqual(len(tiles), 3 * 3)
+
+        for ((iRow, iCol), tile) in tiles.items():
+            self.assertEqual(tile.shape, (4, 5))
+            expected = image[iRow * 4:(iRow + 1) * 4, iCol * 5:(iCol + 1) * 5]
+            self.assertTrue(np.array_equal(tile[:expected.shape[0], :expected.shape[1]], expected))
+            self.assertTrue(np.all(tile[expected.shape[0]:, :] == 0))
+            self.assertTrue(np.all(tile[:, expected.shape[1]:] == 0))
+
+            # Only the tiles on the far edges are padded copies
+            self.assertEqual(np.shares_memory(tile, image), iRow < 2 and iCol < 2)
+
     
     def testImageToTiles(self):
         self.FixedImagePath = os.path.join(self.ImportedDataPath, "0017_TEM_Leveled_image__feabinary_Cel64_Mes8_sp4_Mes8.png")
@@ -247,6 +247,131 @@ class TestLayoutPosition(setup_imagetest.TestBase):
         print("Node Positions")
         print(spring_layout.GetPositions())
 
+    def test_array_layout(self):
+        '''
+        Tension vectors computed from the layout's edge list should match the tension vectors of standalone LayoutPositions
+        '''
+        rng = np.random.RandomState(0)
+        num_nodes = 12
+        
+        spring_layout = Layout()
+        standalone = {}
+        
+        for ID in rng.permutation(num_nodes):
+            position = rng.rand(2) * 100.0
+            spring_layout.CreateNode(ID, position)
+            standalone[ID] = LayoutPosition(ID, position)
+            
+        for iEdge in range(0, 30):
+            (A, B) = rng.choice(num_nodes, 2, replace=False)
+            offset = rng.rand(2) * 10.0
+            weight = rng.rand()
+            spring_layout.SetOffset(A, B, offset, weight)
+            self.SetOffset(standalone[A], standalone[B], offset, weight)
+            
+        for ID, node in spring_layout.nodes.items():
+            expected = standalone[ID]
+            self.assertTrue(np.array_equal(node.OffsetArray, expected.OffsetArray), "Offsets of node %d do not match" % ID)
+            
+            connected_positions = spring_layout.GetPositions(expected.ConnectedIDs)
+            self.assertTrue(np.allclose(spring_layout.NetTensionVector(ID), expected.NetTensionVector(connected_positions)))
+            self.assertTrue(np.allclose(spring_layout.WeightedNetTensionVector(ID), expected.WeightedNetTensionVector(connected_positions)))
+        
+        SortedIDs = sorted(standalone.keys())
+        expected_weighted_tension = np.array([standalone[ID].WeightedNetTensionVector(spring_layout.GetPositions(standalone[ID].ConnectedIDs)) for ID in SortedIDs])
+        self.assertTrue(np.allclose(spring_layout.WeightedNetTensionVectors(), expected_weighted_tension))
+        
+        offsets = OffsetsSortedByWeight(spring_layout)
+        self.assertTrue(np.all(offsets[:, 0] < offsets[:, 1]), "Offsets should be reported from lower to higher ID")
+        self.assertTrue(np.all(np.diff(offsets[:, 4]) <= 0), "Offsets should be sorted by descending weight")
+        for row in offsets:
+            self.assertTrue(np.allclose(spring_layout.nodes[row[0]].GetOffset(row[1]), row[2:4]))
+
+    def test_highest_weights_first(self):
+        '''
+        Two groups of tiles with consistent offsets, joined by a single offset.  Every tile should be placed where the offsets expect
+        '''
+        rng = np.random.RandomState(0)
+        positions = rng.rand(10, 2) * 100.0
+        
+        spring_layout = Layout()
+        for ID in range(0, positions.shape[0]):
+            spring_layout.CreateNode(ID, np.zeros((2)))
+        
+        # Two groups, built in an order where each group grows from both ends before they are merged
+        pairs = [(0, 1), (2, 3), (1, 2), (5, 6), (7, 8), (6, 7), (8, 9), (3, 4), (4, 5)]
+        for (iPair, (A, B)) in enumerate(pairs):
+            spring_layout.SetOffset(A, B, positions[B, :] - positions[A, :], weight=1.0 - (iPair * 0.05))
+            
+        final_layout = BuildLayoutWithHighestWeightsFirst(spring_layout)
+        
+        self.assertEqual(sorted(final_layout.nodes.keys()), list(range(0, positions.shape[0])))
+        
+        final_positions = final_layout.GetPositions()
+        self.assertTrue(np.allclose(final_positions - final_positions[0, :], positions - positions[0, :]), "Tiles should be placed at the offsets")
+
+    def test_least_squares(self):
+        '''
+        The sparse solver should place every node where the offsets expect, regardless of starting position
+        '''
+        spring_layout = Layout()
+
+        positions = np.array([[0, 0],
+                              [10, 5],
+                              [-10, 5],
+                              [5, -20],
+                              [-15, -15]])
+
+        for ID in range(0, positions.shape[0]):
+            spring_layout.CreateNode(ID, np.zeros((2)))
+
+        for A in range(0, positions.shape[0]):
+            for B in range(A + 1, positions.shape[0]):
+                spring_layout.SetOffset(A, B, positions[B, :] - positions[A, :], weight=0.5)
+
+        SolveLayoutLeastSquares(spring_layout, anchor_ID=0)
+
+        self.assertTrue(np.allclose(spring_layout.GetPositions(), positions), "Least squares solution should match consistent offsets")
+
+    def test_least_squares_reweighted(self):
+        '''
+        A grid of tiles where one offset is incorrect.  Reweighting should remove most of the incorrect offset's influence
+        '''
+        spring_layout = Layout()
+
+        grid_dim = 6
+        positions = np.array([[iY * 100.0, iX * 100.0] for iY in range(grid_dim) for iX in range(grid_dim)])
+
+        for ID in range(0, positions.shape[0]):
+            spring_layout.CreateNode(ID, np.zeros((2)))
+
+        for iY in range(grid_dim):
+            for iX in range(grid_dim):
+                A = (iY * grid_dim) + iX
+                neighbors = []
+                if iX + 1 < grid_dim:
+                    neighbors.append(A + 1)
+                if iY + 1 < grid_dim:
+                    neighbors.append(A + grid_dim)
+                if iX + 1 < grid_dim and iY + 1 < grid_dim:
+                    neighbors.append(A + grid_dim + 1)
+
+                for B in neighbors:
+                    spring_layout.SetOffset(A, B, positions[B, :] - positions[A, :], weight=1.0)
+
+        spring_layout.SetOffset(14, 15, np.array([60, 40]), weight=1.0)
+
+        SolveLayoutLeastSquares(spring_layout, anchor_ID=0)
+        unweighted_error = np.max(setup_imagetest.array_distance(spring_layout.GetPositions() - positions))
+
+        SolveLayoutLeastSquares(spring_layout, anchor_ID=0, reweight_iterations=5)
+        reweighted_error = np.max(setup_imagetest.array_distance(spring_layout.GetPositions() - positions))
+
+        self.assertLess(reweighted_error, unweighted_error / 10.0, "Reweighting should reduce the influence of an incorrect offset")
+
+        print("Node Positions")
+        print(spring_layout.GetPositions())
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -3,15 +3,107 @@ Created on Feb 11, 2014
 
 @author: u0490822
 '''
+import collections
 import os
 import unittest
 
 import nornir_imageregistration as nir
+import nornir_imageregistration.tile
 import nornir_imageregistration.tileset as tiles
+from nornir_imageregistration.transforms.triangulation import Triangulation
+import numpy as np
 
 from . import setup_imagetest
 
 
+def _CreateGridTiles(grid_dim, tile_size=100, spacing=90, ImagePathTemplate="%d.png"):
+    '''Create a grid of tiles translated by spacing with a tile_size square image'''
+    
+    tile_list = []
+    for iY in range(grid_dim):
+        for iX in range(grid_dim):
+            ID = (iY * grid_dim) + iX
+            (Y, X) = (iY * spacing, iX * spacing)
+            transform = Triangulation(np.array([[Y, X, 0, 0],
+                                                [Y + tile_size, X, tile_size, 0],
+                                                [Y, X + tile_size, 0, tile_size],
+                                                [Y + tile_size, X + tile_size, tile_size, tile_size]], dtype=np.float64))
+            tile_list.append(nornir_imageregistration.tile.Tile(transform, ImagePathTemplate % ID, ID))
+            
+    return tile_list
+
+
+class TestTileScheduling(setup_imagetest.TestBase):
+    
+    def testOverlappingPairOrder(self):
+        '''Processing the ordered pairs with the reported cache size should load each tile once'''
+        
+        grid_dim = 8
+        tile_list = _CreateGridTiles(grid_dim)
+        
+        pairs = list(nornir_imageregistration.tile.IterateOverlappingTiles(tile_list, minOverlap=0.0))
+        (ordered_pairs, cache_size) = nornir_imageregistration.tile.OrderOverlappingPairsByTile(tile_list, pairs)
+        
+        self.assertEqual(len(ordered_pairs), len(pairs))
+        self.assertEqual(set([(A.ID, B.ID) for (A, B) in ordered_pairs]), set([(A.ID, B.ID) for (A, B) in pairs]))
+        self.assertLessEqual(cache_size, (grid_dim * 2) + 2, "Sweeping the grid should only keep about two rows of tiles")
+        
+        cache = collections.OrderedDict()
+        loads = 0
+        for (A, B) in ordered_pairs:
+            for ID in (A.ID, B.ID):
+                if ID in cache:
+                    cache.move_to_end(ID)
+                else:
+                    loads += 1
+                    cache[ID] = True
+                    if len(cache) > cache_size:
+                        cache.popitem(last=False)
+                        
+        self.assertEqual(loads, len(tile_list), "Each tile should be loaded once")
+        
+    def testTileImageCache(self):
+        
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.TestOutputPath, "%d.npy" % i)
+            np.save(path, np.full((16, 16), i, dtype=np.float32))
+            paths.append(path)
+            
+        cache = nornir_imageregistration.tile.TileImageCache(MaxTiles=2)
+        
+        first = cache.GetImage(paths[0], dtype=np.float16)
+        self.assertEqual(first.dtype, np.float16)
+        self.assertIs(cache.GetImage(paths[0], dtype=np.float16), first, "Cached image should be returned")
+        
+        cache.GetImage(paths[1], dtype=np.float16)
+        self.assertIs(cache.GetImage(paths[0], dtype=np.float16), first, "Most recently used image should remain cached")
+        
+        cache.GetImage(paths[2], dtype=np.float16)
+        self.assertIs(cache.GetImage(paths[0], dtype=np.float16), first, "Most recently used image should remain cached")
+        self.assertEqual(len(cache._images), 2)
+        self.assertFalse(any(key[0] == paths[1] for key in cache._images), "Least recently used image should be discarded")
+        
+        cache.Clear()
+        self.assertIsNot(cache.GetImage(paths[0], dtype=np.float16), first, "Image should be loaded again after clearing the cache")
+
+        # Each float16 image is 512 bytes, so only two fit
+        cache = nornir_imageregistration.tile.TileImageCache(MaxTiles=3, MaxBytes=1024)
+        for path in paths:
+            cache.GetImage(path, dtype=np.float16)
+        self.assertEqual(len(cache._images), 2, "Cache should not hold more than MaxBytes of images")
+        self.assertEqual(cache.nbytes, 1024)
+
+        # Starting a different pass releases the images of the previous pass
+        cache.BeginPass("First")
+        self.assertEqual(len(cache._images), 0)
+        first = cache.GetImage(paths[0], dtype=np.float16)
+        cache.BeginPass("First")
+        self.assertIs(cache.GetImage(paths[0], dtype=np.float16), first, "Images should be kept within a pass")
+        cache.BeginPass("Second")
+        self.assertEqual(cache.nbytes, 0, "Images should be released when a new pass begins")
+
+
 class TestTiles(setup_imagetest.ImageTestBase):
 
 